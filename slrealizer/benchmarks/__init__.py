@@ -0,0 +1,5 @@
+"""
+Benchmarks of the realization pipeline, runnable as scripts, e.g.
+    python -m slrealizer.benchmarks.run_benchmarks
+    python -m slrealizer.benchmarks.bench_object_table
+"""
@@ -0,0 +1,50 @@
+"""
+Benchmarks the aggregation of source tables into object tables by
+:meth:`SLRealizer.make_object_table`, comparing the pivot_table implementation
+with the reduction over sorted (object, filter) segments.
+
+Usage:
+    python -m slrealizer.benchmarks.bench_object_table [--rows 100000 1000000] [--include_std]
+"""
+from __future__ import absolute_import, division, print_function
+import time
+import argparse
+import pandas as pd
+from slrealizer import SLRealizer
+from slrealizer.benchmarks.synthetic import make_synthetic_source_table
+
+def time_object_aggregation(src, engine, include_std, repeat=3):
+    """
+    Returns the best time in seconds of the aggregation step of make_object_table
+    (everything but writing the object table) on the in-memory source table src
+    """
+    realizer = SLRealizer(observation=pd.DataFrame(), add_moment_noise=False, add_flux_noise=False)
+    realizer.sourceTable = src
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        realizer._get_object_stats(source_table_path=None, include_std=include_std, engine=engine)
+        timings.append(time.time() - start)
+    return min(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[10**4, 10**5, 10**6],
+                        help='numbers of source table rows to benchmark')
+    parser.add_argument('--include_std', action='store_true', help='also aggregate standard deviations')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs per engine (the best is kept)')
+    args = parser.parse_args()
+
+    results = []
+    for num_rows in args.rows:
+        src = make_synthetic_source_table(num_rows)
+        pandas_time = time_object_aggregation(src, 'pandas', args.include_std, repeat=args.repeat)
+        numpy_time = time_object_aggregation(src, 'numpy', args.include_std, repeat=args.repeat)
+        results.append((len(src), pandas_time, numpy_time))
+
+    print("%12s %12s %12s %8s" %('rows', 'pandas [s]', 'numpy [s]', 'speedup'))
+    for num_rows, pandas_time, numpy_time in results:
+        print("%12d %12.3f %12.3f %7.1fx" %(num_rows, pandas_time, numpy_time, pandas_time/numpy_time))
+
+if __name__ == '__main__':
+    main()
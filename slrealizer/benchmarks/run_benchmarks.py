@@ -0,0 +1,343 @@
+"""
+Scaling benchmark suite of the realization pipeline: times each stage on synthetic catalogs
+and observation histories (see benchmarks.synthetic) at several numbers of source table rows,
+and saves the results as JSON, named after the current git commit, so that runs of
+different commits can be compared offline.
+
+Usage:
+    python -m slrealizer.benchmarks.run_benchmarks [--scales 1e3 1e4 1e5 1e6] [--benchmarks om10 object]
+        [--output_dir DIR] [--label LABEL] [--compare BASELINE.json]
+
+Each benchmark is set up anew (untimed) before each timed run, and the best of the runs is kept.
+Where tracemalloc is available (Python 3), the peak memory allocated by one further run is recorded too.
+Benchmarks of the per-stamp GalSim paths are capped at fewer rows than the columnar ones.
+"""
+from __future__ import absolute_import, division, print_function
+import os
+import sys
+import json
+import time
+import shutil
+import warnings
+import platform
+import argparse
+import tempfile
+import datetime
+import subprocess
+import numpy as np
+import pandas as pd
+from slrealizer.benchmarks import synthetic
+
+# Registered benchmarks, in the order they are run: name -> (setup function, maximum number of rows)
+BENCHMARKS = []
+
+def benchmark(name, max_rows=None):
+    """
+    Registers a benchmark. The decorated function setup(num_rows, work_dir) prepares
+    the inputs of about num_rows source table rows and returns the function to be timed.
+    """
+    def register(setup):
+        BENCHMARKS.append((name, setup, max_rows))
+        return setup
+    return register
+
+class _Quiet(object):
+    """
+    Context manager silencing the progress printed and the warnings raised by the realizers
+    """
+    def __enter__(self):
+        self.stdout = sys.stdout
+        self.devnull = open(os.devnull, 'w')
+        sys.stdout = self.devnull
+        self.warnings = warnings.catch_warnings()
+        self.warnings.__enter__()
+        warnings.simplefilter('ignore')
+
+    def __exit__(self, *args):
+        self.warnings.__exit__(*args)
+        sys.stdout = self.stdout
+        self.devnull.close()
+
+def _make_om10_realizer(num_rows, add_moment_noise=True):
+    from slrealizer.realize_om10 import OM10Realizer
+
+    num_lenses, num_obs = synthetic.get_catalog_size(num_rows)
+    realizer = OM10Realizer(observation=synthetic.make_synthetic_observation(num_obs),
+                            catalog=synthetic.SyntheticOM10Catalog(num_lenses),
+                            add_moment_noise=add_moment_noise, add_flux_noise=True)
+    return realizer
+
+def _make_stamp_inputs(realizer, num_stamps):
+    """
+    Returns lists of num_stamps (observation, lens) pairs of the realizer,
+    cycling through its catalog and observation history
+    """
+    obs_infos = [realizer.observation.loc[i%realizer.num_obs] for i in range(num_stamps)]
+    lens_infos = [realizer.catalog.sample[i%realizer.num_systems] for i in range(num_stamps)]
+    return obs_infos, lens_infos
+
+@benchmark('om10_preformat_source_table')
+def setup_om10_preformat(num_rows, work_dir):
+    realizer = _make_om10_realizer(num_rows)
+    return realizer._preformat_source_table
+
+@benchmark('om10_include_moments')
+def setup_om10_include_moments(num_rows, work_dir):
+    # Without moment noise, to time the moments alone
+    realizer = _make_om10_realizer(num_rows, add_moment_noise=False)
+    realizer._preformat_source_table()
+    src = realizer.source_table
+    src['apFlux'] = src[['q_flux_' + str(q) for q in range(4)] + ['lens_flux']].sum(axis=1)
+    return realizer._include_moments
+
+@benchmark('om10_include_quasar_variability')
+def setup_om10_variability(num_rows, work_dir):
+    realizer = _make_om10_realizer(num_rows)
+    realizer._preformat_source_table()
+    return lambda: realizer.include_quasar_variability(save_output=False)
+
+@benchmark('om10_source_table_vectorized')
+def setup_om10_vectorized(num_rows, work_dir):
+    realizer = _make_om10_realizer(num_rows)
+    path = os.path.join(work_dir, 'om10_source.csv')
+    return lambda: realizer.make_source_table_vectorized(path, include_time_variability=False)
+
+@benchmark('om10_source_table_vectorized_variability')
+def setup_om10_vectorized_variability(num_rows, work_dir):
+    realizer = _make_om10_realizer(num_rows)
+    path = os.path.join(work_dir, 'om10_source_variability.csv')
+    return lambda: realizer.make_source_table_vectorized(path, include_time_variability=True)
+
+@benchmark('sdss_source_table_vectorized')
+def setup_sdss_vectorized(num_rows, work_dir):
+    from slrealizer.realize_sdss import SDSSRealizer
+
+    num_objects, num_obs = synthetic.get_catalog_size(num_rows)
+    realizer = SDSSRealizer(observation=synthetic.make_synthetic_observation(num_obs),
+                            catalog=synthetic.make_synthetic_sdss_catalog(num_objects),
+                            add_moment_noise=True, add_flux_noise=True)
+    path = os.path.join(work_dir, 'sdss_source.csv')
+    return lambda: realizer.make_source_table_vectorized(path)
+
+@benchmark('object_table')
+def setup_object_table(num_rows, work_dir):
+    from slrealizer import SLRealizer
+
+    realizer = SLRealizer(observation=pd.DataFrame(), add_moment_noise=False, add_flux_noise=False)
+    realizer.sourceTable = synthetic.make_synthetic_source_table(num_rows)
+    path = os.path.join(work_dir, 'object.csv')
+    return lambda: realizer.make_object_table(path, include_std=True)
+
+@benchmark('galsim_draw_system', max_rows=10**3)
+def setup_galsim_draw_system(num_rows, work_dir):
+    realizer = _make_om10_realizer(num_rows)
+    obs_infos, lens_infos = _make_stamp_inputs(realizer, num_rows)
+    def run():
+        for obs_info, lens_info in zip(obs_infos, lens_infos):
+            realizer.draw_system(obs_info=obs_info, lens_info=lens_info)
+    return run
+
+@benchmark('galsim_draw_system_by_observation', max_rows=10**3)
+def setup_galsim_draw_system_by_observation(num_rows, work_dir):
+    # All systems under one observation after another, as in make_source_table_rowbyrow,
+    # so that the systems of an observation share its PSF
+    realizer = _make_om10_realizer(num_rows)
+    lens_infos = [realizer.catalog.sample[i] for i in range(realizer.num_systems)]
+    obs_infos = [realizer.observation.loc[j] for j in range(realizer.num_obs)]
+    def run():
+        for obs_info in obs_infos:
+            for lens_info in lens_infos:
+                realizer.draw_system(obs_info=obs_info, lens_info=lens_info)
+    return run
+
+@benchmark('galsim_estimate_parameters_hsm', max_rows=10**3)
+def setup_galsim_hsm(num_rows, work_dir):
+    return _setup_estimate_parameters(num_rows, method='hsm')
+
+@benchmark('galsim_estimate_parameters_raw_numerical', max_rows=10**3)
+def setup_galsim_raw_numerical(num_rows, work_dir):
+    return _setup_estimate_parameters(num_rows, method='raw_numerical')
+
+def _setup_estimate_parameters(num_rows, method):
+    from slrealizer import SLRealizer
+
+    realizer = _make_om10_realizer(num_rows)
+    obs_infos, lens_infos = _make_stamp_inputs(realizer, num_rows)
+    # Time the shape estimation alone, on images drawn beforehand
+    images = [realizer.draw_system(obs_info=obs_info, lens_info=lens_info)
+              for obs_info, lens_info in zip(obs_infos, lens_infos)]
+    def run():
+        for galsim_img in images:
+            SLRealizer.estimate_parameters(realizer, galsim_img=galsim_img, method=method)
+    return run
+
+@benchmark('numpy_render_raw_numerical', max_rows=10**4)
+def setup_numpy_render(num_rows, work_dir):
+    realizer = _make_om10_realizer(num_rows)
+    obs_infos, lens_infos = _make_stamp_inputs(realizer, num_rows)
+    galsim_infos = [realizer._om10_to_galsim(lens_info, obs_info['filter'])
+                    for obs_info, lens_info in zip(obs_infos, lens_infos)]
+    psf_fwhms = np.array([obs_info['FWHMeff'] for obs_info in obs_infos])
+    def run():
+        for start in range(0, num_rows, realizer.render_batch_size):
+            end = start + realizer.render_batch_size
+            image_stack = realizer.render_systems(lens_infos=galsim_infos[start:end], psf_fwhms=psf_fwhms[start:end])
+            realizer._estimate_parameters_batch(image_stack=image_stack, method='raw_numerical')
+    return run
+
+def _get_peak_memory_mb(run):
+    """
+    Returns the peak memory in MB allocated during run(), or None without tracemalloc
+    """
+    try:
+        import tracemalloc
+    except ImportError: # Python 2
+        return None
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak/2**20
+
+def time_benchmark(setup, num_rows, work_dir, repeat=3, measure_memory=True):
+    """
+    Returns a dictionary of the timings in seconds of repeat runs of the benchmark
+    set up by setup for num_rows rows, of the best of them, and of the peak memory in MB
+    """
+    times = []
+    for _ in range(repeat):
+        with _Quiet():
+            run = setup(num_rows, work_dir)
+            start = time.time()
+            run()
+            times.append(time.time() - start)
+    peak_memory_mb = None
+    if measure_memory:
+        with _Quiet():
+            peak_memory_mb = _get_peak_memory_mb(setup(num_rows, work_dir))
+    return {'time': min(times), 'times': times, 'peak_memory_mb': peak_memory_mb}
+
+def _get_git_commit():
+    """
+    Returns the short hash of the checked out commit, with a '-dirty' suffix
+    if the working tree has uncommitted changes, or None outside a git repository
+    """
+    repo_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir).decode().strip()
+        status = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo_dir).decode()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if status.strip() else '')
+
+def _get_versions():
+    versions = {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__}
+    try:
+        import galsim
+        versions['galsim'] = galsim.__version__
+    except (ImportError, AttributeError):
+        pass
+    return versions
+
+def run_benchmarks(scales, names=None, repeat=3, measure_memory=True):
+    """
+    Runs the registered benchmarks whose names contain any of names (all if None)
+    at each number of rows in scales, and returns the list of results
+    """
+    results = []
+    work_dir = tempfile.mkdtemp(prefix='slrealizer_benchmarks_')
+    try:
+        for name, setup, max_rows in BENCHMARKS:
+            if names and not any(n in name for n in names):
+                continue
+            for num_rows in scales:
+                if max_rows is not None and num_rows > max_rows:
+                    continue
+                result = time_benchmark(setup, num_rows, work_dir, repeat=repeat, measure_memory=measure_memory)
+                result.update(benchmark=name, rows=num_rows)
+                results.append(result)
+                print("%-42s %10d %10.3f s %s" %(name, num_rows, result['time'],
+                      '' if result['peak_memory_mb'] is None else '%10.1f MB' %result['peak_memory_mb']))
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+def save_results(results, output_dir, label=None):
+    """
+    Saves the results with the commit and environment they were obtained in
+    as output_dir/<label>.json, the label defaulting to the git commit,
+    and returns the path of the file
+    """
+    commit = _get_git_commit()
+    if label is None:
+        label = commit or datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    path = os.path.join(output_dir, label + '.json')
+    with open(path, 'w') as f:
+        json.dump({'label': label,
+                   'commit': commit,
+                   'date': datetime.datetime.now().isoformat(),
+                   'machine': platform.platform(),
+                   'versions': _get_versions(),
+                   'results': results, }, f, indent=1, sort_keys=True)
+    return path
+
+def compare_results(results, baseline_path, threshold=0.2):
+    """
+    Prints the ratio of each timing in results to the same benchmark and number of rows
+    in the results saved at baseline_path, flagging slowdowns by more than threshold,
+    and returns the number of those regressions
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    baseline_times = dict(((r['benchmark'], r['rows']), r['time']) for r in baseline['results'])
+    print("\nCompared with %s (commit %s):" %(baseline['label'], baseline['commit']))
+    print("%-42s %10s %12s %12s %8s" %('benchmark', 'rows', 'baseline [s]', 'current [s]', 'ratio'))
+    num_regressions = 0
+    for result in results:
+        key = (result['benchmark'], result['rows'])
+        if key not in baseline_times:
+            continue
+        ratio = result['time']/baseline_times[key]
+        is_regression = ratio > 1.0 + threshold
+        num_regressions += is_regression
+        print("%-42s %10d %12.3f %12.3f %7.2fx%s" %(key[0], key[1], baseline_times[key], result['time'], ratio,
+                                                   '  <-- slower' if is_regression else ''))
+    return num_regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scales', type=float, nargs='+', default=[1e3, 1e4, 1e5, 1e6],
+                        help='numbers of source table rows to benchmark, e.g. 1e3 1e7')
+    parser.add_argument('--benchmarks', nargs='+', default=None,
+                        help='run only the benchmarks whose names contain any of these strings')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs per benchmark (the best is kept)')
+    parser.add_argument('--no_memory', action='store_true', help='skip the peak memory measurement')
+    parser.add_argument('--output_dir', default=os.path.join(os.path.dirname(os.path.realpath(__file__)), 'results'),
+                        help='directory of the saved results')
+    parser.add_argument('--label', default=None, help='name of the saved results [default: the git commit]')
+    parser.add_argument('--compare', default=None, help='path of earlier saved results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative slowdown flagged as a regression in the comparison')
+    parser.add_argument('--list', action='store_true', help='list the benchmarks and exit')
+    args = parser.parse_args()
+
+    if args.list:
+        for name, _, max_rows in BENCHMARKS:
+            print(name if max_rows is None else '%s (up to %d rows)' %(name, max_rows))
+        return 0
+
+    results = run_benchmarks([int(s) for s in args.scales], names=args.benchmarks,
+                             repeat=args.repeat, measure_memory=not args.no_memory)
+    path = save_results(results, args.output_dir, label=args.label)
+    print("Saved the results at %s" %path)
+    if args.compare is not None:
+        return 1 if compare_results(results, args.compare, threshold=args.threshold) else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""
+Synthetic inputs of the realizers for benchmarking: lens and non-lens catalogs,
+observation histories and source tables of any size, shaped like the real inputs
+read by the :class:`Dataloader` but made locally and deterministically from a seed,
+so that benchmarks run offline and are comparable across commits.
+"""
+from __future__ import absolute_import, division, print_function
+import numpy as np
+import pandas as pd
+
+class SyntheticOM10Catalog(object):
+    """
+    Stand-in for a painted OM10 DB, holding a synthetic sample of lensed quasars
+    with the columns used by OM10Realizer (a mix of doubles and quads)
+
+    Keyword arguments:
+    num_lenses -- number of lens systems
+    seed -- seed of the random catalog [default: 123]
+    """
+
+    def __init__(self, num_lenses, seed=123):
+        import slrealizer.utils.utils as utils
+
+        rng = np.random.RandomState(seed)
+        columns = {}
+        for b in 'ugriz':
+            columns[b + '_SDSS_lens'] = rng.uniform(18.0, 21.0, num_lenses)
+            columns[b + '_SDSS_quasar'] = rng.uniform(19.0, 22.0, num_lenses)
+        columns['REFF_T'] = rng.uniform(0.5, 1.5, num_lenses)
+        # About one in six OM10 systems is a quad
+        columns['NIMG'] = np.where(rng.uniform(size=num_lenses) < 1.0/6.0, 4, 2)
+        columns['LENSID'] = 100 + 7*np.arange(num_lenses)
+        columns['ELLIP'] = rng.uniform(0.05, 0.5, num_lenses)
+        columns['PHIE'] = rng.uniform(-90.0, 90.0, num_lenses)
+        # Nonexistent images have zero magnification and position, as in OM10
+        exists = np.arange(4)[np.newaxis, :] < columns['NIMG'][:, np.newaxis]
+        signs = rng.choice([-1.0, 1.0], (num_lenses, 4))
+        columns['MAG'] = np.where(exists, rng.uniform(1.0, 5.0, (num_lenses, 4))*signs, 0.0)
+        columns['XIMG'] = np.where(exists, rng.uniform(-1.5, 1.5, (num_lenses, 4)), 0.0)
+        columns['YIMG'] = np.where(exists, rng.uniform(-1.5, 1.5, (num_lenses, 4)), 0.0)
+
+        flat_catalog = pd.DataFrame(dict((c, v) for c, v in columns.items() if np.ndim(v) == 1))
+        for mc in ['MAG', 'XIMG', 'YIMG']:
+            for c in range(4):
+                flat_catalog[mc + '_' + str(c)] = columns[mc][:, c]
+        self.sample = utils.get_om10_sample(flat_catalog)
+        self.flat_catalog = utils.get_flat_om10_catalog(self.sample)
+
+def make_synthetic_observation(num_obs, seed=123):
+    """
+    Returns a synthetic observation history of num_obs visits over ten years,
+    with the columns of the minion_1060 history read by the Dataloader
+    """
+    rng = np.random.RandomState(seed)
+    return pd.DataFrame({'obsHistID': np.arange(num_obs),
+                         'expMJD': np.sort(rng.uniform(59580.0, 59580.0 + 3650.0, num_obs)),
+                         'filter': rng.choice(list('ugriz'), num_obs),
+                         'FWHMeff': rng.uniform(0.5, 1.2, num_obs),
+                         'fiveSigmaDepth': rng.uniform(22.0, 25.0, num_obs), },
+                        columns=['obsHistID', 'expMJD', 'filter', 'FWHMeff', 'fiveSigmaDepth'])
+
+def make_synthetic_sdss_catalog(num_objects, seed=123):
+    """
+    Returns a synthetic non-lens catalog of num_objects objects,
+    with the columns of the processed SDSS catalog read by the Dataloader
+    """
+    rng = np.random.RandomState(seed)
+    catalog = pd.DataFrame({'objectId': 5000 + np.arange(num_objects)})
+    for p, low, high in [('modelFlux', 10.0, 100.0), ('offsetRa', -0.5, 0.5), ('offsetDec', -0.5, 0.5),
+                         ('mRrCc', 5.0, 30.0), ('mE1', -0.3, 0.3), ('mE2', -0.3, 0.3)]:
+        for b in 'ugriz':
+            catalog[p + '_' + b] = rng.uniform(low, high, num_objects)
+    return catalog
+
+def get_catalog_size(num_rows, num_obs=200):
+    """
+    Returns the numbers of systems and of observations (at most num_obs)
+    whose cross join has about num_rows rows
+    """
+    num_obs = max(min(num_obs, num_rows), 1)
+    return max(num_rows//num_obs, 1), num_obs
+
+def make_synthetic_source_table(num_rows, num_obs=200, seed=123):
+    """
+    Returns a synthetic source table of about num_rows rows, indexed by objectId,
+    with num_obs observations per object cycling through the ugriz filters
+    """
+    rng = np.random.RandomState(seed)
+    num_objects = max(num_rows//num_obs, 1)
+    num_rows = num_objects*num_obs
+    src = pd.DataFrame({'objectId': np.repeat(np.arange(num_objects), num_obs),
+                        'MJD': np.tile(59580.0 + 3.0*np.arange(num_obs), num_objects),
+                        'ccdVisitId': np.tile(np.arange(num_obs), num_objects),
+                        'filter': np.tile(np.array(list('ugriz'))[np.arange(num_obs)%5], num_objects),
+                        'psf_fwhm': rng.uniform(0.5, 1.2, num_rows), })
+    for p in ['x', 'y', 'e1', 'e2', 'phi_final']:
+        src[p] = rng.normal(size=num_rows)
+    for p in ['apFlux', 'apFluxErr', 'apMag', 'apMagErr', 'trace', 'e_final']:
+        src[p] = rng.uniform(0.1, 1.0, num_rows)
+    return src.set_index('objectId')
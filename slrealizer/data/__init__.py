@@ -1,3 +1,4 @@
 from dataloader import Dataloader
+from cache import DataCache
 
-__all__ = [Dataloader]
\ No newline at end of file
+__all__ = [Dataloader, DataCache]
\ No newline at end of file
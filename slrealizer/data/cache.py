@@ -0,0 +1,271 @@
+"""
+The :mod:`cache` module contains the :class:`DataCache` class, a local on-disk cache
+of the remote input tables (observation histories, catalogs) read by the :class:`Dataloader`.
+
+Each downloaded table is stored once, in a directory named after the SHA-256 checksum
+of the downloaded file, as one .npy file per column. Later reads memory-map the columns
+instead of downloading and parsing the text file again. The checksum of each column is verified
+when it is stored or first read; after that, its size and modification time are checked
+against the index, and only a changed file is checksummed again.
+An index file maps each source URL to its entry, so a cache directory seeded elsewhere
+can be used fully offline. Tables derived from the inputs (such as the painted OM10 catalog)
+are cached the same way, under a key identifying their inputs and parameters.
+"""
+from __future__ import absolute_import, division, print_function
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+
+# Name of the index file in the cache directory
+INDEX_FILENAME = 'index.json'
+
+def _get_default_cache_dir():
+    return os.environ.get('SLREALIZER_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'slrealizer'))
+
+def get_file_sha256(path, block_size=2**20):
+    """
+    Returns the SHA-256 checksum of the file at path, as a hexadecimal string
+    """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def _get_file_stat(path):
+    """
+    Returns the size and modification time of the file at path,
+    with which a cached column is recognized as unchanged
+    """
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, }
+
+def _download(url, path):
+    try:
+        from urllib.request import urlopen
+    except ImportError: # Python 2
+        from urllib2 import urlopen
+    response = urlopen(url)
+    try:
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(response, f)
+    finally:
+        response.close()
+
+class DataCache(object):
+    """
+    Local cache of remote tables, stored as memory-mappable columns.
+
+    Keyword arguments:
+    cache_dir -- directory of the cache. If None, the SLREALIZER_CACHE_DIR environment
+                 variable or ~/.cache/slrealizer is used. [default: None]
+    offline -- whether to never download, reading only tables already in the cache.
+               If None, offline mode is on when the SLREALIZER_OFFLINE environment
+               variable is set to a non-empty value other than '0'. [default: None]
+    verify -- whether to verify the checksum of each cached column on every read,
+              rather than only of the columns whose size or modification time changed
+              since they were verified (see also the verify method) [default: False]
+    """
+
+    def __init__(self, cache_dir=None, offline=None, verify=False):
+        self.cache_dir = _get_default_cache_dir() if cache_dir is None else cache_dir
+        if offline is None:
+            offline = os.environ.get('SLREALIZER_OFFLINE', '') not in ('', '0')
+        self.offline = offline
+        self.verify = verify
+
+    def _get_index_path(self):
+        return os.path.join(self.cache_dir, INDEX_FILENAME)
+
+    def _read_index(self):
+        index_path = self._get_index_path()
+        if not os.path.exists(index_path):
+            return {}
+        with open(index_path) as f:
+            return json.load(f)
+
+    def _write_index(self, index):
+        # Write then rename, so concurrent readers never see a partial index
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.rename(tmp_path, self._get_index_path())
+
+    def read_csv(self, url, **read_csv_kwargs):
+        """
+        Returns the csv table at url as a Pandas dataframe,
+        from the cache if it was read before and downloading it into the cache otherwise
+
+        Keyword arguments:
+        url -- URL of the csv table
+        read_csv_kwargs -- keyword arguments passed on to pd.read_csv on download
+        """
+        entry = self._read_index().get(url)
+        if entry is not None:
+            df = self._load_entry(url, entry)
+            if df is not None:
+                return df
+            if self.offline:
+                raise IOError("The cached copy of %s in %s is corrupt, and downloading is disabled in offline mode." %(url, self.cache_dir))
+            # Discard the corrupt copy before downloading again
+            shutil.rmtree(os.path.join(self.cache_dir, entry['sha256']), ignore_errors=True)
+        elif self.offline:
+            raise IOError("%s is not in the cache at %s, and downloading is disabled in offline mode." %(url, self.cache_dir))
+        return self._add(url, **read_csv_kwargs)
+
+    def read_table(self, key, make_table):
+        """
+        Returns the table cached under key as a Pandas dataframe,
+        making it with make_table() and caching it if it is not cached yet.
+        Used for tables derived locally from inputs (which are part of the key),
+        so they are made even in offline mode.
+
+        Keyword arguments:
+        key -- string identifying the table, e.g. a checksum of the inputs and the parameters
+        make_table -- function returning the table as a Pandas dataframe
+        """
+        entry = self._read_index().get(key)
+        if entry is not None:
+            df = self._load_entry(key, entry)
+            if df is not None:
+                return df
+            shutil.rmtree(os.path.join(self.cache_dir, entry['sha256']), ignore_errors=True)
+        df = make_table()
+        sha256 = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        self._store(key, df, sha256, self._make_tmp_dir())
+        return df
+
+    def _make_tmp_dir(self):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        return tempfile.mkdtemp(dir=self.cache_dir)
+
+    def _add(self, url, **read_csv_kwargs):
+        """
+        Downloads the csv table at url and stores it in the cache
+        """
+        tmp_dir = self._make_tmp_dir()
+        try:
+            download_path = os.path.join(tmp_dir, 'download.csv')
+            _download(url, download_path)
+            sha256 = get_file_sha256(download_path)
+            df = pd.read_csv(download_path, **read_csv_kwargs)
+            os.remove(download_path)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        self._store(url, df, sha256, tmp_dir)
+        return df
+
+    def _store(self, key, df, sha256, tmp_dir):
+        """
+        Saves the columns of df into tmp_dir, moves it to the entry directory
+        named sha256 and indexes it under key
+        """
+        try:
+            entry = {'sha256': sha256, 'columns': [], }
+            for i, column in enumerate(df.columns):
+                filename = 'column_%d.npy' %i
+                values = df[column].values
+                if values.dtype == object and all(isinstance(v, str) for v in values):
+                    values = values.astype(str) # fixed-width strings can be memory-mapped
+                np.save(os.path.join(tmp_dir, filename), values, allow_pickle=(values.dtype == object))
+                entry['columns'].append({'name': column,
+                                         'file': filename,
+                                         'sha256': get_file_sha256(os.path.join(tmp_dir, filename)), })
+
+            # Identical tables share one entry
+            entry_dir = os.path.join(self.cache_dir, sha256)
+            if os.path.exists(entry_dir):
+                shutil.rmtree(tmp_dir)
+            else:
+                os.rename(tmp_dir, entry_dir)
+            for column in entry['columns']:
+                column.update(_get_file_stat(os.path.join(entry_dir, column['file'])))
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        index = self._read_index()
+        index[key] = entry
+        self._write_index(index)
+
+    def _check_column(self, entry_dir, column):
+        """
+        Returns whether the cached column file is intact, checksumming it
+        only if self.verify is True or its size or modification time differ from the index.
+        The size and modification time of a column that passes the checksum
+        are updated in column.
+        """
+        path = os.path.join(entry_dir, column['file'])
+        if not os.path.exists(path):
+            return False
+        stat = _get_file_stat(path)
+        if not self.verify and all(column.get(k) == v for k, v in stat.items()):
+            return True
+        if get_file_sha256(path) != column['sha256']:
+            return False
+        column.update(stat)
+        return True
+
+    def _load_entry(self, key, entry):
+        """
+        Returns the cached table of the index entry under key, or None if any of its files
+        is missing or fails the checksum
+        """
+        entry_dir = os.path.join(self.cache_dir, entry['sha256'])
+        old_stats = [(column.get('size'), column.get('mtime')) for column in entry['columns']]
+        columns = []
+        for column in entry['columns']:
+            if not self._check_column(entry_dir, column):
+                return None
+            path = os.path.join(entry_dir, column['file'])
+            try:
+                # Copy-on-write, so that the table can be modified without changing the cached file
+                values = np.load(path, mmap_mode='c')
+            except ValueError: # object columns cannot be memory-mapped
+                values = np.load(path, allow_pickle=True)
+            if values.dtype.kind == 'U':
+                values = values.astype(object) # as pd.read_csv returns strings
+            columns.append((column['name'], values))
+        # Record the verified columns (e.g. of a cache directory copied from elsewhere),
+        # so that they are not checksummed again
+        if old_stats != [(column.get('size'), column.get('mtime')) for column in entry['columns']]:
+            index = self._read_index()
+            index[key] = entry
+            self._write_index(index)
+        # Without copy=False, the columns would be copied out of the memory maps into blocks
+        return pd.DataFrame(dict(columns), columns=[name for name, _ in columns], copy=False)
+
+    def verify_entries(self):
+        """
+        Verifies the checksum of every column in the cache,
+        and removes the entries with missing or corrupt columns,
+        which are then downloaded or made again when next read
+
+        Returns:
+        the list of keys (URLs or derived table keys) of the removed entries
+        """
+        index = self._read_index()
+        corrupt = set()
+        for key, entry in sorted(index.items()):
+            entry_dir = os.path.join(self.cache_dir, entry['sha256'])
+            for column in entry['columns']:
+                column.pop('size', None) # forces the checksum
+                if not self._check_column(entry_dir, column):
+                    corrupt.add(entry['sha256'])
+                    break
+        # Identical tables share one entry directory
+        removed = sorted(key for key, entry in index.items() if entry['sha256'] in corrupt)
+        for key in removed:
+            del index[key]
+        for sha256 in corrupt:
+            shutil.rmtree(os.path.join(self.cache_dir, sha256), ignore_errors=True)
+        if os.path.exists(self.cache_dir):
+            self._write_index(index)
+        return removed
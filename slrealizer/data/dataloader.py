@@ -5,21 +5,73 @@ from __future__ import absolute_import, division, print_function
 
 import os
 
+def _make_painted_om10(catalog_path, select_random_kwargs, random_seed, paint_kwargs):
+    """
+    Reads the OM10 catalog at catalog_path, selects a random subsample
+    (seeded with random_seed, if given) and paints it
+    """
+    import numpy as np
+    from om10 import DB
+
+    lens_catalog = DB(catalog=catalog_path)
+    if select_random_kwargs is not None:
+        if random_seed is not None:
+            np.random.seed(random_seed)
+        lens_catalog.select_random(**select_random_kwargs)
+    lens_catalog.paint(**paint_kwargs)
+    return lens_catalog
+
+class _CachedOM10DB(object):
+    """
+    Stands in for an OM10 DB whose flattened catalog was read from the cache.
+    The DB itself is only read, selected and painted on first access to any of its
+    attributes (such as the sample read by the row-by-row paths of OM10Realizer),
+    and then behaves as the DB returned on a cache miss.
+    """
+
+    def __init__(self, flat_catalog, *make_args):
+        self.flat_catalog = flat_catalog
+        self._make_args = make_args
+        self._db = None
+
+    def __getattr__(self, name):
+        # Only called for the attributes not set in __init__
+        if name.startswith('__') or name in ('_make_args', '_db'):
+            raise AttributeError(name)
+        if self._db is None:
+            self._db = _make_painted_om10(*self._make_args)
+            self._db.flat_catalog = self.flat_catalog
+        return getattr(self._db, name)
+
 class Dataloader:
     """
     Utility class for reading in data files and doing some operations,
     such as querying or basic preprocessing, on them.
 
+    Remote input files are read through a local on-disk cache (see DataCache),
+    so they are downloaded and parsed only once.
+
+    Parameters
+    ----------
+    cache_dir : str, optional
+        Directory of the local cache of remote files. If None, the
+        SLREALIZER_CACHE_DIR environment variable or ~/.cache/slrealizer is used.
+    offline : Boolean, optional
+        Whether to read remote files only from the cache, without downloading.
+        If None, set by the SLREALIZER_OFFLINE environment variable.
+
     Methods
     -------
     read(filename, is_test)
         Reads in the data file
     """
 
-    def __init__(self):
+    def __init__(self, cache_dir=None, offline=None):
         # Path of the data package where all data files reside
         from slrealizer import data
+        from slrealizer.data.cache import DataCache
         self.data_dir = data.__path__[0]
+        self.cache = DataCache(cache_dir=cache_dir, offline=offline)
 
     def read(self, filename, is_test):
         allowed_filenames = ['om10', 'observation', 'sdss']
@@ -51,17 +103,68 @@ class Dataloader:
         DB
             The OM10 catalog.
         """
-        from om10 import DB
-
         if is_test:
-            catalog_path = os.path.join(self.data_dir, 'test_catalog.fits')
-            lens_catalog = DB(catalog=catalog_path)
+            return self.read_painted_om10(catalog_path=os.path.join(self.data_dir, 'test_catalog.fits'))
         else:
-            lens_catalog = DB()
+            # The full mock catalog, where OM10 keeps it
+            return self.read_painted_om10(catalog_path=os.path.expandvars('$OM10_DIR/data/qso_mock.fits'))
 
-        lens_catalog.paint(synthetic=True)
+    def read_painted_om10(self, catalog_path, select_random_kwargs=None, random_seed=None, paint_kwargs=None):
+        """Reads in an OM10 catalog, selected and painted, through the cache.
 
-        return lens_catalog
+        The painted, flattened and deduplicated catalog is cached under
+        the path, size and modification time of the input FITS catalog
+        and the selection and paint parameters. Later reads of the same catalog
+        skip reading, painting and converting it, until the sample is needed:
+        the returned DB is then read, selected and painted on first use.
+        The sample of the returned DB is left as OM10 selects and paints it,
+        and its flat_catalog attribute holds the flattened catalog
+        (see utils.get_flat_om10_catalog) used by OM10Realizer.
+
+        Parameters
+        ----------
+        catalog_path : str
+            Path of the OM10 FITS catalog
+        select_random_kwargs : dict, optional
+            Keyword arguments of DB.select_random, if a random subsample is selected.
+            The selection is only cached if random_seed is given.
+        random_seed : int, optional
+            Seed of the random selection
+        paint_kwargs : dict, optional
+            Keyword arguments of DB.paint [default: {'synthetic': True}]
+
+        Returns
+        -------
+        DB
+            The OM10 catalog.
+        """
+        import json
+        import slrealizer.utils.utils as utils
+
+        if paint_kwargs is None:
+            paint_kwargs = {'synthetic': True}
+        make_args = (catalog_path, select_random_kwargs, random_seed, paint_kwargs)
+
+        if select_random_kwargs is not None and random_seed is None:
+            # An unseeded selection is different every time, so it is not cached
+            lens_catalog = _make_painted_om10(*make_args)
+            lens_catalog.flat_catalog = utils.get_flat_om10_catalog(lens_catalog.sample)
+            return lens_catalog
+
+        made = []
+        def flatten():
+            made.append(_make_painted_om10(*make_args))
+            return utils.get_flat_om10_catalog(made[0].sample)
+
+        stat = os.stat(catalog_path)
+        key = 'om10:%s' %json.dumps({'catalog': os.path.realpath(catalog_path), 'size': stat.st_size,
+                                     'mtime': stat.st_mtime, 'select_random': select_random_kwargs,
+                                     'random_seed': random_seed, 'paint': paint_kwargs}, sort_keys=True)
+        flat_catalog = self.cache.read_table(key, flatten)
+        if not made:
+            return _CachedOM10DB(flat_catalog, *make_args)
+        made[0].flat_catalog = flat_catalog
+        return made[0]
 
     def _read_minion1060(self, is_test):
         """Reads in the minion_1060 observational history.
@@ -78,11 +181,9 @@ class Dataloader:
         Pandas.Dataframe
             The minion_1060 catalog.
         """
-        import pandas as pd
-
         minion1060_url = "https://www.dropbox.com/s/2fgjk6ip69d64kb/twinkles_observation_history.csv?dl=1"
         # Read in the catalog and query out the Y-filter, which does not exist in SDSS
-        observation_catalog = pd.read_csv(minion1060_url).query("(filter != 'y')")
+        observation_catalog = self.cache.read_csv(minion1060_url).query("(filter != 'y')")
 
         if is_test:
             return observation_catalog.sample(20, random_state=123).reset_index(drop=True)
@@ -105,10 +206,8 @@ class Dataloader:
         Pandas.Dataframe
             The processed SDSS (non-lens) catalog.
         """
-        import pandas as pd
-
         sdss_url = "https://www.dropbox.com/s/74moqzb5zhzmmiq/sdss_processed.csv?dl=1"
-        sdss_catalog = pd.read_csv(sdss_url)
+        sdss_catalog = self.cache.read_csv(sdss_url)
 
         if is_test:
             return sdss_catalog.sample(2, random_state=123).reset_index(drop=True)
@@ -3,8 +3,12 @@ from __future__ import division
 from __future__ import print_function
 
 from slrealizer import SLRealizer
+from slrealizer.utils.instrumentation import instrumented
 import slrealizer.utils.utils as utils
-import slrealizer.utils.constants as constants
+import slrealizer.utils.table_io as table_io
+import slrealizer.utils.random_streams as random_streams
+import slrealizer.utils.moments as moments_utils
+import slrealizer.utils.hsm_batch as hsm_batch
 import numpy as np
 import pandas as pd
 import galsim
@@ -25,8 +29,16 @@ class OM10Realizer(SLRealizer):
         self.as_super = super(OM10Realizer, self)
         self.as_super.__init__(observation, add_moment_noise=add_moment_noise, add_flux_noise=add_flux_noise)
         self.catalog = catalog
-        self.num_systems = len(self.catalog.sample)
         self.DEBUG = debug
+        # Flattened, deduplicated catalog (see utils.get_flat_om10_catalog),
+        # provided by catalogs restored from the Dataloader cache or made on first use
+        self._flat_catalog = getattr(catalog, 'flat_catalog', None)
+
+    @property
+    def num_systems(self):
+        # Counted on the flattened catalog, so that a catalog restored from the
+        # Dataloader cache does not need to read, select and paint its sample
+        return len(self._get_flat_catalog())
 
     def get_lens_info(self, objID=None, rownum=None):
         if objID is not None and rownum is not None:
@@ -37,6 +49,18 @@ class OM10Realizer(SLRealizer):
         elif rownum is not None:
             return self.catalog.sample[rownum]
 
+    def _get_object_ids(self):
+        return self._get_flat_catalog()['LENSID'].values
+
+    def _get_flat_catalog(self):
+        """
+        Returns the flattened, deduplicated catalog (see utils.get_flat_om10_catalog),
+        converted from the catalog sample on first use
+        """
+        if self._flat_catalog is None:
+            self._flat_catalog = utils.get_flat_om10_catalog(self.catalog.sample)
+        return self._flat_catalog
+
     def _om10_to_galsim(self, lens_info, band):
         """
         Converts OM10's column values into GalSim terms
@@ -114,11 +138,9 @@ class OM10Realizer(SLRealizer):
         # Include moment-related keys to dictionary
         derived_params = self._include_moments(inplace=False, input_dict=derived_params)
 
-        # Add flux noise
+        # Flux noise is added in create_source_row
         apFluxErr = utils.mag_to_flux((five_sigma_depth - 22.5)/5.0)
         derived_params['apFluxErr'] = apFluxErr
-        if self.add_flux_noise:
-            derived_params['apFlux'] += utils.add_noise(mean=0.0, stdev=apFluxErr)
 
         # Get total magnitude
         derived_params['apMag'] = utils.flux_to_mag(derived_params['apFlux'], from_unit='nMgy')
@@ -133,10 +155,42 @@ class OM10Realizer(SLRealizer):
 
         return derived_params
 
-    def draw_system(self, obs_info, lens_info, save_path=None):
+    def draw_system(self, obs_info, lens_info, save_path=None, nx=None, ny=None):
+        if self.stamp_cache is not None and save_path is None:
+            return self._draw_cached_system(obs_info=obs_info, lens_info=lens_info, nx=nx, ny=ny)
         # Reformat lens_info so it can serve as input to Galsim's drawImage
         lens_info = self._om10_to_galsim(lens_info, obs_info['filter'])
-        return self.as_super.draw_system(lens_info=lens_info, obs_info=obs_info, save_path=save_path)
+        return self.as_super.draw_system(lens_info=lens_info, obs_info=obs_info, save_path=save_path, nx=nx, ny=ny)
+
+    def _draw_cached_system(self, obs_info, lens_info, nx=None, ny=None):
+        """
+        Returns the image of the lens system from self.stamp_cache,
+        rendering it at the quantized PSF FWHM and storing it on a cache miss
+
+        Keyword arguments:
+        obs_info -- a row of the observation history df
+        lens_info -- a row of the OM10 DB
+        nx, ny -- size of the stamp in pixels, as given by get_stamp_sizes
+                  at the quantized PSF FWHM [default: None]
+
+        Returns:
+        a GalSim Image object of the aggregate system
+        """
+        # Render at the quantized FWHM, so that every observation sharing the key gets the same stamp
+        obs_info = obs_info.copy()
+        obs_info['FWHMeff'] = self.stamp_cache.quantize_fwhm(obs_info['FWHMeff'])
+        galsim_info = self._om10_to_galsim(lens_info, obs_info['filter'])
+        if nx is None or ny is None:
+            nx, ny = [int(n[0]) for n in self.get_stamp_sizes(lens_infos=[galsim_info], psf_fwhms=[obs_info['FWHMeff']])]
+        key = self.stamp_cache.get_key(lens_info['LENSID'], obs_info['filter'], obs_info['FWHMeff'], nx, ny,
+                                       render_settings=(self.pixel_scale, repr(self.fft_params)))
+        stamp = self.stamp_cache.get(key)
+        if stamp is not None:
+            return galsim.Image(stamp, scale=self.pixel_scale)
+
+        galsim_img = self.as_super.draw_system(lens_info=galsim_info, obs_info=obs_info, nx=nx, ny=ny)
+        self.stamp_cache.put(key, galsim_img.array)
+        return galsim_img
 
     def estimate_parameters(self, obs_info, lens_info, method="raw_numerical"):
         """
@@ -155,7 +209,64 @@ class OM10Realizer(SLRealizer):
         numerically derived by HSM
         """
         galsim_img = self.draw_system(lens_info=lens_info, obs_info=obs_info, save_path=None)
-        return self.as_super.estimate_parameters(galsim_img=galsim_img, method=method)
+        guess = None
+        if method == "hsm":
+            ny, nx = galsim_img.array.shape
+            guess = [g if g is None else g[0] for g in self._get_hsm_guess(obs_info=obs_info, lens_infos=[lens_info], nx=nx, ny=ny)]
+        return self.as_super.estimate_parameters(galsim_img=galsim_img, method=method, guess=guess)
+
+    def _get_hsm_guess(self, obs_info, lens_infos, nx, ny):
+        """
+        Returns the HSM initial guesses of the images of the systems under one observation
+        (see hsm_batch.get_guess_from_moments): from their analytical moments if self.hsm_warm_start,
+        or else the fixed sigma of self.pixel_scale*10.0 pixels at the center of the stamps
+
+        Keyword arguments:
+        obs_info -- a row of the observation history df
+        lens_infos -- list of catalog rows of the systems
+        nx, ny -- size of their stamps in pixels
+
+        Returns:
+        a tuple of the arrays of guesses of the sigma and of the centroid x and y
+        (None for the fixed guess) in pixels
+        """
+        if not self.hsm_warm_start:
+            return np.full(len(lens_infos), self.pixel_scale*10.0), None, None
+        # Moments of the drawn scenes, whatever their number of quasar images
+        scene = self._get_scene_arrays([self._om10_to_galsim(lens_info, obs_info['filter']) for lens_info in lens_infos])
+        moments = moments_utils.get_analytical_moments(lens_flux=scene['lens_flux'],
+                                                       apFlux=scene['lens_flux'] + np.sum(scene['quasar_flux'], axis=1),
+                                                       q_flux=scene['quasar_flux'], XIMG=scene['quasar_x'], YIMG=scene['quasar_y'],
+                                                       e=scene['e'], beta=np.degrees(scene['beta']),
+                                                       psf_fwhm=np.full(len(lens_infos), obs_info['FWHMeff']))
+        return hsm_batch.get_guess_from_moments(x=moments['x'], y=moments['y'], trace=moments['trace'],
+                                                nx=nx, ny=ny, pixel_scale=self.pixel_scale)
+
+    def _create_hsm_source_rows(self, obs_info, lens_infos, images):
+        """
+        Measures the images of the systems under one observation with HSM,
+        starting from the guesses of _get_hsm_guess, and returns their source rows,
+        None where HSM failed, recording the reason of each failure
+
+        Keyword arguments:
+        obs_info -- a row of the observation history df
+        lens_infos -- list of catalog rows of the systems
+        images -- an array of shape [n_systems, ny, nx] of their images
+        """
+        guess_sig, guess_x, guess_y = self._get_hsm_guess(obs_info=obs_info, lens_infos=lens_infos,
+                                                          nx=images.shape[2], ny=images.shape[1])
+        columns = hsm_batch.measure_stamps(images, pixel_scale=self.pixel_scale, guess_sig=guess_sig,
+                                           guess_x=guess_x, guess_y=guess_y)
+        rows = []
+        for i, lens_info in enumerate(lens_infos):
+            if columns['hsm_failure'][i]:
+                self._record_hsm_failure(lens_info['LENSID'], obs_info['obsHistID'], columns['hsm_failure'][i])
+                rows.append(None)
+                continue
+            derived_params = dict((k, columns[k][i]) for k in hsm_batch.HSM_COLUMNS[:-1])
+            rows.append(self.as_super.create_source_row(derived_params=derived_params,
+                                                        objectId=lens_info['LENSID'], obs_info=obs_info))
+        return rows
 
     def draw_emulated_system(self, obs_info, lens_info):
         """
@@ -190,6 +301,9 @@ class OM10Realizer(SLRealizer):
         objectId = lens_info['LENSID']
         if method == "analytical":
             derived_params = self._om10_to_lsst(obs_info=obs_info, lens_info=lens_info)
+        elif method == "hsm":
+            galsim_img = self.draw_system(lens_info=lens_info, obs_info=obs_info, save_path=None)
+            return self._create_hsm_source_rows(obs_info=obs_info, lens_infos=[lens_info], images=galsim_img.array[np.newaxis])[0]
         else:
             derived_params = self.estimate_parameters(obs_info, lens_info, method=method)
             if derived_params is None:
@@ -197,17 +311,268 @@ class OM10Realizer(SLRealizer):
 
         return self.as_super.create_source_row(derived_params=derived_params, objectId=objectId, obs_info=obs_info)
 
-    def make_source_table_vectorized(self, output_source_path, include_time_variability):
+    def _realize_observation_batch(self, obs_info, lens_infos, method):
+        """
+        Realizes a batch of systems under one observation.
+        With the numpy render backend, the images of the numerical methods
+        are rendered and measured self.render_batch_size at a time.
+        HSM, and any numerical method with adaptive stamps, measure self.render_batch_size
+        images at a time with any backend. Within a batch, the images are sized
+        (see get_stamp_sizes) and measured together by stamp size.
+        """
+        rendered = (self.render_backend == 'numpy' and self.stamp_cache is None)
+        if method == "analytical" or (method != "hsm" and not rendered and not self.adaptive_stamps):
+            return self.as_super._realize_observation_batch(obs_info=obs_info, lens_infos=lens_infos, method=method)
+
+        histID, MJD, band, PSF_FWHM, sky_mag = obs_info
+        rows = []
+        for start in range(0, len(lens_infos), self.render_batch_size):
+            batch = lens_infos[start:start + self.render_batch_size]
+            galsim_infos = [self._om10_to_galsim(lens_info, band) for lens_info in batch]
+            # Stamps missing from the stamp cache are drawn at the quantized FWHM
+            stamp_fwhm = PSF_FWHM if self.stamp_cache is None else self.stamp_cache.quantize_fwhm(PSF_FWHM)
+            nx, ny = self.get_stamp_sizes(lens_infos=galsim_infos, psf_fwhms=np.full(len(batch), stamp_fwhm))
+            if not rendered:
+                images = [self.draw_system(obs_info=obs_info, lens_info=lens_info, nx=nx[i], ny=ny[i]).array
+                          for i, lens_info in enumerate(batch)]
+
+            batch_rows = [None]*len(batch)
+            for size_x, size_y in sorted(set(zip(nx, ny))):
+                members = np.flatnonzero((nx == size_x) & (ny == size_y))
+                if rendered:
+                    stack = self.render_systems(lens_infos=[galsim_infos[i] for i in members],
+                                                psf_fwhms=np.full(len(members), PSF_FWHM), nx=size_x, ny=size_y)
+                else:
+                    stack = np.array([images[i] for i in members])
+                if method == "hsm":
+                    member_rows = self._create_hsm_source_rows(obs_info=obs_info, lens_infos=[batch[i] for i in members], images=stack)
+                else:
+                    member_rows = []
+                    for i, derived_params in zip(members, self.as_super.estimate_parameters(galsim_img=stack, method=method)):
+                        member_rows.append(None if derived_params is None else
+                                           self.as_super.create_source_row(derived_params=derived_params,
+                                                                           objectId=batch[i]['LENSID'], obs_info=obs_info))
+                for i, row in zip(members, member_rows):
+                    batch_rows[i] = row
+            rows.extend(batch_rows)
+        return rows
+
+    @instrumented('make_source_table_vectorized')
+    def make_source_table_vectorized(self, output_source_path, include_time_variability, engine='numpy',
+                                     chunk_size=None, max_memory_mb=None, n_workers=None, mjd_windows=None, filters=None,
+                                     append=False):
         """
-        Generates the source table and saves it as a csv file.
+        Generates the source table and saves it to disk
+        (as csv unless self.table_format or the file extension says otherwise).
 
         Keyword arguments:
         output_source_path -- save path for the output source table
         include_time_variability -- whether to include intrinsic quasar variability
+        engine -- one of "numpy" (columnar engine working on contiguous arrays) or
+                  "pandas" (the original DataFrame implementation, kept as a reference) [default: "numpy"]
+        chunk_size -- if given, the maximum number of rows realized at once.
+                      Blocks of lenses (and, for very long observation histories,
+                      of observations) are realized in turn and appended to the output,
+                      which is identical to the monolithic run. [default: None]
+        max_memory_mb -- if given, a memory budget per block in MB,
+                         used in place of or together with chunk_size [default: None]
+        n_workers -- if given, blocks are realized as shards across n_workers processes
+                     (blocks of self.shard_rows rows if no chunk size is given).
+                     As the noise is keyed on the IDs of each row, the output does not depend
+                     on n_workers. [default: None]
+        mjd_windows, filters -- if given, only the visits in these MJD windows and filters
+                                are realized (see select_observations) [default: None]
+        append -- if True, only the visits (obsHistID) not yet in the source table at output_source_path
+                  are realized and appended to it, with quasar variability continuing
+                  from the last stored epoch of each light curve. The state of the light curves
+                  is saved alongside the source table by every run with time variability,
+                  from the light curves already drawn for the source table. [default: False]
 
         Returns (only if self.DEBUG == True):
         a Pandas dataframe of the source table
         """
+        if mjd_windows is not None or filters is not None:
+            return self._realize_selection('make_source_table_vectorized', mjd_windows, filters,
+                                           output_source_path, include_time_variability, engine=engine,
+                                           chunk_size=chunk_size, max_memory_mb=max_memory_mb, n_workers=n_workers,
+                                           append=append)
+        if append:
+            return self._append_new_observations('make_source_table_vectorized', output_source_path,
+                                                 include_time_variability, engine=engine,
+                                                 chunk_size=chunk_size, max_memory_mb=max_memory_mb, n_workers=n_workers)
+        if engine == 'pandas':
+            if chunk_size is not None or max_memory_mb is not None or n_workers is not None:
+                raise ValueError("Chunked and parallel realization are only supported by the numpy engine.")
+            src = self._make_source_table_pandas(output_source_path, include_time_variability)
+            if include_time_variability:
+                self._save_variability_state(output_source_path, [self._realized_variability_state])
+                self._realized_variability_state = None
+            return src
+        elif engine != 'numpy':
+            raise ValueError("Please enter a valid engine, either 'numpy' or 'pandas'")
+        import time
+
+        start = time.time()
+        with self.instrumentation.stage('get_catalog_arrays'):
+            self._catalog_columns = self._get_catalog_arrays()
+            self._observation_columns = self._get_observation_arrays()
+        num_lenses, num_obs = len(self._catalog_columns['objectId']), len(self._observation_columns['MJD'])
+        if n_workers is not None and chunk_size is None and max_memory_mb is None:
+            chunk_size = self.shard_rows
+        # Quasar variability needs the full light curve of each lens within a block
+        chunk_plan = self._get_chunk_plan(num_lenses, num_obs,
+                                          chunk_size=chunk_size, max_memory_mb=max_memory_mb,
+                                          split_observations=not include_time_variability)
+        block_args = [(lens_rows, obs_rows, include_time_variability) for lens_rows, obs_rows in chunk_plan]
+        if n_workers is None:
+            blocks = (self._realize_block_rows(*args) for args in block_args)
+        else:
+            blocks = self._map_shards('_realize_block_rows', block_args, n_workers)
+
+        keep_in_memory = (len(chunk_plan) == 1) or self.DEBUG
+        num_rows, src = self._write_source_blocks(blocks, output_source_path, keep_in_memory=keep_in_memory)
+        self.instrumentation.add_rows(num_rows)
+        if self.DEBUG:
+            print("Result of making source table: ")
+            print("Number of observations: ", num_obs)
+            print("Number of lenses: ", num_lenses)
+        self._catalog_columns, self._observation_columns = None, None
+        end = time.time()
+
+        print("Done making the source table with %d row(s) in %d block(s) in %0.2f seconds using the numpy engine." %(num_rows, len(chunk_plan), end-start))
+        self.sourceTable = src
+        if self.DEBUG:
+            return src
+
+    def _realize_block_rows(self, lens_rows, obs_rows, include_time_variability):
+        """
+        Realizes one block of the source table from the catalog and
+        observation arrays prepared by make_source_table_vectorized
+
+        Keyword arguments:
+        lens_rows -- slice of lenses to realize
+        obs_rows -- slice of observations to realize
+        include_time_variability -- whether to include intrinsic quasar variability
+
+        Returns:
+        a Pandas dataframe of the block, indexed by objectId,
+        or, if include_time_variability is True, a tuple of the dataframe and the state
+        of the block light curves at their last epoch (see _get_variability_state)
+        """
+        ###########################################
+        # Build the DataFrame only at output time #
+        ###########################################
+        columns, variability_state = self._realize_columns(utils.select_rows(self._catalog_columns, lens_rows),
+                                                           utils.select_rows(self._observation_columns, obs_rows),
+                                                           include_time_variability=include_time_variability)
+        if self.compact_dtypes:
+            utils.compact_columns(columns, self.get_compact_dtypes())
+        block = pd.DataFrame(columns, columns=self.source_columns).set_index('objectId')
+        if include_time_variability:
+            return block, variability_state
+        return block
+
+    def _get_catalog_arrays(self):
+        """
+        Returns the OM10 catalog as a dictionary of contiguous Numpy arrays,
+        with one entry per unique LENSID (in catalog order)
+
+        Returns:
+        a dictionary with keys 'objectId', 'NIMG', 'e', 'beta',
+        'lens_mag' and 'q_mag' (shape [n_lens, 5], one column per band in 'ugriz'),
+        and 'MAG', 'XIMG', 'YIMG' (shape [n_lens, 4], one column per quasar image)
+        """
+        flat_catalog = self._get_flat_catalog() # one row per unique LENSID, in catalog order
+        get_column = lambda c: np.asarray(flat_catalog[c].values, dtype=np.float64)
+
+        catalog = {'objectId': np.asarray(flat_catalog['LENSID'].values),
+                   'NIMG': np.asarray(flat_catalog['NIMG'].values),
+                   'e': get_column('ELLIP'),
+                   'beta': get_column('PHIE'), }
+        for prefix, suffix in [('lens_mag', '_SDSS_lens'), ('q_mag', '_SDSS_quasar')]:
+            catalog[prefix] = np.column_stack([get_column(b + suffix) for b in 'ugriz'])
+        for mc in ['MAG', 'XIMG', 'YIMG']:
+            catalog[mc] = np.column_stack([get_column(mc + '_' + str(q)) for q in range(4)])
+        return catalog
+
+    def _realize_columns(self, catalog, observation, include_time_variability=False):
+        """
+        Realizes every (lens, observation) pair in a single columnar pass,
+        in the same row order as the catalog x observation cross join
+
+        Keyword arguments:
+        catalog -- dictionary of lens arrays, as returned by _get_catalog_arrays
+        observation -- dictionary of observation arrays, as returned by _get_observation_arrays
+        include_time_variability -- whether to include intrinsic quasar variability [default: False]
+
+        Returns:
+        a tuple of a dictionary of Numpy arrays keyed by self.source_columns
+        and the state of the light curves at their last epoch
+        (see _get_variability_state, None without time variability)
+        """
+        num_lenses, num_obs = len(catalog['objectId']), len(observation['MJD'])
+        lens_idx = np.repeat(np.arange(num_lenses), num_obs)
+        obs_idx = np.tile(np.arange(num_obs), num_lenses)
+        band_idx = observation['band_index'][obs_idx]
+
+        # Magnitudes in the observed band, read out with one gather
+        lens_flux = utils.mag_to_flux(catalog['lens_mag'][lens_idx, band_idx], to_unit='nMgy')
+        q_mag = catalog['q_mag'][lens_idx, band_idx][:, np.newaxis]\
+                + utils.flux_to_mag(np.abs(catalog['MAG'][lens_idx]))
+        objectId, ccdVisitId = catalog['objectId'][lens_idx], observation['ccdVisitId'][obs_idx]
+        variability_state = None
+        if include_time_variability:
+            MJD = observation['MJD'][obs_idx]
+            walk = self._get_intrinsic_variability(objectId=objectId, ccdVisitId=ccdVisitId, band_index=band_idx,
+                                                   MJD=MJD, num_images=q_mag.shape[1])
+            q_mag = q_mag + walk
+            # Appended visits continue each light curve from its last epoch
+            variability_state = self._get_variability_state(objectId, band_idx, MJD, walk)
+            del walk
+        q_flux = utils.mag_to_flux(q_mag, to_unit='nMgy')
+        # Set fluxes of nonexistent quasar images to zero
+        q_flux[np.arange(4) >= catalog['NIMG'][lens_idx][:, np.newaxis]] = 0.0
+        apFlux = np.sum(q_flux, axis=1) + lens_flux
+        del q_mag
+
+        ###########
+        # MOMENTS #
+        ###########
+        noise = {}
+        if self.add_moment_noise:
+            noise['x_noise'], noise['y_noise'], noise['trace_noise'] = self._get_moment_noise(objectId, ccdVisitId)
+        # Lens positions and shapes only depend on the lens, so they are passed once per lens
+        moments = moments_utils.get_analytical_moments(lens_flux=lens_flux, apFlux=apFlux, q_flux=q_flux,
+                                                       XIMG=catalog['XIMG'], YIMG=catalog['YIMG'],
+                                                       e=catalog['e'], beta=catalog['beta'], lens_index=lens_idx,
+                                                       psf_fwhm=observation['psf_fwhm'][obs_idx], **noise)
+        del q_flux, lens_flux, noise
+
+        # Add flux noise
+        apFluxErr = (utils.mag_to_flux(observation['fiveSigmaDepth'] - 22.5)/5.0)[obs_idx] # because Fb = 5 \sigma_b
+        if self.add_flux_noise:
+            apFlux += random_streams.get_noise(self.seed, 'flux', objectId, ccdVisitId, mean=0.0, stdev=apFluxErr)
+        # Get total magnitude and propagate to get error on magnitude
+        apMag = utils.flux_to_mag(apFlux, from_unit='nMgy')
+        apMagErr = (2.5/np.log(10.0)) * apFluxErr / apFlux
+
+        columns = {'MJD': observation['MJD'][obs_idx],
+                   'ccdVisitId': ccdVisitId,
+                   'objectId': objectId,
+                   'filter': observation['filter'][obs_idx],
+                   'psf_fwhm': observation['psf_fwhm'][obs_idx],
+                   'x': moments['x'], 'y': moments['y'],
+                   'apFlux': apFlux, 'apFluxErr': apFluxErr,
+                   'apMag': apMag, 'apMagErr': apMagErr,
+                   'trace': moments['trace'], 'e1': moments['e1'], 'e2': moments['e2'],
+                   'e_final': moments['e_final'], 'phi_final': moments['phi_final'], }
+        return columns, variability_state
+
+    def _make_source_table_pandas(self, output_source_path, include_time_variability):
+        """
+        Generates the source table with the original DataFrame implementation
+        and saves it to disk. See make_source_table_vectorized.
+        """
         import time
 
         start = time.time()
@@ -226,12 +591,14 @@ class OM10Realizer(SLRealizer):
         src['apFlux'] = src[q_flux_cols + ['lens_flux']].sum(axis=1)
 
         self.source_table = src
-        self._include_moments()
+        with self.instrumentation.stage('include_moments', num_rows=len(src)):
+            self._include_moments()
 
         # Add flux noise
         src['apFluxErr'] = utils.mag_to_flux(src['fiveSigmaDepth']-22.5)/5.0 # because Fb = 5 \sigma_b
         if self.add_flux_noise:
-            src['apFlux'] += utils.add_noise(mean=0.0, stdev=src['apFluxErr'], shape=src['apFluxErr'].shape)
+            src['apFlux'] += random_streams.get_noise(self.seed, 'flux', src['objectId'].values, src['ccdVisitId'].values,
+                                                      mean=0.0, stdev=src['apFluxErr'].values)
         # Get total magnitude
         src['apMag'] = utils.flux_to_mag(src['apFlux'], from_unit='nMgy')
         # Propagate to get error on magnitude
@@ -239,15 +606,17 @@ class OM10Realizer(SLRealizer):
         gc.collect()
 
         # Remove remaining unused columns
-        src.drop(['lensFluxRatio', 'lens_mag', 'q_mag', 'sigmasq_lens', 'sigmasq_psf', 'NIMG',], axis=1, inplace=True)
+        src.drop(['lens_mag', 'q_mag', 'NIMG',], axis=1, inplace=True)
         for q in range(4):
-            src.drop(['MAG_%d'%q] + ['XIMG_%d'%q] + ['YIMG_%d'%q] + ['qFluxRatio_%d'%q], axis=1, inplace=True)
+            src.drop(['MAG_%d'%q] + ['XIMG_%d'%q] + ['YIMG_%d'%q], axis=1, inplace=True)
         gc.collect()
 
         ############################################
         # Final column reordering & saving to file #
         ############################################
         src = src[self.source_columns]
+        if self.compact_dtypes:
+            utils.compact_columns(src, self.get_compact_dtypes())
         if self.DEBUG:
             out_num_lenses = src['objectId'].nunique()
             out_num_times = src['MJD'].nunique()
@@ -256,7 +625,9 @@ class OM10Realizer(SLRealizer):
             print("Number of lenses: ", out_num_lenses)
 
         src.set_index('objectId', inplace=True)
-        src.to_csv(output_source_path)
+        with self.instrumentation.stage('write_source_table', num_rows=len(src)):
+            table_io.write_table(src, output_source_path, table_format=self.table_format, append=self._append_source_rows)
+        self.instrumentation.add_rows(len(src))
         gc.collect()
         end = time.time()
 
@@ -265,27 +636,23 @@ class OM10Realizer(SLRealizer):
         if self.DEBUG:
             return src
 
+    @instrumented('preformat_source_table')
     def _preformat_source_table(self):
         """
         Initializes self.source_table with the column conventions
         that can be used by SLRealizer's helper functions
         """
-        from astropy.table import Table, Column
-
-        catalogAstropy = self.catalog.sample # the Astropy table underlying OM10 object
-
         #################################
         # OM10 --> Pandas DF conversion #
         #################################
         lensMagCols = [b + '_SDSS_lens' for b in 'ugriz']
         qMagCols = [b + '_SDSS_quasar' for b in 'ugriz']
-        saveCols = lensMagCols + qMagCols + ['REFF_T', 'NIMG', 'LENSID', 'ELLIP', 'PHIE']
-        saveValues = [catalogAstropy[c] for c in saveCols]
-        saveColDict = dict(zip(saveCols, saveValues))
-        collapsedColDict = utils.get_1D_columns(multidimColNames=['MAG', 'XIMG', 'YIMG'], table=catalogAstropy)
-        saveColDict.update(collapsedColDict)
-        catalog = Table(saveColDict.values(), names=saveColDict.keys()).to_pandas()
-        catalog.drop_duplicates('LENSID', inplace=True)
+        catalog = self._get_flat_catalog().copy()
+        # Keep the multi-band magnitudes out of the cross join, as (lens x band) arrays
+        lens_mag_table = catalog[lensMagCols].values
+        q_mag_table = catalog[qMagCols].values
+        catalog.drop(lensMagCols + qMagCols, axis=1, inplace=True)
+        catalog['catalog_row'] = np.arange(len(catalog))
 
         ####################################
         # Merging catalog with observation #
@@ -297,9 +664,9 @@ class OM10Realizer(SLRealizer):
         src.drop('key', 1, inplace=True)
         gc.collect()
 
-        ##############################################
-        # Rename columns and set null values to zero #
-        ##############################################
+        ##################
+        # Rename columns #
+        ##################
         #src.drop(['fiveSigmaDepth', ], axis=1, inplace=True)
         src.rename(columns={'obsHistID': 'ccdVisitId',
             'LENSID': 'objectId',
@@ -310,18 +677,13 @@ class OM10Realizer(SLRealizer):
             }, inplace=True)
         gc.collect()
 
-        # Set unused band magnitudes to zero, to
-        # work only with the magnitude in the observed filter
-        for b in 'ugriz': # b = observed filter
-            setZeroLens = lensMagCols[:]
-            setZeroLens.remove(b + '_SDSS_lens')
-            setZeroQ = qMagCols[:]
-            setZeroQ.remove(b + '_SDSS_quasar')
-            src.loc[src['filter'] == b, setZeroLens] = 0.0
-            src.loc[src['filter'] == b, setZeroQ] = 0.0
-        src['lens_mag'] = src[lensMagCols].sum(axis=1)
-        src['q_mag'] = src[qMagCols].sum(axis=1)
-        src.drop(lensMagCols + qMagCols, axis=1, inplace=True)
+        # Read out the magnitudes in the observed filter with one gather per property
+        band_index = utils.get_band_index(src['filter'].values)
+        catalog_row = src['catalog_row'].values
+        src['lens_mag'] = lens_mag_table[catalog_row, band_index]
+        src['q_mag'] = q_mag_table[catalog_row, band_index]
+        src.drop('catalog_row', axis=1, inplace=True)
+        del band_index, catalog_row
         gc.collect()
 
         # Convert magnitudes into fluxes
@@ -334,6 +696,12 @@ class OM10Realizer(SLRealizer):
         src.loc[src['NIMG'] == 2, ['q_flux_2', 'q_flux_3']] = 0.0
         src.loc[src['NIMG'] == 3, ['q_flux_3']] = 0.0
 
+        if self.compact_dtypes:
+            # Intermediate columns are compacted too; MJD and the IDs as in the source table
+            dtypes = self.get_compact_dtypes()
+            utils.compact_columns(src, dict((c, dtypes[c]) for c in ['MJD', 'filter', 'objectId', 'ccdVisitId']))
+
+        self.instrumentation.add_rows(len(src))
         self.source_table = src
 
 
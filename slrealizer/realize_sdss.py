@@ -1,8 +1,9 @@
 from __future__ import absolute_import, division, print_function
 
 from slrealizer import SLRealizer
-import slrealizer.utils.constants as constants
+from slrealizer.utils.instrumentation import instrumented
 import slrealizer.utils.utils as utils
+import slrealizer.utils.random_streams as random_streams
 import pandas as pd
 import numpy as np
 
@@ -14,6 +15,10 @@ class SDSSRealizer(SLRealizer):
     into LSST DRP Source and Object catalogs.
     """
 
+    # Multi-band properties of the catalog, one column per band in 'ugriz' (e.g. modelFlux_r),
+    # of which each source row takes the band of its observation
+    band_properties = ['modelFlux', 'offsetRa', 'offsetDec', 'mRrCc', 'mE1', 'mE2', ]
+
     def __init__(self, observation, catalog, debug=False, add_moment_noise=True, add_flux_noise=True):
         #super(SDSSRealizer, self).__init__(observation) # Didn't work for some reason
         self.as_super = super(SDSSRealizer, self)
@@ -32,6 +37,9 @@ class SDSSRealizer(SLRealizer):
         elif rownum is not None:
             return self.catalog.loc[rownum]
 
+    def _get_object_ids(self):
+        return self.catalog['objectId'].values
+
     def _sdss_to_galsim(self, lens_info, band):
         raise NotImplementedError
 
@@ -67,17 +75,197 @@ class SDSSRealizer(SLRealizer):
 
         return row
 
-    def make_source_table_vectorized(self, save_file):
-        import gc # need this to optimize memory usage
+    @instrumented('make_source_table_vectorized')
+    def make_source_table_vectorized(self, save_file, chunk_size=None, max_memory_mb=None, n_workers=None,
+                                     mjd_windows=None, filters=None, append=False, engine='numpy'):
+        """
+        Generates the source table and saves it to disk
+        (as csv unless self.table_format or the file extension says otherwise).
+
+        Keyword arguments:
+        save_file -- save path for the output source table
+        chunk_size -- if given, the maximum number of rows realized at once.
+                      Blocks of objects (and, for very long observation histories,
+                      of observations) are realized in turn and appended to the output,
+                      which is identical to the monolithic run. [default: None]
+        max_memory_mb -- if given, a memory budget per block in MB,
+                         used in place of or together with chunk_size [default: None]
+        n_workers -- if given, blocks are realized as shards across n_workers processes
+                     (blocks of self.shard_rows rows if no chunk size is given).
+                     As the noise is keyed on the IDs of each row, the output does not depend
+                     on n_workers. [default: None]
+        mjd_windows, filters -- if given, only the visits in these MJD windows and filters
+                                are realized (see select_observations) [default: None]
+        append -- if True, only the visits (obsHistID) not yet in the source table at save_file
+                  are realized and appended to it [default: False]
+        engine -- one of "numpy" (columnar engine reading only the band properties
+                  from contiguous arrays) or "pandas" (the original cross join of
+                  the catalog and observation DataFrames, kept as a reference).
+                  Both give the same source table. [default: "numpy"]
+
+        Returns (only if self.DEBUG == True):
+        a Pandas dataframe of the source table
+        """
+        if mjd_windows is not None or filters is not None:
+            return self._realize_selection('make_source_table_vectorized', mjd_windows, filters, save_file,
+                                           chunk_size=chunk_size, max_memory_mb=max_memory_mb, n_workers=n_workers,
+                                           append=append, engine=engine)
+        if append:
+            return self._append_new_observations('make_source_table_vectorized', save_file,
+                                                 chunk_size=chunk_size, max_memory_mb=max_memory_mb, n_workers=n_workers,
+                                                 engine=engine)
+        if engine not in ['numpy', 'pandas']:
+            raise ValueError("Please enter a valid engine, either 'numpy' or 'pandas'")
         import time
 
         start = time.time()
+        if engine == 'numpy':
+            with self.instrumentation.stage('get_catalog_arrays'):
+                self._catalog_columns = self._get_catalog_arrays()
+                self._observation_columns = self._get_observation_arrays()
+        if n_workers is not None and chunk_size is None and max_memory_mb is None:
+            chunk_size = self.shard_rows
+        chunk_plan = self._get_chunk_plan(self.num_systems, self.num_obs,
+                                          chunk_size=chunk_size, max_memory_mb=max_memory_mb)
+        block_args = [(catalog_rows, obs_rows, engine) for catalog_rows, obs_rows in chunk_plan]
+        if n_workers is None:
+            blocks = (self._realize_block_rows(*args) for args in block_args)
+        else:
+            blocks = self._map_shards('_realize_block_rows', block_args, n_workers)
+        keep_in_memory = (len(chunk_plan) == 1) or self.DEBUG
+        num_rows, src = self._write_source_blocks(blocks, save_file, keep_in_memory=keep_in_memory)
+        self.instrumentation.add_rows(num_rows)
+        self._catalog_columns, self._observation_columns = None, None
+        print("Number of observations: ", self.num_obs)
+        print("Number of nonlenses: ", self.num_systems)
+        end = time.time()
+
+        print("Done making the source table with %d row(s) in %d block(s) in %0.2f seconds using the %s engine." %(num_rows, len(chunk_plan), end-start, engine))
+
+        self.sourceTable = src
+        if self.DEBUG:
+            return src
+
+    def _realize_block_rows(self, catalog_rows, obs_rows, engine='numpy'):
+        """
+        Realizes the block of the source table given by
+        the catalog and observation row slices, with either engine
+        (see make_source_table_vectorized)
+
+        Returns:
+        a Pandas dataframe of the block, indexed by objectId
+        """
+        if engine == 'pandas':
+            return self._realize_block(self.catalog.iloc[catalog_rows], self.observation.iloc[obs_rows])
+        ###########################################
+        # Build the DataFrame only at output time #
+        ###########################################
+        columns = self._realize_columns(utils.select_rows(self._catalog_columns, catalog_rows),
+                                        utils.select_rows(self._observation_columns, obs_rows))
+        if self.compact_dtypes:
+            utils.compact_columns(columns, self.get_compact_dtypes())
+        return pd.DataFrame(columns, columns=self.source_columns).set_index('objectId')
+
+    def _get_catalog_arrays(self):
+        """
+        Returns the columns of the SDSS catalog read by the numpy engine
+        as a dictionary of contiguous Numpy arrays
+
+        Returns:
+        a dictionary with keys 'objectId' and each of self.band_properties
+        (shape [n_objects, 5], one column per band in 'ugriz')
+        """
+        catalog = {'objectId': self.catalog['objectId'].values}
+        for p in self.band_properties:
+            catalog[p] = np.ascontiguousarray(self.catalog[[p + '_' + b for b in 'ugriz']].values)
+        return catalog
+
+    def _realize_columns(self, catalog, observation):
+        """
+        Realizes every (object, observation) pair in a single columnar pass,
+        in the same row order and with the same values as _realize_block
+
+        Keyword arguments:
+        catalog -- dictionary of object arrays, as returned by _get_catalog_arrays
+        observation -- dictionary of observation arrays, as returned by _get_observation_arrays
+
+        Returns:
+        a dictionary of Numpy arrays keyed by self.source_columns
+        """
+        num_objects, num_obs = len(catalog['objectId']), len(observation['MJD'])
+        object_idx = np.repeat(np.arange(num_objects), num_obs)
+        obs_idx = np.tile(np.arange(num_obs), num_objects)
+        band_idx = observation['band_index'][obs_idx]
+        objectId, ccdVisitId = catalog['objectId'][object_idx], observation['ccdVisitId'][obs_idx]
+
+        # Band properties in the observed band, read out with one gather each.
+        # Quantities of each observation are computed once per observation.
+        # Noise is added out of place, so that the columns are promoted
+        # as in _realize_block whatever the dtypes of the catalog.
+        apFlux = catalog['modelFlux'][object_idx, band_idx]
+        apFluxErr = (utils.mag_to_flux(observation['fiveSigmaDepth'] - 22.5)/5.0)[obs_idx]
+        if self.add_flux_noise:
+            apFlux = apFlux + random_streams.get_noise(self.seed, 'flux', objectId, ccdVisitId,
+                                                       mean=0.0, stdev=apFluxErr) # flux rms not skyEr
+
+        ###########
+        # MOMENTS #
+        ###########
+        y = catalog['offsetDec'][object_idx, band_idx]
+        x = np.cos(np.deg2rad(y*3600.0))
+        x *= catalog['offsetRa'][object_idx, band_idx]
+        trace = catalog['mRrCc'][object_idx, band_idx]
+        trace *= self.sdss_pixel_scale**2.0
+        trace = trace + (2.0*np.square(utils.fwhm_to_sigma(observation['psf_fwhm'])))[obs_idx]
+        if self.add_moment_noise:
+            x_noise, y_noise, trace_noise = self._get_moment_noise(objectId, ccdVisitId)
+            x = x + x*x_noise
+            y = y + y*y_noise
+            trace += trace*trace_noise
+            del x_noise, y_noise, trace_noise
+        e1 = catalog['mE1'][object_idx, band_idx]
+        e2 = catalog['mE2'][object_idx, band_idx]
+        e_final, phi_final = utils.e1e2_to_ephi(e1, e2)
+
+        # Get total magnitude and propagate to get error on magnitude
+        apMag = utils.flux_to_mag(apFlux, from_unit='nMgy')
+        apMagErr = (2.5/np.log(10.0)) * apFluxErr / apFlux
+
+        return {'MJD': observation['MJD'][obs_idx],
+                'ccdVisitId': ccdVisitId,
+                'objectId': objectId,
+                'filter': observation['filter'][obs_idx],
+                'psf_fwhm': observation['psf_fwhm'][obs_idx],
+                'x': x, 'y': y,
+                'apFlux': apFlux, 'apFluxErr': apFluxErr,
+                'apMag': apMag, 'apMagErr': apMagErr,
+                'trace': trace, 'e1': e1, 'e2': e2,
+                'e_final': e_final, 'phi_final': phi_final, }
+
+    def _realize_block(self, catalog, observation):
+        """
+        Realizes every (object, observation) pair of the given
+        catalog and observation history subsets
+
+        Keyword arguments:
+        catalog -- a subset of rows of the SDSS catalog df
+        observation -- a subset of rows of the observation history df
+
+        Returns:
+        a Pandas dataframe of the corresponding source table rows, indexed by objectId
+        """
+        import gc # need this to optimize memory usage
 
         ####################################
         # Merging catalog with observation #
         ####################################
-        catalog = self.catalog.copy()
-        observation = self.observation.copy()
+        # Keep the multi-band properties out of the cross join, as (object x band) arrays
+        propsToCollapse = self.band_properties
+        bandCols = dict((p, [p + '_' + b for b in 'ugriz']) for p in propsToCollapse)
+        bandTables = dict((p, catalog[bandCols[p]].values) for p in propsToCollapse)
+        catalog = catalog.drop(sum(bandCols.values(), []), axis=1)
+        catalog['catalog_row'] = np.arange(len(catalog))
+        observation = observation.copy()
         catalog['key'] = 0
         observation['key'] = 0
         src = catalog.merge(observation, how='left', on='key')
@@ -88,52 +276,36 @@ class SDSSRealizer(SLRealizer):
         # Collapsing multi-band properties #
         # into one of observed band        #
         ####################################
-        setZeroDict = {}
-        propsToCollapse = ['modelFlux', 'offsetRa', 'offsetDec', 'mRrCc', 'mE1', 'mE2', ]
-        # Initialize dictionary of columns we want to collapse
+        # One indexed read per property, instead of masked writes per band
+        band_index = utils.get_band_index(src['filter'].values)
+        catalog_row = src['catalog_row'].values
         for p in propsToCollapse:
-            setZeroDict[p] = [p + '_' + b for b in 'ugriz']
-        # Set unused column values to zero
-        for b in 'ugriz': # b = observed filter
-            for p in propsToCollapse: # multi-band columns to collapse
-                setZeroCols = setZeroDict[p][:]
-                setZeroCols.remove(p + '_' + b)
-                src.loc[src['filter'] == b, setZeroCols] = 0.0
-        # Collapse
-        for p in propsToCollapse: # multi-band columns to collapse
-            src[p] = src[[p + '_' + b for b in 'ugriz']].sum(axis=1)
-            src.drop([p + '_' + b for b in 'ugriz'], axis=1, inplace=True)
+            src[p] = bandTables[p][catalog_row, band_index]
+        src.drop('catalog_row', axis=1, inplace=True)
+        del band_index, catalog_row
         gc.collect()
 
         ################
         # Adding noise #
         ################
         src['apFluxErr'] = utils.mag_to_flux(src['fiveSigmaDepth'] - 22.5)/5.0
+        objectId, ccdVisitId = src['objectId'].values, src['obsHistID'].values
         if self.add_flux_noise:
-            src['modelFlux'] += utils.add_noise(mean=0.0,
-                                          stdev=src['apFluxErr'],
-                                          shape=src['apFluxErr'].shape) # flux rms not skyEr
+            src['modelFlux'] += random_streams.get_noise(self.seed, 'flux', objectId, ccdVisitId,
+                                                         mean=0.0, stdev=src['apFluxErr'].values) # flux rms not skyEr
         src['x'] = np.cos(np.deg2rad(src['offsetDec']*3600.0))*src['offsetRa']
         src['y'] = src['offsetDec']
         src['trace'] = src['mRrCc']*(self.sdss_pixel_scale**2.0) + 2.0*np.power(utils.fwhm_to_sigma(src['FWHMeff']), 2.0)
         if self.add_moment_noise:
-            src['x'] += utils.add_noise(mean=constants.get_first_moment_err(),
-                                  stdev=constants.get_first_moment_err_std(),
-                                  shape=src['x'].shape,
-                                  measurement=src['x'])
-            src['y'] += utils.add_noise(mean=constants.get_first_moment_err(),
-                                  stdev=constants.get_first_moment_err_std(),
-                                  shape=src['y'].shape,
-                                  measurement=src['y'])
-            src['trace'] += utils.add_noise(mean=constants.get_second_moment_err(),
-                                     stdev=constants.get_second_moment_err_std(),
-                                     shape=src['trace'].shape,
-                                     measurement=src['trace'])
+            x_noise, y_noise, trace_noise = self._get_moment_noise(objectId, ccdVisitId)
+            src['x'] += src['x']*x_noise
+            src['y'] += src['y']*y_noise
+            src['trace'] += src['trace']*trace_noise
         src['apMag'] = utils.flux_to_mag(src['modelFlux'], from_unit='nMgy')
         src['apMagErr'] = (2.5/np.log(10.0)) * src['apFluxErr'] / src['modelFlux']
 
         #####################################################
-        # Final column renaming/reordering & saving to file #
+        # Final column renaming/reordering                  #
         #####################################################
         src.rename(columns={'obsHistID': 'ccdVisitId',
                             'expMJD': 'MJD',
@@ -144,19 +316,12 @@ class SDSSRealizer(SLRealizer):
         src['e_final'], src['phi_final'] = utils.e1e2_to_ephi(src['e1'], src['e2'])
         src.drop(['mRrCc', 'offsetRa', 'offsetDec', 'fiveSigmaDepth'], axis=1, inplace=True)
         gc.collect()
-        print("Number of observations: ", src['MJD'].nunique())
-        print("Number of nonlenses: ", src['objectId'].nunique())
 
         src = src[self.source_columns]
+        if self.compact_dtypes:
+            utils.compact_columns(src, self.get_compact_dtypes())
         src.set_index('objectId', inplace=True)
-        src.to_csv(save_file)
-        end = time.time()
-
-        print("Done making the source table with %d row(s) in %0.2f seconds using vectorization." %(len(src), end-start))
-
-        self.sourceTable = src
-        if self.DEBUG:
-            return src
+        return src
 
 
     #def make_source_table INHERITED
@@ -8,10 +8,36 @@ import matplotlib.pyplot as plt
 import numpy as np
 import slrealizer.utils.utils as utils
 import slrealizer.utils.constants as constants
+import slrealizer.utils.table_io as table_io
+import slrealizer.utils.variability as variability
+import slrealizer.utils.random_streams as random_streams
+import slrealizer.utils.moments as moments_utils
+import slrealizer.utils.gaussian_render as gaussian_render
+import slrealizer.utils.hsm_batch as hsm_batch
+from slrealizer.utils.stamp_cache import StampCache
+import slrealizer.utils.running_stats as running_stats
+from slrealizer.utils.running_stats import RunningStats
+from slrealizer.utils.instrumentation import Instrumentation, instrumented
+from slrealizer.utils.observation_index import ObservationIndex
 import pandas as pd
 import random
 import galsim
 
+# Realizer held by each worker process of a sharded realization
+_worker_realizer = None
+
+def _init_worker(realizer):
+    global _worker_realizer
+    _worker_realizer = realizer
+
+def _realize_shard(task):
+    """
+    Realizes one shard in a worker process.
+    Must live at module level so that multiprocessing can pickle it.
+    """
+    method_name, method_args = task
+    return getattr(_worker_realizer, method_name)(*method_args)
+
 class SLRealizer(object):
 
     """
@@ -27,14 +53,64 @@ class SLRealizer(object):
         # Observation history
         self.observation = observation
         self.num_obs = len(self.observation)
+        # Index of the observation history, built on first use (see get_observation_index)
+        self._observation_index = None
 
         # GalSim drawImage params
         self.fft_params = galsim.GSParams(maximum_fft_size=10240)
         self.pixel_scale = 0.1
         self.nx, self.ny = 49, 49
+        # Whether the stamp of each system is sized to contain stamp_flux_fraction of its flux,
+        # as one of gaussian_render.STAMP_SIZES pixels on a side, rather than self.nx by self.ny
+        self.adaptive_stamps = False
+        self.stamp_flux_fraction = 0.999
+        # Backend rendering the images of the numerical methods, one of
+        # 'galsim' (FFT convolution with GalSim) or 'numpy' (closed-form
+        # convolved Gaussians, see utils.gaussian_render)
+        self.render_backend = 'galsim'
+        # Maximum number of stamps rendered (and measured) at once by the numerical methods
+        self.render_batch_size = 256
+        # Whether HSM starts from the analytical moments of each row (see utils.hsm_batch)
+        # rather than from a fixed guess of the size at the center of the stamp
+        self.hsm_warm_start = True
+        # HSM failures of the last row-by-row realization, as a df of the objectId,
+        # ccdVisitId and reason (hsm_failure) of each failed row
+        self.hsm_failures = None
+        self._hsm_failures = []
+        # Cache of rendered stamps, see enable_stamp_cache
+        self.stamp_cache = None
+        # PSFs of the GalSim backend, keyed by the PSF FWHM and the stamp geometry (see _get_psf),
+        # reused across the systems drawn under the same observing conditions
+        self._psf_cache = {}
+        self.max_psf_cache_size = 4096
+        # Stage timings and memory of this realizer's runs (see enable_instrumentation),
+        # off unless switched on by the SLREALIZER_INSTRUMENT* environment variables
+        self.instrumentation = Instrumentation.from_environment()
 
         # Source table df
         self.source_table = None
+        self.sourceTable = None
+        # Whether realized rows are appended to the output source table
+        # rather than overwrite it, set on the copies realizing new visits (see _append_new_observations)
+        self._append_source_rows = False
+        # Damped random walk state at the last stored epoch of each light curve,
+        # from which quasar variability continues when visits are appended
+        self._variability_state = None
+        # State at the last epoch of each light curve realized by include_quasar_variability
+        self._realized_variability_state = None
+        # Rough peak memory footprint of one realized source table row in bytes,
+        # used to turn a memory budget into a block size for chunked realization
+        self.bytes_per_source_row = 1024
+        # Number of source table rows per shard in parallel mode, if no chunk size is given.
+        # Fixed independently of the number of workers, so that results do not depend on it.
+        self.shard_rows = 100000
+        # Format of the tables written and read by this realizer, one of
+        # 'csv', 'parquet', 'feather' or 'hdf5' (see utils.table_io).
+        # If None, the format is inferred from each file extension, defaulting to csv.
+        self.table_format = None
+        # Whether the source and object tables are stored in the compact schema
+        # of float32 measurements, a categorical filter and int32 IDs (see get_compact_dtypes)
+        self.compact_dtypes = False
         # Source table column list
         self.source_columns = ['MJD', 'ccdVisitId', 'objectId', 'filter', 'psf_fwhm', 'x', 'y', 'apFlux', 'apFluxErr', 'apMag', 'apMagErr', 'trace', 'e1', 'e2', 'e_final', 'phi_final', ]
 
@@ -45,23 +121,317 @@ class SLRealizer(object):
             self.remove_random = True
         else:
             self.remove_random = False
+        # Seed of the noise, which is drawn per row from the counter-based generator
+        # of utils.random_streams, keyed on (seed, objectId, ccdVisitId, noise kind)
         self.seed = 123
-        np.random.seed(self.seed)
+
+    def __getstate__(self):
+        # super objects cannot be pickled, so as_super is rebuilt on unpickling
+        state = self.__dict__.copy()
+        state.pop('as_super', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.as_super = super(type(self), self)
+
+    def _map_shards(self, method_name, shard_args, n_workers):
+        """
+        Realizes the shards with getattr(self, method_name),
+        either in this process or across a pool of worker processes
+
+        Keyword arguments:
+        method_name -- name of the method realizing one shard
+        shard_args -- list of argument tuples, one per shard
+        n_workers -- number of worker processes. If 1, shards are realized in this process.
+
+        Returns:
+        an iterator over the shard results, in shard order regardless of n_workers
+        """
+        # The noise of each row is keyed on its IDs (see utils.random_streams),
+        # so it does not depend on the shard or process realizing the row
+        if n_workers <= 1:
+            for args in shard_args:
+                yield getattr(self, method_name)(*args)
+            return
+
+        import copy
+        import multiprocessing
+        # Workers get their own copy of the realizer once, without any source table
+        worker_realizer = copy.copy(self)
+        worker_realizer.source_table, worker_realizer.sourceTable = None, None
+        # Stages are recorded by this process, which waits on the workers
+        worker_realizer.instrumentation = Instrumentation()
+        pool = multiprocessing.Pool(processes=n_workers, initializer=_init_worker, initargs=(worker_realizer, ))
+        try:
+            for result in pool.imap(_realize_shard, [(method_name, args) for args in shard_args]):
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def enable_stamp_cache(self, fwhm_quantum=0.01, max_memory_mb=256, cache_dir=None):
+        """
+        Makes the GalSim paths reuse rendered stamps of repeated
+        (lens, band, PSF FWHM) combinations, with the PSF FWHM quantized
+        to fwhm_quantum. See utils.stamp_cache.StampCache for the arguments.
+
+        Returns:
+        the StampCache object, also stored as self.stamp_cache
+        """
+        self.stamp_cache = StampCache(fwhm_quantum=fwhm_quantum, max_memory_mb=max_memory_mb, cache_dir=cache_dir)
+        return self.stamp_cache
+
+    def enable_instrumentation(self, trace_memory=False, profile_dir=None, report_path=None):
+        """
+        Records the wall-clock and CPU time, rows per second and peak memory
+        of each stage of this realizer's runs. See utils.instrumentation.Instrumentation
+        for the arguments. The records are read with self.instrumentation.get_report().
+
+        Returns:
+        the Instrumentation object, also stored as self.instrumentation
+        """
+        self.instrumentation = Instrumentation(enabled=True, trace_memory=trace_memory,
+                                               profile_dir=profile_dir, report_path=report_path)
+        return self.instrumentation
 
     def get_obs_info(self, obsID=None, rownum=None):
         if obsID is not None and rownum is not None:
             raise ValueError("Need to define either obsID or rownum, not both.")
         if obsID is not None:
-            return self.observation.loc[self.observation['obsHistID']==obsID]
+            return self.observation.iloc[self.get_observation_index().get_rows(obsID)]
         elif rownum is not None:
             return self.observation.loc[rownum]
 
+    def get_observation_index(self):
+        """
+        Returns the ObservationIndex of self.observation, built on first use
+        and rebuilt if self.observation is replaced
+        """
+        if self._observation_index is None or self._observation_index.observation is not self.observation:
+            self._observation_index = ObservationIndex(self.observation)
+        return self._observation_index
+
+    def select_observations(self, mjd_windows=None, filters=None):
+        """
+        Returns a copy of this realizer restricted to the visits in the given MJD windows
+        and filters, so that only the corresponding source table rows are realized, e.g.
+            realizer.select_observations(mjd_windows=(60000.0, 60180.0), filters='r').make_source_table_vectorized(...)
+        The copy shares the catalog and settings of this realizer.
+        As the noise of each row is keyed on its IDs, the realized rows are identical
+        to the same rows of the full realization, except for quasar variability,
+        whose light curves then start at the first selected epoch.
+
+        Keyword arguments:
+        mjd_windows -- a (start, end) pair or a list of pairs of MJDs, each including its start
+                       and excluding its end. If None, all MJDs are selected. [default: None]
+        filters -- a string or list of filter names, e.g. 'r' or 'gri'.
+                   If None, all filters are selected. [default: None]
+        """
+        rows = self.get_observation_index().select(mjd_windows=mjd_windows, filters=filters)
+        return self._select_observation_rows(rows)
+
+    def _select_observation_rows(self, rows):
+        """
+        Returns a copy of this realizer restricted to the given rows (positions)
+        of the observation history
+        """
+        import copy
+        selection = copy.copy(self)
+        selection.observation = self.observation.iloc[rows].reset_index(drop=True)
+        selection.num_obs = len(rows)
+        selection.source_table, selection.sourceTable = None, None
+        selection._observation_index = None
+        return selection
+
+    def _realize_selection(self, method_name, mjd_windows, filters, *args, **kwargs):
+        """
+        Runs getattr(realizer, method_name)(*args, **kwargs) on the realizer restricted
+        to the given MJD windows and filters (see select_observations)
+        and keeps the source table it realized
+        """
+        selection = self.select_observations(mjd_windows=mjd_windows, filters=filters)
+        result = getattr(selection, method_name)(*args, **kwargs)
+        self.source_table, self.sourceTable = selection.source_table, selection.sourceTable
+        return result
+
+    def _append_new_observations(self, method_name, source_table_path, *args, **kwargs):
+        """
+        Runs getattr(realizer, method_name)(source_table_path, *args, **kwargs) on the realizer
+        restricted to the visits (obsHistID) not yet in the source table at source_table_path,
+        appending their rows to it (or writing it, if it does not exist yet).
+        Quasar variability continues from the state stored alongside the source table.
+        The appended rows are identical to the same rows of a full realization,
+        provided the new visits follow the stored ones in time.
+        """
+        import os
+
+        realized = np.zeros(0, dtype=np.int64)
+        if os.path.exists(source_table_path):
+            with self.instrumentation.stage('read_realized_visits'):
+                chunks = table_io.iter_table(source_table_path, table_format=self.table_format, columns=['ccdVisitId'])
+                realized = np.unique(np.concatenate([realized] + [chunk['ccdVisitId'].values for chunk in chunks]))
+        rows = np.flatnonzero(~np.isin(self.observation['obsHistID'].values, realized))
+        print("Appending %d new visit(s) to the %d visit(s) of %s." %(len(rows), len(realized), source_table_path))
+        if len(rows) == 0 and len(realized) > 0:
+            return None
+
+        selection = self._select_observation_rows(rows)
+        selection._append_source_rows = True
+        state_path = table_io.get_sidecar_path(source_table_path, 'variability')
+        if os.path.exists(state_path):
+            selection._variability_state = table_io.read_table(state_path, table_format=self.table_format)
+        result = getattr(selection, method_name)(source_table_path, *args, **kwargs)
+        self.source_table, self.sourceTable = selection.source_table, selection.sourceTable
+        return result
+
+    def _get_observation_arrays(self, observation=None):
+        """
+        Returns the observation history as a dictionary of contiguous Numpy arrays,
+        renamed to the source table conventions
+
+        Keyword arguments:
+        observation -- a subset of the observation history df.
+                       If None, self.observation is used. [default: None]
+
+        Returns:
+        a dictionary with keys 'ccdVisitId', 'MJD', 'filter', 'psf_fwhm',
+        'fiveSigmaDepth' and 'band_index' (position of the filter in 'ugriz')
+        """
+        if observation is None:
+            observation = self.observation
+        obs = {'ccdVisitId': observation['obsHistID'].values,
+               'MJD': np.ascontiguousarray(observation['expMJD'].values, dtype=np.float64),
+               'filter': observation['filter'].values,
+               'psf_fwhm': np.ascontiguousarray(observation['FWHMeff'].values, dtype=np.float64),
+               'fiveSigmaDepth': np.ascontiguousarray(observation['fiveSigmaDepth'].values, dtype=np.float64), }
+        obs['band_index'] = utils.get_band_index(obs['filter'])
+        return obs
+
+    def _get_chunk_plan(self, num_systems, num_obs, chunk_size=None, max_memory_mb=None, split_observations=True):
+        """
+        Splits the catalog x observation cross join into blocks of bounded size,
+        ordered so that concatenating the realized blocks reproduces
+        the row order of the monolithic cross join (system-major, then observation)
+
+        Keyword arguments:
+        num_systems -- number of systems in the catalog
+        num_obs -- number of observations in the observation history
+        chunk_size -- maximum number of source table rows per block.
+                      If None and max_memory_mb is None, a single block is returned. [default: None]
+        max_memory_mb -- memory budget per block in MB, converted into rows
+                         using self.bytes_per_source_row [default: None]
+        split_observations -- whether a single system may be realized across several
+                              blocks of observations. If False, each block holds
+                              the full observation history of its systems. [default: True]
+
+        Returns:
+        a list of (system slice, observation slice) tuples
+        """
+        if chunk_size is None and max_memory_mb is None:
+            return [(slice(0, num_systems), slice(0, num_obs))]
+        if max_memory_mb is not None:
+            budget_rows = int(max_memory_mb*1024**2//self.bytes_per_source_row)
+            chunk_size = budget_rows if chunk_size is None else min(chunk_size, budget_rows)
+        chunk_size = max(int(chunk_size), 1)
+
+        # Observations are only split when one system against
+        # the full observation history does not fit in a block,
+        # in which case each block holds a single system to preserve row order
+        if chunk_size >= num_obs or not split_observations:
+            systems_per_block, obs_per_block = max(chunk_size//max(num_obs, 1), 1), max(num_obs, 1)
+        else:
+            systems_per_block, obs_per_block = 1, chunk_size
+        return [(slice(i, min(i + systems_per_block, num_systems)), slice(j, min(j + obs_per_block, num_obs)))
+                for i in range(0, num_systems, systems_per_block)
+                for j in range(0, num_obs, obs_per_block)]
+
+    def _write_source_blocks(self, blocks, output_source_path, keep_in_memory=True):
+        """
+        Appends each realized block of the source table to output_source_path,
+        in the format given by self.table_format,
+        so that only one block has to be held in memory at a time
+
+        Keyword arguments:
+        blocks -- iterable of source table dataframes indexed by objectId, in output order,
+                  or of (dataframe, variability state) tuples for blocks with quasar variability,
+                  whose states are saved alongside the source table (see _save_variability_state)
+        output_source_path -- save path for the output source table
+        keep_in_memory -- whether to also return the concatenated source table [default: True]
+
+        Returns:
+        a tuple of the number of rows written and the concatenated source table
+        (None if keep_in_memory is False)
+        """
+        kept_blocks, states = [], None
+        with table_io.get_table_writer(output_source_path, table_format=self.table_format,
+                                       append=self._append_source_rows) as writer:
+            # Blocks are realized lazily, as they are consumed here
+            for block in self.instrumentation.iter_stage('realize_source_block', blocks):
+                if isinstance(block, tuple):
+                    block, state = block
+                    states = [] if states is None else states
+                    states.append(state)
+                with self.instrumentation.stage('write_source_block', num_rows=len(block)):
+                    writer.write(block)
+                if keep_in_memory:
+                    kept_blocks.append(block)
+            if writer.num_rows == 0 and not kept_blocks:
+                empty = pd.DataFrame(columns=self.source_columns).set_index('objectId')
+                writer.write(empty)
+                kept_blocks.append(empty)
+        num_rows = writer.num_rows
+        if states is not None:
+            self._save_variability_state(output_source_path, states)
+
+        if not keep_in_memory:
+            return num_rows, None
+        elif len(kept_blocks) == 1:
+            return num_rows, kept_blocks[0]
+        return num_rows, pd.concat(kept_blocks)
+
     def _get_lens_info(self, lensID):
         ''' This function will depend on the format of each lens catalog.
         '''
         raise NotImplementedError
 
-    def draw_system(self, lens_info, obs_info, save_path=None):
+    def _get_object_ids(self):
+        """
+        Returns the objectIds of all the systems in the catalog
+        """
+        raise NotImplementedError
+
+    def get_compact_dtypes(self):
+        """
+        Returns the dtypes of the source table columns in the compact schema
+        used if self.compact_dtypes is True, which about halves the memory and disk
+        taken by the source and object tables:
+        float32 for the measured quantities, a categorical filter with one-byte codes,
+        and int32 objectId and ccdVisitId if the IDs of the catalog and observation history fit
+        (an objectId index is int64 before pandas 2.0, which has no int32 index).
+        MJD is kept in float64, whose resolution float32 would coarsen to minutes.
+
+        float32 keeps 24 significant bits, i.e. a relative rounding error of at most 6e-8:
+        at most 2e-6 mag on apMag (for magnitudes below 32), and 6e-8 on e1 and e2
+        (which lie within [-1, 1]), far below the simulated measurement errors.
+        The numpy engine realizes each block in float64 and only rounds the stored values.
+        The pandas engine computes in float32 from the compacted preformatted table,
+        which makes errors of up to a few 1e-7 on e1 and e2 and 2e-6 mag on apMag.
+        The object table means and standard deviations are accumulated in float64
+        and rounded to float32.
+
+        Returns:
+        a dictionary of the dtype of each source table column
+        """
+        dtypes = dict((c, np.dtype(np.float32)) for c in self.source_columns)
+        dtypes['MJD'] = np.dtype(np.float64)
+        dtypes['filter'] = utils.get_filter_dtype()
+        dtypes['objectId'] = utils.get_id_dtype(self._get_object_ids())
+        dtypes['ccdVisitId'] = utils.get_id_dtype(self.observation['obsHistID'].values if self.num_obs else [])
+        return dtypes
+
+    def draw_system(self, lens_info, obs_info, save_path=None, nx=None, ny=None):
         '''
         Draws all objects of the given lens system
         in the given observation conditions, using GalSim.
@@ -74,6 +444,8 @@ class SLRealizer(object):
             a row of the observation history df
         save_path: string
             path in which to save the image
+        nx, ny: int
+            size of the stamp in pixels, by default given by get_stamp_sizes
 
         Returns
         =======
@@ -97,21 +469,30 @@ class SLRealizer(object):
         the image
         '''
         histID, MJD, band, PSF_FWHM, sky_mag = obs_info
-
-        # Construct a "scene" of image components:
-        # i) Lens galaxy #half_light_radius=lens_info['half_light_radius'],\
-        scene = galsim.Gaussian(sigma=1.0, flux=lens_info['flux'])\
-                       .shear(e=lens_info['e'], beta=lens_info['beta'])
-        # ii) Lensed quasar images
-        for i in xrange(lens_info['num_objects']):
-            quasar = galsim.Gaussian(flux=lens_info['flux_'+str(i)], sigma=1.e-5)\
-                         .shift(lens_info['xy_'+str(i)])
-            scene += quasar
-
-        # Convolve the scene with the PSF:
-        psf = galsim.Gaussian(flux=1.0, fwhm=PSF_FWHM)
-        galsim_obj = galsim.Convolve([scene, psf], gsparams=self.fft_params)
-        galsim_img = galsim_obj.drawImage(nx=self.nx, ny=self.ny, scale=self.pixel_scale, method='no_pixel')
+        if nx is None or ny is None:
+            nx, ny = [int(n[0]) for n in self.get_stamp_sizes(lens_infos=[lens_info], psf_fwhms=[PSF_FWHM])]
+
+        if self.render_backend == 'numpy':
+            image_array = self.render_systems(lens_infos=[lens_info], psf_fwhms=[PSF_FWHM], nx=nx, ny=ny)[0]
+            galsim_img = galsim.Image(image_array, scale=self.pixel_scale)
+        elif self.render_backend == 'galsim':
+            # Construct a "scene" of image components, built with the GSParams
+            # of the convolution so that Convolve does not have to rebuild them:
+            # i) Lens galaxy #half_light_radius=lens_info['half_light_radius'],\
+            components = [galsim.Gaussian(sigma=1.0, flux=lens_info['flux'], gsparams=self.fft_params)\
+                                .shear(e=lens_info['e'], beta=lens_info['beta'])]
+            # ii) Lensed quasar images
+            for i in xrange(lens_info['num_objects']):
+                quasar = galsim.Gaussian(flux=lens_info['flux_'+str(i)], sigma=1.e-5, gsparams=self.fft_params)\
+                             .shift(lens_info['xy_'+str(i)])
+                components.append(quasar)
+            scene = galsim.Sum(components, gsparams=self.fft_params)
+
+            # Convolve the scene with the PSF:
+            galsim_obj = galsim.Convolve([scene, self._get_psf(PSF_FWHM)], gsparams=self.fft_params)
+            galsim_img = galsim_obj.drawImage(nx=nx, ny=ny, scale=self.pixel_scale, method='no_pixel')
+        else:
+            raise ValueError("Please enter a valid render backend, either 'galsim' or 'numpy'")
         if save_path is not None:
             plt.imshow(galsim_img.array, interpolation='none', aspect='auto')
             plt.savefig(save_path)
@@ -119,7 +500,80 @@ class SLRealizer(object):
 
         return galsim_img
 
-    def estimate_parameters(self, galsim_img, method="raw_numerical"):
+    def _get_psf(self, psf_fwhm):
+        """
+        Returns the GalSim PSF of draw_system for the given FWHM,
+        shared by all systems drawn at this FWHM and pixel scale.
+        Systems are realized grouped by observation (see _realize_rows),
+        so consecutive draws mostly hit the cache.
+        """
+        key = (float(psf_fwhm), self.pixel_scale, self.fft_params)
+        psf = self._psf_cache.get(key)
+        if psf is None:
+            if len(self._psf_cache) >= self.max_psf_cache_size:
+                self._psf_cache.clear()
+            psf = galsim.Gaussian(flux=1.0, fwhm=psf_fwhm, gsparams=self.fft_params)
+            self._psf_cache[key] = psf
+        return psf
+
+    def get_stamp_sizes(self, lens_infos, psf_fwhms):
+        """
+        Returns the stamp sizes of lens systems: with self.adaptive_stamps,
+        the size containing self.stamp_flux_fraction of the flux of each system
+        (see gaussian_render.get_stamp_sizes), and otherwise self.nx by self.ny
+
+        Keyword arguments:
+        lens_infos -- list of lens systems in GalSim terms (the lens_info of draw_system)
+        psf_fwhms -- PSF FWHM of the observation of each system in arcsec
+
+        Returns:
+        a tuple of the integer arrays of the number of pixels nx and ny of each stamp
+        """
+        if not self.adaptive_stamps:
+            return np.full(len(lens_infos), self.nx), np.full(len(lens_infos), self.ny)
+        sizes = gaussian_render.get_stamp_sizes(pixel_scale=self.pixel_scale, psf_fwhm=psf_fwhms,
+                                                flux_fraction=self.stamp_flux_fraction,
+                                                **self._get_scene_arrays(lens_infos))
+        return sizes, sizes
+
+    def render_systems(self, lens_infos, psf_fwhms, nx=None, ny=None):
+        """
+        Renders many lens systems at once with the closed-form convolved Gaussians
+        of utils.gaussian_render, i.e. the images draw_system renders with GalSim
+
+        Keyword arguments:
+        lens_infos -- list of lens systems in GalSim terms (the lens_info of draw_system)
+        psf_fwhms -- PSF FWHM of the observation of each system in arcsec
+        nx, ny -- size of the stamps in pixels [default: self.nx, self.ny]
+
+        Returns:
+        an array of shape [n_systems, ny, nx] of the rendered images
+        """
+        nx = self.nx if nx is None else nx
+        ny = self.ny if ny is None else ny
+        return gaussian_render.render_lens_systems(psf_fwhm=psf_fwhms, nx=nx, ny=ny, pixel_scale=self.pixel_scale,
+                                                   **self._get_scene_arrays(lens_infos))
+
+    def _get_scene_arrays(self, lens_infos):
+        """
+        Returns the lens and quasar arguments of gaussian_render.render_lens_systems
+        for a list of lens systems in GalSim terms
+        """
+        num_systems = len(lens_infos)
+        num_images = max([lens_info['num_objects'] for lens_info in lens_infos] + [0])
+        lens_flux, e, beta = np.zeros(num_systems), np.zeros(num_systems), np.zeros(num_systems)
+        quasar_flux = np.zeros((num_systems, num_images))
+        quasar_x, quasar_y = np.zeros((num_systems, num_images)), np.zeros((num_systems, num_images))
+        for s, lens_info in enumerate(lens_infos):
+            lens_flux[s], e[s] = lens_info['flux'], lens_info['e']
+            beta[s] = lens_info['beta']/galsim.radians
+            for i in xrange(lens_info['num_objects']):
+                quasar_flux[s, i] = lens_info['flux_'+str(i)]
+                quasar_x[s, i], quasar_y[s, i] = lens_info['xy_'+str(i)]
+        return {'lens_flux': lens_flux, 'lens_sigma': np.ones(num_systems), 'e': e, 'beta': beta,
+                'quasar_flux': quasar_flux, 'quasar_x': quasar_x, 'quasar_y': quasar_y, }
+
+    def estimate_parameters(self, galsim_img, method="raw_numerical", guess=None, n_workers=None):
         """
         Performs shape estimati on on the galsim_img
         using either GalSim's HSM shape estimator or
@@ -127,36 +581,28 @@ class SLRealizer(object):
         under the observation conditions obs_info
 
         Keyword arguments:
-        galsim_img -- GalSim's Image object on which parameters will be estimated
+        galsim_img -- GalSim's Image object on which parameters will be estimated,
+                      or a batch of images as an array of shape [n_images, ny, nx]
         method -- one of "hsm" (GalSim's HSM shape estimator) or
                   "raw_numerical" (a native numerical moment calculator) [default: "raw"]
+        guess -- HSM initial guess, a tuple of the sigma and the centroid x and y in pixels
+                 (arrays for a batch of images) as returned by hsm_batch.get_guess_from_moments.
+                 If None, HSM starts from a sigma of self.pixel_scale*10.0 at the center. [default: None]
+        n_workers -- if given, HSM measures a batch of images across n_workers processes [default: None]
 
         Returns
         a dictionary of the lens properties,
         which can be used to draw the emulated image
+        (a list of them, None where HSM failed, for a batch of images)
         """
+        if isinstance(galsim_img, np.ndarray):
+            return self._estimate_parameters_batch(image_stack=galsim_img, method=method, guess=guess, n_workers=n_workers)
+
         estimated_params = {}
         if method == "hsm":
-            try:
-                shape_info = galsim_img.FindAdaptiveMom(guess_sig=self.pixel_scale*10.0)
-            except:
-                #print "HSM failed"
-                return None
-
-            # Calculate the real position from the arbitrary pixel position
-            pixelCenter = galsim.PositionD(x=shape_info.moments_centroid.x, y=shape_info.moments_centroid.y)
-            estimated_params['x'], estimated_params['y'] = utils.pixel_to_physical(shape_info.moments_centroid.x, self.nx, self.pixel_scale),\
-                                             utils.pixel_to_physical(shape_info.moments_centroid.y, self.ny, self.pixel_scale)
-
-            estimated_params['apFlux'] = float(np.sum(galsim_img.array))
-            if self.DEBUG:
-                estimated_params['hlr'] = galsim_img.calculateHLR(center=pixelCenter)
-                estimated_params['det'] = (shape_info.moments_sigma * self.pixel_scale)**4.0
-            estimated_params['trace'] = 2.0*galsim_img.calculateMomentRadius(center=pixelCenter, rtype='trace')**2.0
-            estimated_params['e1'] = shape_info.observed_shape.e1
-            estimated_params['e2'] = shape_info.observed_shape.e2
-            estimated_params['e_final'] = shape_info.observed_shape.e
-            estimated_params['phi_final'] = shape_info.observed_shape.beta
+            guess_sig, guess_x, guess_y = (self.pixel_scale*10.0, None, None) if guess is None else guess
+            estimated_params, _ = hsm_batch.measure_stamp(galsim_img, pixel_scale=self.pixel_scale, guess_sig=guess_sig,
+                                                          guess_x=guess_x, guess_y=guess_y, debug=self.DEBUG)
         elif method == "raw_numerical":
             image_array = galsim_img.array
             Ix, Iy = utils.get_first_moments_from_image(image_array, self.pixel_scale)
@@ -174,6 +620,37 @@ class SLRealizer(object):
 
         return estimated_params
 
+    def _estimate_parameters_batch(self, image_stack, method="raw_numerical", guess=None, n_workers=None):
+        """
+        Performs shape estimation on a batch of images, computing the
+        raw_numerical moments of the whole stack at once,
+        or measuring the stamps with hsm_batch.measure_stamps
+
+        Keyword arguments:
+        image_stack -- an array of shape [n_images, ny, nx]
+        method -- one of "hsm" or "raw_numerical" (See estimate_parameters)
+        guess, n_workers -- HSM initial guesses and number of processes (See estimate_parameters)
+
+        Returns
+        a list of dictionaries of the lens properties, None where HSM failed
+        """
+        if method == "hsm":
+            guess_sig, guess_x, guess_y = (self.pixel_scale*10.0, None, None) if guess is None else guess
+            columns = hsm_batch.measure_stamps(image_stack, pixel_scale=self.pixel_scale, guess_sig=guess_sig,
+                                               guess_x=guess_x, guess_y=guess_y, n_workers=n_workers)
+            return [None if columns['hsm_failure'][i] else dict((k, columns[k][i]) for k in hsm_batch.HSM_COLUMNS[:-1])
+                    for i in range(len(image_stack))]
+        elif method != "raw_numerical":
+            raise ValueError("Please enter a valid method, either 'hsm' or 'raw_numerical'")
+
+        flux, Ix, Iy, Ixx, Ixy, Iyy = utils.get_moments_from_image_stack(image_stack, self.pixel_scale)
+        trace = Ixx + Iyy
+        e1, e2 = (Ixx - Iyy)/trace, 2.0*Ixy/trace
+        e_final, phi_final = utils.e1e2_to_ephi(e1, e2)
+        return [{'apFlux': flux[i], 'x': Ix[i], 'y': Iy[i], 'trace': trace[i],
+                 'e1': e1[i], 'e2': e2[i], 'e_final': e_final[i], 'phi_final': phi_final[i], }
+                for i in range(len(flux))]
+
     def draw_emulated_system(self, estimated_params):
         """
         Draws the emulated system, i.e. draws the aggregate system
@@ -192,6 +669,17 @@ class SLRealizer(object):
         emulatedImg = system.drawImage(nx=self.nx, ny=self.ny, scale=self.pixel_scale, method='no_pixel')
         return emulatedImg
 
+    def _get_moment_noise(self, objectId, ccdVisitId):
+        """
+        Returns the fractional noise of the first moments x and y and of the trace,
+        keyed on the objectId and ccdVisitId of each row
+        """
+        first_moment = random_streams.get_standard_normals(self.seed, 'first_moment', objectId, ccdVisitId, num_draws=2)
+        first_moment = constants.get_first_moment_err() + constants.get_first_moment_err_std()*first_moment
+        trace = constants.get_second_moment_err() + constants.get_second_moment_err_std()\
+                *random_streams.get_standard_normals(self.seed, 'second_moment', objectId, ccdVisitId)
+        return first_moment[..., 0], first_moment[..., 1], trace
+
     def create_source_row(self, derived_params, objectId, obs_info):
         '''
         Returns a dictionary of lens system's properties
@@ -210,18 +698,13 @@ class SLRealizer(object):
 
         derived_params['apFluxErr'] = utils.mag_to_flux(sky_mag-22.5)/5.0 # because Fb = 5 \sigma_b
         if self.add_moment_noise:
-            derived_params['trace'] += utils.add_noise(mean=constants.get_second_moment_err(),
-                                               stdev=constants.get_second_moment_err_std(),
-                                               measurement=derived_params['trace'])
-            derived_params['x'] += utils.add_noise(mean=constants.get_first_moment_err(),
-                                           stdev=constants.get_first_moment_err_std(),
-                                           measurement=derived_params['x'])
-            derived_params['y'] += utils.add_noise(mean=constants.get_first_moment_err(),
-                                           stdev=constants.get_first_moment_err_std(),
-                                           measurement=derived_params['y'])
+            x_noise, y_noise, trace_noise = self._get_moment_noise(objectId, histID)
+            derived_params['trace'] += derived_params['trace']*trace_noise
+            derived_params['x'] += derived_params['x']*x_noise
+            derived_params['y'] += derived_params['y']*y_noise
         if self.add_flux_noise:
-            derived_params['apFlux'] += utils.add_noise(mean=0.0,
-                                                stdev=derived_params['apFluxErr']) # flux rms not skyErr
+            derived_params['apFlux'] += random_streams.get_noise(self.seed, 'flux', objectId, histID,
+                                                                 mean=0.0, stdev=derived_params['apFluxErr']) # flux rms not skyErr
         derived_params['apMag'] = utils.flux_to_mag(derived_params['apFlux'], from_unit='nMgy')
         derived_params['apMagErr'] = (2.5/np.log(10.0)) * derived_params['apFluxErr']/derived_params['apFlux']
 
@@ -234,45 +717,85 @@ class SLRealizer(object):
                'psf_fwhm': PSF_FWHM, 'objectId': objectId}
         return row
 
-    def make_source_table_rowbyrow(self, save_file, method="analytical"):
+    @instrumented('make_source_table_rowbyrow')
+    def make_source_table_rowbyrow(self, save_file, method="analytical", n_workers=None, shard_size=None,
+                                   mjd_windows=None, filters=None):
         import time
         """
         Returns a source table generated from all the lens systems in the catalog
         under all the observation conditions in the observation history,
-        and saves it as a .csv file.
+        and saves it to disk (as csv unless self.table_format
+        or the file extension says otherwise).
 
         Keyword arguments:
         save_file -- path into which output source table will be saved
         method -- how to calculate moments for each row
                   (See method estimate_parameters for details about each option)
+        n_workers -- if given, the catalog is split into shards of shard_size systems
+                     realized across n_workers processes. The merged table is in the
+                     usual row order and does not depend on n_workers. [default: None]
+        shard_size -- number of systems per shard in parallel mode.
+                      If None, the catalog is split into 64 shards. [default: None]
+        mjd_windows, filters -- if given, only the visits in these MJD windows and filters
+                                are realized (see select_observations) [default: None]
         """
+        if mjd_windows is not None or filters is not None:
+            return self._realize_selection('make_source_table_rowbyrow', mjd_windows, filters, save_file,
+                                           method=method, n_workers=n_workers, shard_size=shard_size)
         start = time.time()
         print("Began making the source catalog.")
+        self._hsm_failures = []
 
-        df = pd.DataFrame(columns=self.source_columns)
         #ellipticity_upper_limit = desc.slrealizer.get_ellipticity_cut()
         print("Number of systems: %d, number of observations: %d" %(self.num_systems, self.num_obs))
 
-        hsm_failed = 0
-
-        for j in xrange(self.num_obs):
-            for i in xrange(self.num_systems):
-                row = self.create_source_row(lens_info=self.get_lens_info(rownum=i),
-                                             obs_info=self.observation.loc[j],
-                                             method=method)
-                if row == None:
-                    hsm_failed += 1
-                else:
-                    df = df.append(row, ignore_index=True)
+        with self.instrumentation.stage('realize_rows'):
+            if n_workers is None:
+                shard_results = [self._realize_rows(slice(0, self.num_systems), method)]
+            else:
+                if shard_size is None:
+                    shard_size = max(int(np.ceil(self.num_systems/64.0)), 1)
+                shard_args = [(slice(i, min(i + shard_size, self.num_systems)), method)
+                              for i in range(0, self.num_systems, shard_size)]
+                shard_results = self._map_shards('_realize_rows', shard_args, n_workers)
+
+            hsm_failures = []
+            shard_columns = []
+            for columns, shard_hsm_failures in shard_results:
+                hsm_failures.extend(shard_hsm_failures)
+                if columns is not None:
+                    shard_columns.append(columns)
+                    self.instrumentation.add_rows(len(columns['obs_row']))
+
+        if shard_columns:
+            columns = dict((k, np.concatenate([c[k] for c in shard_columns])) for k in shard_columns[0])
+            # Merge shards in the (observation, system) order of the serial loop
+            order = np.lexsort((columns.pop('system_row'), columns.pop('obs_row')))
+            df = pd.DataFrame(utils.select_rows(columns, order), columns=self.source_columns)
+        else:
+            df = pd.DataFrame(columns=self.source_columns)
 
         df = df.infer_objects()
         df = df[self.source_columns]
+        if self.compact_dtypes:
+            utils.compact_columns(df, self.get_compact_dtypes())
         df.set_index('objectId', inplace=True)
-        df.to_csv(save_file, index=True)
+        with self.instrumentation.stage('write_source_table', num_rows=len(df)):
+            table_io.write_table(df, save_file, table_format=self.table_format, index=True)
+        self.instrumentation.add_rows(len(df))
+        # Record the reason of each HSM failure alongside the source table
+        self.hsm_failures = pd.DataFrame(hsm_failures, columns=['objectId', 'ccdVisitId', 'hsm_failure'])
+        if method == 'hsm':
+            table_io.write_table(self.hsm_failures, table_io.get_sidecar_path(save_file, 'hsm_failures'),
+                                 table_format=self.table_format, index=False)
 
         end = time.time()
+        if self.stamp_cache is not None:
+            print("Stamp cache statistics (this process): ", self.stamp_cache.get_stats())
         if method == 'hsm':
-            print("Done making the source table which has %d row(s) in %0.2f hours, after getting %d errors from HSM failure." %(len(df), (end - start)/3600.0, hsm_failed))
+            print("Done making the source table which has %d row(s) in %0.2f hours, after getting %d errors from HSM failure." %(len(df), (end - start)/3600.0, len(hsm_failures)))
+            if hsm_failures:
+                print("HSM failures by reason: ", dict(self.hsm_failures['hsm_failure'].value_counts()))
         else:
             print("Done making the source table with %s method in %0.2f minutes." %(method, (end - start)/60.0))
 #        desc.slrealizer.dropbox_upload(dir, 'source_catalog_new.csv')
@@ -281,31 +804,181 @@ class SLRealizer(object):
         if self.DEBUG:
             return df
 
-    def make_object_table(self, object_table_path, source_table_path=None, include_std=False):
+    def _realize_rows(self, system_rows, method):
+        """
+        Realizes the systems in system_rows under every observation,
+        one observation (and batch of systems) at a time,
+        accumulating the rows in preallocated column buffers
+
+        Keyword arguments:
+        system_rows -- slice of catalog row numbers to realize
+        method -- how to calculate moments for each row
+
+        Returns:
+        a tuple of the dictionary of filled column buffers (None if no row succeeded),
+        including the 'obs_row' and 'system_row' of each row,
+        and the list of the (objectId, ccdVisitId, reason) of the rows for which HSM failed
+        """
+        num_failures = len(self._hsm_failures)
+        systems = list(range(system_rows.start, system_rows.stop))
+        # Look up each system once, not once per observation
+        lens_infos = [self.get_lens_info(rownum=i) for i in systems]
+        max_rows = self.num_obs*len(systems)
+
+        buffers = None
+        obs_row = np.empty(max_rows, dtype=np.int64)
+        system_row = np.empty(max_rows, dtype=np.int64)
+        num_rows = 0
+        for j in range(self.num_obs):
+            rows = self._realize_observation_batch(obs_info=self.observation.loc[j], lens_infos=lens_infos, method=method)
+            for i, row in zip(systems, rows):
+                if row is None:
+                    # Recorded by _record_hsm_failure
+                    continue
+                if buffers is None:
+                    buffers = self._allocate_source_buffers(row, max_rows)
+                for k, buf in buffers.items():
+                    if k in row:
+                        buf[num_rows] = row[k]
+                obs_row[num_rows], system_row[num_rows] = j, i
+                num_rows += 1
+
+        hsm_failures = self._hsm_failures[num_failures:]
+        if buffers is None:
+            return None, hsm_failures
+        columns = dict((k, buf[:num_rows]) for k, buf in buffers.items())
+        columns['obs_row'], columns['system_row'] = obs_row[:num_rows], system_row[:num_rows]
+        return columns, hsm_failures
+
+    def _record_hsm_failure(self, objectId, ccdVisitId, reason):
+        """
+        Records that HSM failed on the row of objectId and ccdVisitId, for the given reason
+        """
+        self._hsm_failures.append((objectId, ccdVisitId, reason))
+
+    def _realize_observation_batch(self, obs_info, lens_infos, method):
+        """
+        Realizes a batch of systems under one observation
+
+        Keyword arguments:
+        obs_info -- a row of the observation history df
+        lens_infos -- list of catalog rows of the systems
+        method -- how to calculate moments for each row
+
+        Returns:
+        a list of source rows (see create_source_row), None where HSM failed
+        """
+        return [self.create_source_row(lens_info=lens_info, obs_info=obs_info, method=method)
+                for lens_info in lens_infos]
+
+    def _allocate_source_buffers(self, row, num_rows):
+        """
+        Allocates one column buffer of length num_rows per source table column,
+        typed after the values of the first realized row.
+        Columns missing from a row are left as NaN.
+        """
+        buffers = {}
+        for k in self.source_columns:
+            dtype = np.asarray(row.get(k, np.nan)).dtype
+            if dtype.kind in 'iu':
+                buffers[k] = np.zeros(num_rows, dtype=np.int64)
+            elif dtype.kind == 'f':
+                buffers[k] = np.full(num_rows, np.nan, dtype=dtype)
+            else:
+                # Strings (e.g. filter) and any other Python objects
+                buffers[k] = np.empty(num_rows, dtype=object)
+        return buffers
+
+    @instrumented('make_object_table')
+    def make_object_table(self, object_table_path, source_table_path=None, include_std=False, chunk_rows=None, engine='numpy',
+                          update=False):
 
         """
         Generates the object table from the given source table at source_table_path
         by averaging the properties for each filter, and saves it as object_table_path.
+
+        Keyword arguments:
+        chunk_rows -- if given, the source table is streamed chunk_rows rows at a time
+                      into running per-(object, filter) statistics, so that memory
+                      is bounded by the size of the object table [default: None]
+        engine -- how the whole source table is aggregated if chunk_rows is None,
+                  one of "numpy" (reductions over sorted (object, filter) segments) or
+                  "pandas" (the original pivot_table implementation, kept as a reference) [default: "numpy"]
+        update -- if True, the running per-(object, filter) statistics stored alongside the object table
+                  are updated with only the source table rows appended since they were stored
+                  (or built from the whole source table the first time), and saved again.
+                  The source table at source_table_path must only have grown by appending since.
+                  A csv source table is read from its size when the statistics were stored,
+                  without parsing the rows already aggregated. [default: False]
         """
         import time
-        import gc
 
         if object_table_path is None:
             raise ValueError("Must provide save path of the output object table.")
 
+        if update:
+            start = time.time()
+            obj = self._get_object_stats_incremental(object_table_path=object_table_path, source_table_path=source_table_path,
+                                                     include_std=include_std, chunk_rows=chunk_rows or 100000)
+        elif chunk_rows is not None:
+            start = time.time()
+            obj = self._get_object_stats_streaming(source_table_path=source_table_path, include_std=include_std, chunk_rows=chunk_rows)
+        else:
+            start, obj = self._get_object_stats(source_table_path=source_table_path, include_std=include_std, engine=engine)
+
+        # Drop examples with missing values
+        obj.dropna(how='any', inplace=True)
+        # Get x, y values relative to the r-band
+        for b in 'ugriz':
+            obj[b + '_' + 'x'] = obj[b + '_' + 'x'] - obj['r_x']
+            obj[b + '_' + 'y'] = obj[b + '_' + 'y'] - obj['r_y']
+        end = time.time()
+
+        if self.compact_dtypes:
+            utils.compact_columns(obj, {})
+        # Save in the realizer's table format
+        with self.instrumentation.stage('write_object_table', num_rows=len(obj)):
+            table_io.write_table(obj, object_table_path, table_format=self.table_format, index=False)
+        print("Done making the object table in %0.2f seconds." %(end-start))
+        #if self.DEBUG:
+            #print("Object table columns: ", obj.columns)
+
+        #desc.slrealizer.dropbox_upload(save_dir, 'object_catalog_new.csv') #this uploads to the desc account
+
+    @instrumented('aggregate_object_table')
+    def _get_object_stats(self, source_table_path, include_std, engine='numpy'):
+        """
+        Returns the start time and the per-object mean (and std) of the source table properties
+        of each filter, aggregating the whole source table in memory
+        """
+        import time
+        import gc
+
         if source_table_path is not None:
             print("Reading in the source table at %s ..." %source_table_path)
-            obj = pd.read_csv(source_table_path)
-            obj.set_index('objectId', inplace=True)
+            with self.instrumentation.stage('read_source_table'):
+                obj = table_io.read_table(source_table_path, table_format=self.table_format)
+                if self.compact_dtypes:
+                    utils.compact_columns(obj, {'MJD': np.float64})
+                obj.set_index('objectId', inplace=True)
+                self.instrumentation.add_rows(len(obj))
         elif self.sourceTable is not None:
             print("Reading in Pandas Dataframe of most recent source table generated... ")
-            obj = self.sourceTable.copy()
+            # The numpy engine only reads the table, so it needs no copy
+            obj = self.sourceTable.copy() if engine == 'pandas' else self.sourceTable
         else:
             raise ValueError("Must provide a source table path or generate a source table at least once using this Realizer object.")
 
         start = time.time()
+        self.instrumentation.add_rows(len(obj))
+
+        if engine == 'numpy':
+            return start, self._aggregate_object_stats(obj, include_std=include_std)
+        elif engine != 'pandas':
+            raise ValueError("Please enter a valid engine, either 'numpy' or 'pandas'")
 
         obj.drop(['ccdVisitId', 'psf_fwhm'], axis=1, inplace=True)
+        obj['filter'] = np.asarray(obj['filter'])
         # Define (filter-nonspecific) properties to go in object table columns
         keepCols = list(obj.columns.values)
         keepCols.remove('filter')
@@ -328,23 +1001,150 @@ class SLRealizer(object):
         else:
             obj = means
         gc.collect()
+        return start, obj
 
-        # Drop examples with missing values
-        obj.dropna(how='any', inplace=True)
-        # Get x, y values relative to the r-band
-        for b in 'ugriz':
-            obj[b + '_' + 'x'] = obj[b + '_' + 'x'] - obj['r_x']
-            obj[b + '_' + 'y'] = obj[b + '_' + 'y'] - obj['r_y']
-        end = time.time()
+    def _aggregate_object_stats(self, src, include_std):
+        """
+        Returns the per-object mean (and std) of the source table properties of each filter,
+        reducing over contiguous (object, filter) segments of the sorted source table
+        instead of pivoting it on MJD
 
-        # Save as csv file
-        obj.to_csv(object_table_path, index=False)
-        print("Done making the object table in %0.2f seconds." %(end-start))
-        #if self.DEBUG:
-            #print("Object table columns: ", obj.columns)
+        Keyword arguments:
+        src -- the source table df, indexed by objectId
+        include_std -- whether to include the standard deviations, as '-std' columns
 
-        #desc.slrealizer.dropbox_upload(save_dir, 'object_catalog_new.csv') #this uploads to the desc account
+        Returns:
+        a Pandas dataframe with one row per object and filter_property columns,
+        in the column order of the pivot_table implementation
+        """
+        if len(src) == 0:
+            raise ValueError("The source table is empty.")
+        properties = sorted(c for c in src.columns if c not in ['filter', 'MJD', 'ccdVisitId', 'psf_fwhm'])
+        objectId = src.index.values
+        filter_index, filters = pd.factorize(np.asarray(src['filter']), sort=True)
+
+        # Segment boundaries of the table sorted by (object, filter)
+        order = np.lexsort((filter_index, objectId))
+        sorted_object, sorted_filter = objectId[order], filter_index[order]
+        is_start = np.ones(len(order), dtype=bool)
+        is_start[1:] = (sorted_object[1:] != sorted_object[:-1]) | (sorted_filter[1:] != sorted_filter[:-1])
+        starts = np.flatnonzero(is_start)
+        values = np.column_stack([src[p].values[order] for p in properties])
+        _, means, stds = running_stats.get_segment_stats(values, starts, include_std=include_std)
+
+        # Scatter the segments into an (object, property, filter) cube, and flatten it into columns
+        objects, object_row = np.unique(sorted_object[starts], return_inverse=True)
+        columns = ['%s_%s' %(f, p) for p in properties for f in filters]
+        def to_wide(segment_stats):
+            cube = np.full((len(objects), len(properties), len(filters)), np.nan)
+            cube[object_row, :, sorted_filter[starts]] = segment_stats
+            return pd.DataFrame(cube.reshape(len(objects), -1), index=pd.Index(objects, name='objectId'), columns=columns)
+
+        obj = to_wide(means)
+        if include_std:
+            obj = obj.join(to_wide(stds), lsuffix='', rsuffix='-std')
+        return obj
 
+    @instrumented('aggregate_object_table')
+    def _get_object_stats_streaming(self, source_table_path, include_std, chunk_rows):
+        """
+        Returns the per-object mean (and std) of the source table properties of each filter,
+        reading the source table chunk_rows rows at a time into running statistics
+        """
+        if source_table_path is not None:
+            print("Streaming the source table at %s ..." %source_table_path)
+            chunks = table_io.iter_table(source_table_path, table_format=self.table_format, chunk_rows=chunk_rows)
+        elif self.sourceTable is not None:
+            print("Streaming Pandas Dataframe of most recent source table generated... ")
+            chunks = (self.sourceTable.iloc[i:i + chunk_rows].reset_index()
+                      for i in range(0, len(self.sourceTable), chunk_rows))
+        else:
+            raise ValueError("Must provide a source table path or generate a source table at least once using this Realizer object.")
+
+        stats, _ = self._update_object_stats(chunks)
+        if stats is None:
+            raise ValueError("The source table is empty.")
+        return self._get_object_stats_table(stats, include_std=include_std)
+
+    @instrumented('aggregate_object_table')
+    def _get_object_stats_incremental(self, object_table_path, source_table_path, include_std, chunk_rows):
+        """
+        Returns the per-object mean (and std) of the source table properties of each filter,
+        updating the running statistics stored alongside the object table
+        with the source table rows appended since, streamed chunk_rows rows at a time
+        """
+        import os
+
+        if source_table_path is None:
+            raise ValueError("Must provide the source table path to update the object table.")
+        stats_path = table_io.get_sidecar_path(object_table_path, 'stats')
+        stats, num_source_rows, num_source_bytes = None, 0, None
+        if os.path.exists(stats_path):
+            with self.instrumentation.stage('read_object_stats'):
+                stored = table_io.read_table(stats_path, table_format=self.table_format)
+                num_source_rows = int(stored['num_source_rows'].iloc[0])
+                # Stats stored before the source table size was recorded have no num_source_bytes
+                if 'num_source_bytes' in stored:
+                    num_source_bytes = int(stored['num_source_bytes'].iloc[0])
+                stats = RunningStats.from_frame(stored.drop(['num_source_rows', 'num_source_bytes'], axis=1, errors='ignore'),
+                                                group_columns=['objectId', 'filter'])
+        print("Streaming the source table at %s from row %d ..." %(source_table_path, num_source_rows))
+        chunks = table_io.iter_table(source_table_path, table_format=self.table_format, chunk_rows=chunk_rows,
+                                     start_row=num_source_rows, start_byte=num_source_bytes)
+        stats, num_new_rows = self._update_object_stats(chunks, stats=stats)
+        if stats is None:
+            raise ValueError("The source table is empty.")
+
+        # The number and size of the source table rows aggregated, in every row,
+        # from which the next update resumes reading
+        stored = stats.to_frame()
+        stored['num_source_rows'] = num_source_rows + num_new_rows
+        stored['num_source_bytes'] = table_io.get_table_size(source_table_path)
+        with self.instrumentation.stage('write_object_stats', num_rows=len(stored)):
+            table_io.write_table(stored, stats_path, table_format=self.table_format, index=False)
+        return self._get_object_stats_table(stats, include_std=include_std)
+
+    def _update_object_stats(self, chunks, stats=None):
+        """
+        Adds chunks of the source table to running per-(object, filter) statistics
+
+        Keyword arguments:
+        chunks -- iterable of source table dataframes, with objectId as a regular column
+        stats -- the RunningStats to update. If None, they are created from the first chunk. [default: None]
+
+        Returns:
+        a tuple of the updated RunningStats (None if there were neither stats nor rows) and the number of rows added
+        """
+        num_rows = 0
+        for chunk in self.instrumentation.iter_stage('read_source_chunk', chunks):
+            if stats is None:
+                value_columns = [c for c in chunk.columns if c not in ['objectId', 'filter', 'MJD', 'ccdVisitId', 'psf_fwhm']]
+                stats = RunningStats(group_columns=['objectId', 'filter'], value_columns=value_columns)
+            chunk['filter'] = np.asarray(chunk['filter'])
+            stats.update(chunk)
+            num_rows += len(chunk)
+            self.instrumentation.add_rows(len(chunk))
+        return stats, num_rows
+
+    def _get_object_stats_table(self, stats, include_std):
+        """
+        Returns the per-object mean (and std) of each filter from running per-(object, filter) statistics
+        """
+        obj = self._pivot_object_stats(stats.get_mean())
+        if include_std:
+            obj = obj.join(self._pivot_object_stats(stats.get_std()), lsuffix='', rsuffix='-std')
+        return obj
+
+    def _pivot_object_stats(self, stats):
+        """
+        Pivots per-(object, filter) statistics into one row per object,
+        with the filter_property columns of the object table
+        """
+        stats = stats.unstack('filter').sort_index(axis=1)
+        stats.columns = stats.columns.map('{0[1]}_{0[0]}'.format)
+        return stats
+
+    @instrumented('include_quasar_variability')
     def include_quasar_variability(self, save_output=False, input_source_path=None, output_source_path=None):
         """
         Takes a source table and adds the intrinsic variability of the quasar images
@@ -355,8 +1155,6 @@ class SLRealizer(object):
         input_source_path -- path of input source table to be altered [default: None]
         output_source_path -- path of output source table containing time variability [default: None]
         """
-
-        import gc
         import time
 
         start = time.time()
@@ -369,7 +1167,7 @@ class SLRealizer(object):
         else:
             try:
                 print("Reading in the source table at %s" %input_source_path)
-                src = pd.read_csv(input_source_path)
+                src = table_io.read_table(input_source_path, table_format=self.table_format)
             except ValueError:
                 print("Please input a valid path to the source table.")
 
@@ -378,85 +1176,97 @@ class SLRealizer(object):
             NUM_OBJECTS = src['objectId'].nunique()
             print(NUM_TIMES, NUM_OBJECTS)
 
-        for q in range(4):
-            magnitude_type = 'q_mag_' + str(q)
-            # Filter-specific dictionary of apMag values to replace src apMag
-            apMag_filter = {}
-            for b in 'ugriz':
-                #########################
-                # Adding useful columns #
-                #########################
-                # Filter-specific version of src with only the columns we need
-                src_timevar = src.query('filter == @b')[['filter', 'objectId', 'MJD', magnitude_type, ]].copy()
-                # Total number of time steps in this filter
-                NUM_TIMES_FILTER = src_timevar['MJD'].nunique()
-                # Set MJD relative to zero
-                src_timevar['MJD_diff'] = src_timevar['MJD'] - np.min(src_timevar['MJD'].values)
-                # Map ccdVisitId to integers starting from 0
-                sorted_obs_id = np.sort(src_timevar['MJD'].unique())
-                time_map = dict(zip(sorted_obs_id, range(NUM_TIMES_FILTER)))
-                src_timevar['time_index'] = src_timevar['MJD'].map(time_map).astype(int)
-                # Add a column of time elapsed since last observation, d_time
-                src_timevar.sort_values(['objectId', 'filter', 'MJD', 'MJD_diff'], axis=0, inplace=True)
-                src_timevar['d_time'] = src_timevar['MJD_diff'] - src_timevar['MJD_diff'].shift(+1)
-                src_timevar['d_time'].fillna(0.0, inplace=True)
-                src_timevar['d_time'] = np.clip(src_timevar['d_time'], a_min=0.0, a_max=None)
-                gc.collect()
-
-                ##############################
-                # Computing time variability #
-                ##############################
-                # Parameters of the generative model (hand-picked)
-                MU = 0.0
-                TAU = 20.0 #np.power(10.0, 2.4) # days
-                S_INF = 0.14 # mag
-                # Add a column to store the variability and initialize to zero
-                src_timevar['intrinsic_mag'] = 0.0
-                # Pivot to get time sequence to be horizontal
-                src_timepivot = src_timevar.pivot_table(index=['filter', 'objectId'],
-                                                        columns=['time_index',],
-                                                        values=['d_time', magnitude_type, 'intrinsic_mag', ])
-                # Update 'intrinsic_mag' column
-                for t in range(1, NUM_TIMES_FILTER):
-                    src_timepivot.loc[b, :]['intrinsic_mag'][t] = np.random.normal(loc=src_timepivot['intrinsic_mag'][t - 1].values*np.exp(-src_timepivot['d_time'][t].values/TAU) + MU*(1.0 - np.exp(-src_timepivot['d_time'][t].values/TAU)),
-                                                                                   scale=0.5*S_INF**2.0*(1.0 - np.exp(-2.0*src_timepivot['d_time'][t].values/TAU)))
-
-                ########################
-                # Final column sorting #
-                ########################
-                # Add computed variability to magnitude_type column
-                src_timepivot[magnitude_type] = src_timepivot[magnitude_type] + src_timepivot['intrinsic_mag']
-                # Pivot the time sequence back, to be vertical
-                src_timepivot = src_timepivot.stack(dropna=False)
-                # Drop columns we'll no longer use
-                src_timepivot.drop(['intrinsic_mag', 'd_time'], axis=1, inplace=True)
-                # As precaution, sort before storing updated apMag
-                src_timepivot.reset_index(inplace=True)
-                src_timepivot.sort_values(by=['filter', 'objectId', 'time_index'], inplace=True)
-                # Store filter-specific apMag values
-                apMag_filter[b] = src_timepivot[magnitude_type].values
-                gc.collect()
-
-            # Update apMag in source table, filter by filter
-            for b in 'ugriz':
-                src.loc[src['filter']==b, magnitude_type] = apMag_filter[b]
+        # Draw a damped random walk for every (object, band) light curve
+        # and every quasar image in one batch, and add it to the image magnitudes
+        magnitude_types = ['q_mag_' + str(q) for q in range(4)]
+        band_index = utils.get_band_index(src['filter'].values)
+        walk = self._get_intrinsic_variability(objectId=src['objectId'].values, ccdVisitId=src['ccdVisitId'].values,
+                                               band_index=band_index, MJD=src['MJD'].values,
+                                               num_images=len(magnitude_types))
+        src[magnitude_types] = src[magnitude_types].values + walk
+        self._realized_variability_state = self._get_variability_state(src['objectId'].values, band_index,
+                                                                       src['MJD'].values, walk)
+        del walk
 
-        gc.collect()
         if self.DEBUG:
             print("Result of adding time variability: ")
             print("Number of observations: ", src['MJD'].nunique())
             print("Number of objects: ", src['objectId'].nunique())
 
         src.set_index('objectId', inplace=True)
+        self.instrumentation.add_rows(len(src))
         end = time.time()
 
         print("Done adding time variability with %d row(s) in %0.2f seconds using vectorization." %(len(src), end-start))
         if save_output:
             print("Saving the new source table with time variability at %s" %output_source_path)
-            src.to_csv(output_source_path)
+            table_io.write_table(src, output_source_path, table_format=self.table_format)
 
         self.source_table = src
 
+    def _get_intrinsic_variability(self, objectId, ccdVisitId, band_index, MJD, num_images=4):
+        """
+        Returns damped random walk magnitude offsets of shape [n_rows, num_images]
+        (see variability.get_intrinsic_variability),
+        with the innovation of each row keyed on its objectId and ccdVisitId
+        """
+        normals = random_streams.get_standard_normals(self.seed, 'variability', objectId, ccdVisitId, num_draws=num_images)
+        initial_mag, initial_MJD = None, None
+        if self._variability_state is not None:
+            # Continue each light curve from its last stored epoch
+            state = self._variability_state
+            key = pd.MultiIndex.from_arrays([state['objectId'].values, state['band_index'].values])
+            state_rows = key.get_indexer(pd.MultiIndex.from_arrays([objectId, band_index]))
+            has_state = (state_rows >= 0)
+            initial_mag, initial_MJD = np.zeros((len(MJD), num_images)), np.full(len(MJD), np.nan)
+            initial_mag[has_state] = state[['walk_%d' %q for q in range(num_images)]].values[state_rows[has_state]]
+            initial_MJD[has_state] = state['MJD'].values[state_rows[has_state]]
+        return variability.get_intrinsic_variability(objectId=objectId, band_index=band_index, MJD=MJD,
+                                                     num_images=num_images, initial_mag=initial_mag, initial_MJD=initial_MJD,
+                                                     normals=normals.reshape(len(MJD), num_images))
+
+    def _get_variability_state(self, objectId, band_index, MJD, walk):
+        """
+        Returns the damped random walk state (the MJD and magnitude offset of each quasar image)
+        at the last epoch of each (object, band) light curve among the given rows
+
+        Keyword arguments:
+        objectId, band_index, MJD -- arrays of length n_rows identifying each row
+        walk -- array of shape [n_rows, num_images] of the magnitude offsets of the rows,
+                as returned by _get_intrinsic_variability
+
+        Returns:
+        a Pandas dataframe with columns objectId, band_index, MJD and walk_<q>,
+        or None if there are no rows
+        """
+        if len(MJD) == 0:
+            return None
+        order, is_first = variability.get_light_curve_order(objectId, band_index, MJD)
+        last = order[np.append(is_first[1:], True)]
+        state = pd.DataFrame({'objectId': objectId[last], 'band_index': band_index[last], 'MJD': MJD[last]},
+                             columns=['objectId', 'band_index', 'MJD'])
+        for q in range(walk.shape[1]):
+            state['walk_%d' %q] = walk[last, q]
+        return state
+
+    def _save_variability_state(self, source_table_path, states):
+        """
+        Saves alongside the source table at source_table_path the damped random walk state
+        of the light curves realized by this run, merged with any earlier state,
+        so that appended visits continue the light curves.
+
+        Keyword arguments:
+        source_table_path -- path of the source table
+        states -- list of the states of the realized blocks (see _get_variability_state), in row order
+        """
+        earlier = [] if self._variability_state is None else [self._variability_state]
+        states = earlier + [state for state in states if state is not None]
+        if states:
+            with self.instrumentation.stage('save_variability_state'):
+                state = pd.concat(states, ignore_index=True).drop_duplicates(['objectId', 'band_index'], keep='last')
+                table_io.write_table(state, table_io.get_sidecar_path(source_table_path, 'variability'),
+                                     table_format=self.table_format, index=False)
+
     def _include_moments(self, inplace=True, input_dict=None):
         """
         Adds columns of first and second moments (analytically computed)
@@ -487,71 +1297,29 @@ class SLRealizer(object):
             else:
                 raise ValueError("Keyword input_dict must be a dictionary and contain all the required keys.")
 
-        # Calculate flux ratios (for weighted moments)
-        src['lensFluxRatio'] = src['lens_flux']/src['apFlux']
-        for q in range(4):
-            src['qFluxRatio_' + str(q)] = src['q_flux_' + str(q)]/src['apFlux']
-        if not return_dict:
-            src.drop(['lens_flux'] + ['q_flux_' + str(q) for q in range(4)], axis=1, inplace=True)
-
-        #################
-        # FIRST MOMENTS #
-        #################
-        src['x'], src['y'] = 0.0, 0.0
-        for q in range(4):
-            src['x'] += src['qFluxRatio_' + str(q)]*src['XIMG_' + str(q)]
-            src['y'] += src['qFluxRatio_' + str(q)]*src['YIMG_' + str(q)]
-        if self.add_moment_noise:
-            src['x'] += utils.add_noise(mean=get_first_moment_err(),
-                                  stdev=get_first_moment_err_std(),
-                                  shape=src['x'].shape,
-                                  measurement=src['x'])
-            src['y'] += utils.add_noise(mean=get_first_moment_err(),
-                                  stdev=get_first_moment_err_std(),
-                                  shape=src['y'].shape,
-                                  measurement=src['y'])
-        ##################
-        # SECOND MOMENTS #
-        ##################
-        # Read in lens shape parameters
-        src['minor_to_major'] = np.power((1.0 - src['e'])/(1.0 + src['e']), 0.5) # q parameter in galsim.shear
-        src['beta'] = np.radians(src['beta']) # beta parameter in galsim.shear
-         # Arbitrarily set REFF_T to 1.0
-        #src['sigmasq_lens'] = np.power(utils.hlr_to_sigma(src['REFF_T']), 2.0)
-        src['sigmasq_lens'] = np.power(utils.hlr_to_sigma(1.0), 2.0)
-
-        # Initialize with lens contributions
-        src['lam1'] = src['sigmasq_lens']/src['minor_to_major']
-        src['lam2'] = src['sigmasq_lens']*src['minor_to_major']
-        src['lens_Ixx'] = src['lam1']*np.power(np.cos(src['beta']), 2.0) + src['lam2']*np.power(np.sin(src['beta']), 2.0)
-        src['lens_Iyy'] = src['lam1']*np.power(np.sin(src['beta']), 2.0) + src['lam2']*np.power(np.cos(src['beta']), 2.0)
-        src['lens_Ixy'] = (src['lam1'] - src['lam2'])*np.cos(src['beta'])*np.sin(src['beta'])
-        src['Ixx'] = src['lensFluxRatio']*(src['lens_Ixx'] + np.power(src['x'], 2.0))
-        src['Iyy'] = src['lensFluxRatio']*(src['lens_Iyy'] + np.power(src['y'], 2.0))
-        src['Ixy'] = src['lensFluxRatio']*(src['lens_Ixy'] - src['x']*src['y'])
-        if not return_dict:
-            src.drop(['lam1', 'lam2', 'lens_Ixx', 'lens_Iyy', 'lens_Ixy'], axis=1, inplace=True)
-        # Add quasar contributions
-        for q in range(4):
-            src['Ixx'] += src['qFluxRatio_' + str(q)]*(np.power(src['XIMG_' + str(q)] - src['x'], 2.0))
-            src['Iyy'] += src['qFluxRatio_' + str(q)]*(np.power(src['YIMG_' + str(q)] - src['y'], 2.0))
-            src['Ixy'] += src['qFluxRatio_' + str(q)]*(src['XIMG_' + str(q)] - src['x'])\
-                                                     *(src['YIMG_' + str(q)] - src['y'])
-        # Add PSF
-        src['sigmasq_psf'] = np.power(utils.fwhm_to_sigma(src['psf_fwhm']), 2.0)
-        src['Ixx'] += src['sigmasq_psf']
-        src['Iyy'] += src['sigmasq_psf']
-
-        # Get trace and ellipticities
-        src['trace'] = src['Ixx'] + src['Iyy']
-        if self.add_moment_noise:
-            src['trace'] += utils.add_noise(mean=get_second_moment_err(),
-                                      stdev=get_second_moment_err_std(),
-                                      shape=src['trace'].shape,
-                                      measurement=src['trace'])
-        src['e1'] = (src['Ixx'] - src['Iyy'])/src['trace']
-        src['e2'] = 2.0*src['Ixy']/src['trace']
-        src['e_final'], src['phi_final'] = utils.e1e2_to_ephi(src['e1'], src['e2'])
+        # One fused pass writing the moment columns, without intermediate columns
+        if return_dict:
+            get_column = lambda k: np.atleast_1d(src[k])
+        else:
+            get_column = lambda k: src[k].values
+        noise = {}
+        # Rows realized one at a time (input_dict) get their noise in create_source_row
+        if self.add_moment_noise and not return_dict:
+            noise['x_noise'], noise['y_noise'], noise['trace_noise'] = self._get_moment_noise(get_column('objectId'),
+                                                                                              get_column('ccdVisitId'))
+        moments = moments_utils.get_analytical_moments(lens_flux=get_column('lens_flux'), apFlux=get_column('apFlux'),
+                                                       q_flux=[get_column('q_flux_%d' %q) for q in range(4)],
+                                                       XIMG=[get_column('XIMG_%d' %q) for q in range(4)],
+                                                       YIMG=[get_column('YIMG_%d' %q) for q in range(4)],
+                                                       e=get_column('e'), beta=get_column('beta'),
+                                                       psf_fwhm=get_column('psf_fwhm'), **noise)
+        if return_dict:
+            for k in moments_utils.MOMENT_COLUMNS:
+                src[k] = moments[k][0]
+        else:
+            src.drop(['lens_flux'] + ['q_flux_%d' %q for q in range(4)], axis=1, inplace=True)
+            for k in moments_utils.MOMENT_COLUMNS:
+                src[k] = moments[k]
 
         if inplace:
             self.source_table = src
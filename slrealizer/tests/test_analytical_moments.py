@@ -218,5 +218,20 @@ class AnalyticalTest(unittest.TestCase):
         assert np.isclose(num_Iyy, Iyy, rtol=1.e-3)
         assert np.isclose(np.sum(galsim_img.array), total_flux)
 
+    def test_image_stack_moments(self):
+        """ Compares the moments of an image stack with those of each image """
+        images = []
+        for shift in [(0.0, 0.0), (-2.0, 2.4), (1.5, -0.5)]:
+            gal = galsim.Gaussian(sigma=self.gal_sigma, flux=self.gal_flux).shear(e1=self.gal_e1, e2=self.gal_e2).shift(shift)
+            images.append(gal.drawImage(scale=self.pixel_scale, nx=self.nx, ny=self.nx, method='no_pixel').array)
+        flux, Ix, Iy, Ixx, Ixy, Iyy = utils.get_moments_from_image_stack(np.array(images), pixel_scale=self.pixel_scale)
+        for i, image_array in enumerate(images):
+            num_Ix, num_Iy = utils.get_first_moments_from_image(image_array, pixel_scale=self.pixel_scale)
+            num_Ixx, num_Ixy, num_Iyy = utils.get_second_moments_from_image(image_array, pixel_scale=self.pixel_scale)
+            assert np.allclose([Ix[i], Iy[i], Ixx[i], Ixy[i], Iyy[i]], [num_Ix, num_Iy, num_Ixx, num_Ixy, num_Iyy])
+            assert np.isclose(flux[i], np.sum(image_array))
+            # Central moments do not depend on the position
+            assert np.allclose([Ixx[i], Ixy[i], Iyy[i]], [Ixx[0], Ixy[0], Iyy[0]], rtol=1.e-3)
+
 if __name__ == '__main__':
     unittest.main()
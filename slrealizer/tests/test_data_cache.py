@@ -0,0 +1,103 @@
+from __future__ import absolute_import, division, print_function
+
+import unittest
+import os
+import shutil
+import pandas as pd
+import numpy as np
+
+from slrealizer.data.cache import DataCache
+
+class DataCacheTest(unittest.TestCase):
+
+    """
+    Tests the local cache of remote input tables in data.cache.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        tests_dir = os.path.dirname(os.path.realpath(__file__))
+        cls.output_dir = os.path.join(tests_dir, 'test_output', 'test_data_cache')
+        if os.path.exists(cls.output_dir):
+            shutil.rmtree(cls.output_dir)
+        os.makedirs(cls.output_dir)
+
+        num_rows = 30
+        cls.table = pd.DataFrame({'obsHistID': np.arange(num_rows),
+                                  'expMJD': np.linspace(59580.0, 59980.0, num_rows),
+                                  'filter': np.tile(list('ugriz'), 6),
+                                  'FWHMeff': np.random.RandomState(123).uniform(0.5, 1.2, num_rows), })
+        csv_path = os.path.join(cls.output_dir, 'observation.csv')
+        cls.table.to_csv(csv_path, index=False)
+        cls.url = 'file://' + csv_path
+
+    def setUp(self):
+        self.cache_dir = os.path.join(self.output_dir, 'cache')
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+    def _check_table(self, df):
+        self.assertEqual(list(df.columns), list(self.table.columns))
+        self.assertTrue((df['filter'].values == self.table['filter'].values).all())
+        self.assertTrue(np.allclose(df[['obsHistID', 'expMJD', 'FWHMeff']].values,
+                                    self.table[['obsHistID', 'expMJD', 'FWHMeff']].values))
+
+    def test_cached_read(self):
+        """ Tests whether a cached table reads back the same, also offline """
+        self._check_table(DataCache(cache_dir=self.cache_dir).read_csv(self.url))
+        cached = DataCache(cache_dir=self.cache_dir, offline=True).read_csv(self.url)
+        # Numerical columns are read from the memory-mapped files, without copies
+        self.assertIsInstance(cached['expMJD'].values, np.memmap)
+        self._check_table(cached)
+        # which can be modified without changing the cache
+        cached['expMJD'] += 1.0
+        self._check_table(DataCache(cache_dir=self.cache_dir, offline=True).read_csv(self.url))
+
+    def test_offline_miss(self):
+        """ Tests whether offline mode refuses to download """
+        self.assertRaises(IOError, DataCache(cache_dir=self.cache_dir, offline=True).read_csv, self.url)
+
+    def test_corrupt_entry(self):
+        """ Tests whether a corrupt cached column is detected and downloaded again """
+        DataCache(cache_dir=self.cache_dir).read_csv(self.url)
+        entry_dir = [d for d in os.listdir(self.cache_dir) if os.path.isdir(os.path.join(self.cache_dir, d))][0]
+        with open(os.path.join(self.cache_dir, entry_dir, 'column_1.npy'), 'r+b') as f:
+            f.seek(-8, os.SEEK_END)
+            f.write(b'\x00'*8)
+        self.assertRaises(IOError, DataCache(cache_dir=self.cache_dir, offline=True).read_csv, self.url)
+        self._check_table(DataCache(cache_dir=self.cache_dir).read_csv(self.url))
+        self._check_table(DataCache(cache_dir=self.cache_dir, offline=True).read_csv(self.url))
+
+    def test_verify_entries(self):
+        """ Tests whether full verification detects a corrupt column whose size and modification time are unchanged """
+        DataCache(cache_dir=self.cache_dir).read_csv(self.url)
+        entry_dir = [d for d in os.listdir(self.cache_dir) if os.path.isdir(os.path.join(self.cache_dir, d))][0]
+        path = os.path.join(self.cache_dir, entry_dir, 'column_1.npy')
+        stat = os.stat(path)
+        with open(path, 'r+b') as f:
+            f.seek(-8, os.SEEK_END)
+            f.write(b'\x00'*8)
+        os.utime(path, (stat.st_atime, stat.st_mtime))
+        # Only checked against the size and modification time in the index
+        DataCache(cache_dir=self.cache_dir, offline=True).read_csv(self.url)
+        self.assertRaises(IOError, DataCache(cache_dir=self.cache_dir, offline=True, verify=True).read_csv, self.url)
+        self.assertEqual(DataCache(cache_dir=self.cache_dir).verify_entries(), [self.url])
+        self.assertRaises(IOError, DataCache(cache_dir=self.cache_dir, offline=True).read_csv, self.url)
+        self._check_table(DataCache(cache_dir=self.cache_dir).read_csv(self.url))
+        self.assertEqual(DataCache(cache_dir=self.cache_dir).verify_entries(), [])
+
+    def test_derived_table(self):
+        """ Tests whether a derived table is made once and then read from the cache """
+        calls = []
+        def make_table():
+            calls.append(1)
+            return self.table
+        for offline in [False, True]:
+            cache = DataCache(cache_dir=self.cache_dir, offline=offline)
+            self._check_table(cache.read_table('observation:v1', make_table))
+        self.assertEqual(len(calls), 1)
+        DataCache(cache_dir=self.cache_dir).read_table('observation:v2', make_table)
+        self.assertEqual(len(calls), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+from __future__ import absolute_import, division, print_function
+
+import unittest
+import numpy as np
+import galsim
+
+import slrealizer.utils.gaussian_render as gaussian_render
+
+class GaussianRenderTest(unittest.TestCase):
+
+    """
+    Tests the closed-form Gaussian renderer in utils.gaussian_render against GalSim.
+    """
+
+    def test_matches_galsim(self):
+        """ Compares a batch of rendered lens systems with GalSim's FFT convolution """
+        rng = np.random.RandomState(123)
+        num_systems, nx, ny, pixel_scale = 5, 49, 45, 0.1
+        lens_flux = rng.uniform(10.0, 50.0, num_systems)
+        e, beta = rng.uniform(0.0, 0.6, num_systems), rng.uniform(0.0, np.pi, num_systems)
+        quasar_flux = rng.uniform(1.0, 10.0, (num_systems, 4))
+        quasar_flux[0, 2:] = 0.0 # a double
+        quasar_x, quasar_y = rng.uniform(-1.5, 1.5, (2, num_systems, 4))
+        psf_fwhm = rng.uniform(0.5, 1.2, num_systems)
+
+        stamps = gaussian_render.render_lens_systems(lens_flux=lens_flux, lens_sigma=np.ones(num_systems), e=e, beta=beta,
+                                                     quasar_flux=quasar_flux, quasar_x=quasar_x, quasar_y=quasar_y,
+                                                     psf_fwhm=psf_fwhm, nx=nx, ny=ny, pixel_scale=pixel_scale)
+        self.assertEqual(stamps.shape, (num_systems, ny, nx))
+        for s in range(num_systems):
+            scene = galsim.Gaussian(sigma=1.0, flux=lens_flux[s]).shear(e=e[s], beta=beta[s]*galsim.radians)
+            for i in range(4):
+                scene += galsim.Gaussian(flux=quasar_flux[s, i], sigma=1.e-5).shift(quasar_x[s, i], quasar_y[s, i])
+            galsim_obj = galsim.Convolve([scene, galsim.Gaussian(flux=1.0, fwhm=psf_fwhm[s])],
+                                         gsparams=galsim.GSParams(maximum_fft_size=10240))
+            expected = galsim_obj.drawImage(nx=nx, ny=ny, scale=pixel_scale, method='no_pixel').array
+            self.assertTrue(np.allclose(stamps[s], expected, rtol=0.0, atol=1e-4*expected.max()))
+
+    def test_stamp_sizes(self):
+        """ Checks that the chosen stamps contain the flux fraction and the next smaller size does not """
+        rng = np.random.RandomState(7)
+        num_systems, pixel_scale, flux_fraction = 20, 0.1, 0.99
+        lens_flux = rng.uniform(0.0, 20.0, num_systems)
+        quasar_flux = rng.uniform(1.0, 10.0, (num_systems, 4))
+        quasar_x, quasar_y = rng.uniform(-3.0, 3.0, (2, num_systems, 4))
+        quasar_x[0], quasar_y[0] = 10.0, 0.0 # beyond the largest of STAMP_SIZES
+        # Round lenses, for which the containment bound is exact
+        scene = dict(lens_flux=lens_flux, lens_sigma=np.ones(num_systems), e=np.zeros(num_systems), beta=np.zeros(num_systems),
+                     quasar_flux=quasar_flux, quasar_x=quasar_x, quasar_y=quasar_y, psf_fwhm=rng.uniform(0.5, 1.2, num_systems))
+        sizes = gaussian_render.get_stamp_sizes(pixel_scale=pixel_scale, flux_fraction=flux_fraction, **scene)
+        self.assertTrue(sizes[0] > gaussian_render.STAMP_SIZES[-1])
+        self.assertTrue(set(sizes[1:]) <= set(gaussian_render.STAMP_SIZES))
+        total_flux = lens_flux + np.sum(quasar_flux, axis=1)
+        candidates = list(gaussian_render.STAMP_SIZES) + list(range(gaussian_render.STAMP_SIZES[-1] + 32, sizes[0] + 1, 32))
+        for s in range(num_systems):
+            system = dict((k, v[s:s + 1]) for k, v in scene.items())
+            stamp = gaussian_render.render_lens_systems(nx=sizes[s], ny=sizes[s], pixel_scale=pixel_scale, **system)[0]
+            # Pixel centers approximate the integral over the stamp
+            self.assertTrue(np.sum(stamp) >= (flux_fraction - 1.e-3)*total_flux[s])
+            smaller = candidates.index(sizes[s]) - 1
+            if smaller >= 0:
+                stamp = gaussian_render.render_lens_systems(nx=candidates[smaller], ny=candidates[smaller],
+                                                            pixel_scale=pixel_scale, **system)[0]
+                self.assertTrue(np.sum(stamp) < (flux_fraction + 1.e-3)*total_flux[s])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+from __future__ import absolute_import, division, print_function
+
+import unittest
+import numpy as np
+import galsim
+
+import slrealizer.utils.utils as utils
+import slrealizer.utils.hsm_batch as hsm_batch
+
+class HSMBatchTest(unittest.TestCase):
+
+    """
+    Tests the batched HSM measurements in utils.hsm_batch.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pixel_scale = 0.2
+        cls.nx, cls.ny = 45, 45
+        rng = np.random.RandomState(42)
+        cls.x, cls.y = rng.uniform(-0.5, 0.5, 6), rng.uniform(-0.5, 0.5, 6)
+        cls.sigma = rng.uniform(0.4, 0.8, 6)
+        stamps = []
+        for x, y, sigma in zip(cls.x, cls.y, cls.sigma):
+            gal = galsim.Gaussian(sigma=sigma, flux=100.0).shear(e1=0.1, e2=-0.05).shift(x, y)
+            stamps.append(gal.drawImage(nx=cls.nx, ny=cls.ny, scale=cls.pixel_scale, method='no_pixel').array)
+        # An empty stamp, on which HSM fails
+        stamps.append(np.zeros((cls.ny, cls.nx)))
+        cls.image_stack = np.array(stamps)
+
+    def get_guess(self):
+        # Round Gaussians: trace = 2 sigma^2
+        return hsm_batch.get_guess_from_moments(x=np.append(self.x, 0.0), y=np.append(self.y, 0.0),
+                                                trace=2.0*np.append(self.sigma, 0.5)**2.0,
+                                                nx=self.nx, ny=self.ny, pixel_scale=self.pixel_scale)
+
+    def test_guess_from_moments(self):
+        """ Checks the conversion of the moments into pixel guesses """
+        guess_sig, guess_x, guess_y = self.get_guess()
+        self.assertTrue(np.allclose(guess_sig[:-1], self.sigma/self.pixel_scale))
+        self.assertTrue(np.allclose(utils.pixel_to_physical(guess_x[:-1], self.nx, self.pixel_scale), self.x))
+        self.assertTrue(np.allclose(utils.pixel_to_physical(guess_y[:-1], self.ny, self.pixel_scale), self.y))
+
+    def test_measure_stamps(self):
+        """ Checks the measurements, the warm start and the failure reason """
+        guess_sig, guess_x, guess_y = self.get_guess()
+        warm = hsm_batch.measure_stamps(self.image_stack, pixel_scale=self.pixel_scale,
+                                        guess_sig=guess_sig, guess_x=guess_x, guess_y=guess_y, stamps_per_task=4)
+        cold = hsm_batch.measure_stamps(self.image_stack, pixel_scale=self.pixel_scale,
+                                        guess_sig=self.pixel_scale*10.0)
+        for columns in [warm, cold]:
+            self.assertEqual(sorted(columns), sorted(hsm_batch.HSM_COLUMNS))
+            self.assertTrue(np.allclose(columns['x'][:-1], self.x, atol=1.e-3))
+            self.assertTrue(np.allclose(columns['y'][:-1], self.y, atol=1.e-3))
+            self.assertTrue(np.allclose(columns['apFlux'][:-1], 100.0, rtol=1.e-2))
+            self.assertTrue(np.all(columns['hsm_failure'][:-1] == ''))
+            # The empty stamp
+            self.assertTrue(columns['hsm_failure'][-1] != '')
+            self.assertTrue(np.isnan(columns['trace'][-1]))
+            self.assertEqual(columns['hsm_n_iter'][-1], 0)
+        self.assertTrue(np.allclose(warm['e1'][:-1], cold['e1'][:-1], atol=1.e-5))
+        self.assertTrue(np.all(warm['hsm_n_iter'][:-1] <= cold['hsm_n_iter'][:-1]))
+
+    def test_n_workers(self):
+        """ Checks that the measurements do not depend on the number of workers """
+        guess_sig, guess_x, guess_y = self.get_guess()
+        serial = hsm_batch.measure_stamps(self.image_stack, pixel_scale=self.pixel_scale,
+                                          guess_sig=guess_sig, guess_x=guess_x, guess_y=guess_y)
+        parallel = hsm_batch.measure_stamps(self.image_stack, pixel_scale=self.pixel_scale,
+                                            guess_sig=guess_sig, guess_x=guess_x, guess_y=guess_y,
+                                            n_workers=2, stamps_per_task=2)
+        for k in hsm_batch.HSM_COLUMNS[:-1]:
+            self.assertTrue(np.array_equal(serial[k], parallel[k], equal_nan=True), k)
+        self.assertTrue(np.array_equal(serial['hsm_failure'], parallel['hsm_failure']))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import json
+import shutil
+import unittest
+import numpy as np
+
+from slrealizer.utils.instrumentation import Instrumentation
+
+def _has_module(name):
+    try:
+        __import__(name)
+        return True
+    except ImportError:
+        return False
+
+class InstrumentationTest(unittest.TestCase):
+
+    """
+    Tests the stage instrumentation in utils.instrumentation.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        test_dir = os.path.dirname(os.path.abspath(__file__))
+        cls.output_dir = os.path.join(test_dir, 'test_output', 'test_instrumentation')
+        if os.path.exists(cls.output_dir):
+            shutil.rmtree(cls.output_dir)
+        os.makedirs(cls.output_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.output_dir, ignore_errors=True)
+
+    def test_disabled(self):
+        """ Checks that nothing is recorded unless enabled """
+        instrumentation = Instrumentation()
+        with instrumentation.stage('realize', num_rows=10):
+            instrumentation.add_rows(5)
+        self.assertEqual(list(instrumentation.iter_stage('block', [[1], [2]])), [[1], [2]])
+        self.assertEqual(len(instrumentation.get_report()['stages']), 0)
+
+    def test_nested_stages(self):
+        """ Checks the calls, rows and nesting of the recorded stages """
+        instrumentation = Instrumentation(enabled=True)
+        for _ in range(2):
+            with instrumentation.stage('realize'):
+                blocks = [np.zeros(3), np.zeros(4)]
+                for block in instrumentation.iter_stage('realize_block', blocks):
+                    with instrumentation.stage('write_block', num_rows=len(block)):
+                        pass
+                    instrumentation.add_rows(len(block))
+        stages = instrumentation.get_report()['stages']
+        self.assertEqual(list(stages), ['realize', 'realize_block', 'write_block'])
+        self.assertEqual(stages['realize']['calls'], 2)
+        self.assertEqual(stages['realize_block']['calls'], 4)
+        self.assertEqual(stages['realize']['num_rows'], 14)
+        self.assertEqual(stages['write_block']['num_rows'], 14)
+        self.assertEqual(stages['write_block']['parent'], 'realize')
+        self.assertIsNone(stages['realize']['parent'])
+        self.assertTrue(stages['realize']['wall_time'] >= stages['write_block']['wall_time'])
+
+    def test_reentered_stage(self):
+        """ Checks that a stage entered again while open is recorded as one call """
+        instrumentation = Instrumentation(enabled=True)
+        with instrumentation.stage('realize'):
+            with instrumentation.stage('realize'):
+                instrumentation.add_rows(5)
+        stages = instrumentation.get_report()['stages']
+        self.assertEqual(stages['realize']['calls'], 1)
+        self.assertEqual(stages['realize']['num_rows'], 5)
+        self.assertEqual(stages['realize']['parent'], None)
+
+    def test_report(self):
+        """ Checks the JSON report written at the end of each outermost stage """
+        report_path = os.path.join(self.output_dir, 'report.json')
+        instrumentation = Instrumentation(enabled=True, report_path=report_path)
+        with instrumentation.stage('realize', num_rows=100):
+            pass
+        with open(report_path) as f:
+            report = json.load(f)
+        self.assertEqual(report['stages']['realize']['num_rows'], 100)
+        self.assertTrue('rows_per_sec' in report['stages']['realize'])
+        self.assertEqual(len(instrumentation.format_report().splitlines()), 2)
+
+    @unittest.skipIf(not _has_module('tracemalloc'), "tracemalloc is not available")
+    def test_trace_memory(self):
+        """ Checks that the allocations of each stage are traced """
+        instrumentation = Instrumentation(enabled=True, trace_memory=True)
+        with instrumentation.stage('allocate'):
+            with instrumentation.stage('allocate_inner'):
+                kept = np.ones(2**20) # 8 MB
+            del kept
+        stages = instrumentation.get_report()['stages']
+        self.assertTrue(stages['allocate_inner']['tracemalloc_delta_mb'] > 7.0)
+        self.assertTrue(stages['allocate']['tracemalloc_peak_mb'] > 7.0)
+        self.assertTrue(stages['allocate']['tracemalloc_delta_mb'] < 1.0)
+
+    def test_profile(self):
+        """ Checks that a cProfile capture of each outermost stage is saved """
+        import pstats
+        profile_dir = os.path.join(self.output_dir, 'profiles')
+        instrumentation = Instrumentation(enabled=True, profile_dir=profile_dir)
+        with instrumentation.stage('realize'):
+            with instrumentation.stage('realize_inner'):
+                np.sort(np.random.uniform(size=1000))
+        stages = instrumentation.get_report()['stages']
+        self.assertEqual(stages['realize']['profile_path'], os.path.join(profile_dir, 'realize.prof'))
+        self.assertIsNone(stages['realize_inner']['profile_path'])
+        pstats.Stats(stages['realize']['profile_path'])
+
+if __name__ == '__main__':
+    unittest.main()
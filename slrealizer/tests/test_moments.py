@@ -0,0 +1,84 @@
+from __future__ import absolute_import, division, print_function
+
+import unittest
+import numpy as np
+
+import slrealizer.utils.utils as utils
+import slrealizer.utils.moments as moments
+
+class MomentsTest(unittest.TestCase):
+
+    """
+    Tests the fused analytical moment kernel in utils.moments.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.RandomState(123)
+        num_rows = 40000 # spans several blocks
+        cls.inputs = {'lens_flux': rng.uniform(1.0, 10.0, num_rows),
+                      'q_flux': rng.uniform(0.0, 5.0, (num_rows, 4)),
+                      'XIMG': rng.uniform(-1.5, 1.5, (num_rows, 4)),
+                      'YIMG': rng.uniform(-1.5, 1.5, (num_rows, 4)),
+                      'e': rng.uniform(0.0, 0.5, num_rows),
+                      'beta': rng.uniform(-90.0, 90.0, num_rows),
+                      'psf_fwhm': rng.uniform(0.5, 1.2, num_rows), }
+        cls.inputs['apFlux'] = cls.inputs['lens_flux'] + np.sum(cls.inputs['q_flux'], axis=1)
+
+    def get_expected(self, x_noise=0.0, y_noise=0.0, trace_noise=0.0):
+        """ Returns the moments evaluated term by term on whole arrays """
+        p = self.inputs
+        q_ratio = p['q_flux']/p['apFlux'][:, np.newaxis]
+        lens_ratio = p['lens_flux']/p['apFlux']
+        x = np.sum(q_ratio*p['XIMG'], axis=1)
+        y = np.sum(q_ratio*p['YIMG'], axis=1)
+        x, y = x*(1.0 + x_noise), y*(1.0 + y_noise)
+        lens_Ixx, lens_Iyy, lens_Ixy = self.get_lens_covariance()
+        Ixx = lens_ratio*(lens_Ixx + x*x) + np.sum(q_ratio*(p['XIMG'] - x[:, np.newaxis])**2.0, axis=1)
+        Iyy = lens_ratio*(lens_Iyy + y*y) + np.sum(q_ratio*(p['YIMG'] - y[:, np.newaxis])**2.0, axis=1)
+        Ixy = lens_ratio*(lens_Ixy - x*y) + np.sum(q_ratio*(p['XIMG'] - x[:, np.newaxis])*(p['YIMG'] - y[:, np.newaxis]), axis=1)
+        sigmasq_psf = utils.fwhm_to_sigma(p['psf_fwhm'])**2.0
+        trace = (Ixx + Iyy + 2.0*sigmasq_psf)*(1.0 + trace_noise)
+        e1, e2 = (Ixx - Iyy)/trace, 2.0*Ixy/trace
+        e_final, phi_final = utils.e1e2_to_ephi(e1, e2)
+        return {'x': x, 'y': y, 'trace': trace, 'e1': e1, 'e2': e2, 'e_final': e_final, 'phi_final': phi_final}
+
+    def get_lens_covariance(self):
+        q = np.sqrt((1.0 - self.inputs['e'])/(1.0 + self.inputs['e']))
+        beta = np.radians(self.inputs['beta'])
+        sigmasq = utils.hlr_to_sigma(1.0)**2.0
+        lam1, lam2 = sigmasq/q, sigmasq*q
+        return (lam1*np.cos(beta)**2.0 + lam2*np.sin(beta)**2.0,
+                lam1*np.sin(beta)**2.0 + lam2*np.cos(beta)**2.0,
+                (lam1 - lam2)*np.cos(beta)*np.sin(beta))
+
+    def test_matches_reference(self):
+        """ Compares the blocked kernel with the moments evaluated on whole arrays """
+        result = moments.get_analytical_moments(**self.inputs)
+        expected = self.get_expected()
+        for k in moments.MOMENT_COLUMNS:
+            self.assertTrue(np.allclose(result[k], expected[k], rtol=1e-12, atol=1e-14), k)
+
+    def test_noise(self):
+        """ Checks that the fractional noise enters the first moments and the trace """
+        rng = np.random.RandomState(0)
+        noise = dict((k, rng.normal(0.0, 0.01, len(self.inputs['apFlux']))) for k in ['x_noise', 'y_noise', 'trace_noise'])
+        result = moments.get_analytical_moments(**dict(self.inputs, **noise))
+        expected = self.get_expected(**noise)
+        for k in moments.MOMENT_COLUMNS:
+            self.assertTrue(np.allclose(result[k], expected[k], rtol=1e-12, atol=1e-14), k)
+
+    def test_column_inputs_and_out(self):
+        """ Checks that per-image columns and preallocated outputs give the same moments """
+        inputs = dict(self.inputs)
+        for k in ['q_flux', 'XIMG', 'YIMG']:
+            inputs[k] = [np.ascontiguousarray(inputs[k][:, q]) for q in range(4)]
+        out = dict((k, np.empty(len(inputs['apFlux']))) for k in moments.MOMENT_COLUMNS)
+        result = moments.get_analytical_moments(out=out, **inputs)
+        expected = moments.get_analytical_moments(**self.inputs)
+        for k in moments.MOMENT_COLUMNS:
+            self.assertTrue(result[k] is out[k])
+            self.assertTrue(np.array_equal(result[k], expected[k]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+from __future__ import absolute_import, division, print_function
+
+import unittest
+import numpy as np
+import pandas as pd
+
+from slrealizer.utils.observation_index import ObservationIndex
+
+class ObservationIndexTest(unittest.TestCase):
+
+    """
+    Tests the indexed lookups and selections of utils.observation_index.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.RandomState(42)
+        num_obs = 1000
+        cls.observation = pd.DataFrame({'obsHistID': rng.permutation(num_obs) + 100,
+                                        'expMJD': rng.uniform(59580.0, 60580.0, num_obs),
+                                        'filter': rng.choice(list('ugrizy'), num_obs), })
+        cls.index = ObservationIndex(cls.observation)
+
+    def get_expected(self, mjd_windows, filters):
+        """ Returns the rows selected by a full boolean scan """
+        MJD = self.observation['expMJD'].values
+        in_windows = np.zeros(len(MJD), dtype=bool)
+        for start, end in mjd_windows:
+            in_windows |= (MJD >= start) & (MJD < end)
+        return np.flatnonzero(in_windows & self.observation['filter'].isin(list(filters)).values)
+
+    def test_get_rows(self):
+        """ Checks the lookups by obsHistID, in the order of the given IDs """
+        obsHistID = self.observation['obsHistID'].values
+        for row in [0, 17, 999]:
+            self.assertEqual(list(self.index.get_rows(obsHistID[row])), [row])
+        rows = self.index.get_rows([obsHistID[5], -1, obsHistID[3]])
+        self.assertEqual(list(rows), [5, 3])
+
+    def test_select(self):
+        """ Checks the selections by MJD windows and filters against a full scan """
+        self.assertTrue(np.array_equal(self.index.select(), np.arange(len(self.observation))))
+        self.assertEqual(self.index.get_filters(), sorted('ugrizy'))
+        for mjd_windows, filters in [([(59800.0, 59900.0)], 'r'),
+                                     ([(59600.0, 59700.0), (60000.0, 60200.0)], 'gri'),
+                                     ([(59600.0, 59800.0), (59700.0, 59900.0)], 'ugrizy'), # overlapping windows
+                                     ([(60600.0, 60700.0)], 'ugrizy'), ]: # nothing
+            rows = self.index.select(mjd_windows=mjd_windows, filters=filters)
+            self.assertTrue(np.array_equal(rows, self.get_expected(mjd_windows, filters)))
+        rows = self.index.select(mjd_windows=(59800.0, 59900.0))
+        self.assertTrue(np.array_equal(rows, self.get_expected([(59800.0, 59900.0)], 'ugrizy')))
+        self.assertEqual(len(self.index.select(filters=['Y'])), 0)
+
+if __name__ == '__main__':
+    unittest.main()
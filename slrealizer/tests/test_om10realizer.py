@@ -38,8 +38,16 @@ class OM10RealizerTest(unittest.TestCase):
         'rowbyrow_analytical_path': os.path.join(output_dir, 'rowbyrow_ana_source.csv'),
         'rowbyrow_hsm_numerical_path': os.path.join(output_dir, 'rowbyrow_hsm_num_source.csv'),
         'rowbyrow_raw_numerical_path': os.path.join(output_dir, 'rowbyrow_raw_num_source.csv'),
+        'rowbyrow_numpy_render_path': os.path.join(output_dir, 'rowbyrow_numpy_render_source.csv'),
+        'adaptive_galsim_path': os.path.join(output_dir, 'adaptive_galsim_source.csv'),
+        'adaptive_numpy_path': os.path.join(output_dir, 'adaptive_numpy_source.csv'),
         'vectorized_path': os.path.join(output_dir, 'vectorized_source.csv'),
+        'chunked_path': os.path.join(output_dir, 'chunked_source.csv'),
+        'parallel_path': os.path.join(output_dir, 'parallel_source.csv'),
         'object_path': os.path.join(output_dir, 'object.csv'),
+        'streamed_object_path': os.path.join(output_dir, 'streamed_object.csv'),
+        'appended_path': os.path.join(output_dir, 'appended_source.csv'),
+        'appended_object_path': os.path.join(output_dir, 'appended_object.csv'),
         }
 
         for k, v in output_paths.items():
@@ -63,6 +71,22 @@ class OM10RealizerTest(unittest.TestCase):
         """ Tests whether draw_system method runs """ 
         self.realizer.draw_system(lens_info=self.lens_info, obs_info=self.obs_info)
 
+    def test_psf_cache(self):
+        """ Checks that systems drawn under one observation share its PSF """
+        import galsim
+        lens_info = self.realizer._om10_to_galsim(self.lens_info, self.obs_info['filter'])
+        first = self.realizer.draw_system(lens_info=self.lens_info, obs_info=self.obs_info)
+        psf = self.realizer._get_psf(self.obs_info['FWHMeff'])
+        self.assertTrue(self.realizer._get_psf(self.obs_info['FWHMeff']) is psf)
+        self.assertTrue(np.array_equal(self.realizer.draw_system(lens_info=self.lens_info, obs_info=self.obs_info).array, first.array))
+        # Same image as a scene convolved with a new PSF
+        scene = galsim.Gaussian(sigma=1.0, flux=lens_info['flux']).shear(e=lens_info['e'], beta=lens_info['beta'])
+        for i in range(lens_info['num_objects']):
+            scene += galsim.Gaussian(flux=lens_info['flux_'+str(i)], sigma=1.e-5).shift(lens_info['xy_'+str(i)])
+        expected = galsim.Convolve([scene, galsim.Gaussian(flux=1.0, fwhm=self.obs_info['FWHMeff'])], gsparams=self.realizer.fft_params)\
+                         .drawImage(nx=self.realizer.nx, ny=self.realizer.ny, scale=self.realizer.pixel_scale, method='no_pixel')
+        self.assertTrue(np.array_equal(first.array, expected.array))
+
     def test_estimate_hsm(self):
         """ Tests whether estimate_parameters method runs """ 
         self.realizer.estimate_parameters(lens_info=self.lens_info, obs_info=self.obs_info)
@@ -86,6 +110,65 @@ class OM10RealizerTest(unittest.TestCase):
         """
         self.realizer.make_source_table_rowbyrow(save_file=self.rowbyrow_raw_numerical_path, method="raw_numerical")
         self.realizer.make_source_table_rowbyrow(save_file=self.rowbyrow_hsm_numerical_path, method="hsm")
+        # One row per failed HSM measurement, with its reason
+        source_table = pd.read_csv(self.rowbyrow_hsm_numerical_path)
+        self.assertEqual(list(self.realizer.hsm_failures.columns), ['objectId', 'ccdVisitId', 'hsm_failure'])
+        self.assertEqual(len(source_table) + len(self.realizer.hsm_failures), self.realizer.num_systems*self.realizer.num_obs)
+
+    def test_numpy_render_backend(self):
+        """
+        Tests whether the numpy render backend reproduces the GalSim images
+        and the raw_numerical source table
+        """
+        galsim_img = self.realizer.draw_system(lens_info=self.lens_info, obs_info=self.obs_info)
+        galsim_table = self.realizer.make_source_table_rowbyrow(save_file=self.rowbyrow_raw_numerical_path, method="raw_numerical")
+        self.realizer.render_backend = 'numpy'
+        try:
+            numpy_img = self.realizer.draw_system(lens_info=self.lens_info, obs_info=self.obs_info)
+            numpy_table = self.realizer.make_source_table_rowbyrow(save_file=self.rowbyrow_numpy_render_path, method="raw_numerical")
+        finally:
+            self.realizer.render_backend = 'galsim'
+
+        self.assertTrue(np.allclose(numpy_img.array, galsim_img.array, rtol=0.0, atol=1e-4*galsim_img.array.max()))
+        self.assertTrue(np.allclose(numpy_table.select_dtypes(include=[np.number]).values,
+                                    galsim_table.select_dtypes(include=[np.number]).values, rtol=1e-4, atol=1e-5))
+
+    def test_stamp_cache_settings(self):
+        """
+        Tests whether realizers sharing a stamp cache directory with different
+        stamp sizes and pixel scales draw their own stamps
+        """
+        cache_dir = os.path.join(os.path.dirname(self.vectorized_path), 'stamps')
+        for adaptive_stamps, pixel_scale in [(False, 0.1), (True, 0.1), (False, 0.2)]:
+            realizer = OM10Realizer(observation=self.realizer.observation, catalog=self.realizer.catalog)
+            realizer.adaptive_stamps, realizer.pixel_scale = adaptive_stamps, pixel_scale
+            realizer.enable_stamp_cache(cache_dir=cache_dir)
+            galsim_img = realizer.draw_system(lens_info=self.lens_info, obs_info=self.obs_info)
+            realizer.stamp_cache = None
+            expected = realizer.draw_system(lens_info=self.lens_info, obs_info=self.obs_info)
+            self.assertEqual(galsim_img.array.shape, expected.array.shape)
+            self.assertEqual(galsim_img.scale, pixel_scale)
+
+    def test_adaptive_stamps(self):
+        """
+        Tests whether adaptive stamps are drawn at the size given by get_stamp_sizes
+        and give the same raw_numerical source table with both render backends
+        """
+        lens_info = self.realizer._om10_to_galsim(self.lens_info, self.obs_info['filter'])
+        self.realizer.adaptive_stamps = True
+        try:
+            nx, ny = self.realizer.get_stamp_sizes(lens_infos=[lens_info], psf_fwhms=[self.obs_info['FWHMeff']])
+            galsim_img = self.realizer.draw_system(lens_info=self.lens_info, obs_info=self.obs_info)
+            galsim_table = self.realizer.make_source_table_rowbyrow(save_file=self.adaptive_galsim_path, method="raw_numerical")
+            self.realizer.render_backend = 'numpy'
+            numpy_table = self.realizer.make_source_table_rowbyrow(save_file=self.adaptive_numpy_path, method="raw_numerical")
+        finally:
+            self.realizer.adaptive_stamps = False
+            self.realizer.render_backend = 'galsim'
+
+        self.assertEqual(galsim_img.array.shape, (ny[0], nx[0]))
+        self.assertTrue(np.allclose(numpy_table.select_dtypes(include=[np.number]).values,
+                                    galsim_table.select_dtypes(include=[np.number]).values, rtol=1e-4, atol=1e-5))
 
     def test_make_source_table_analytical(self):
         """ 
@@ -104,10 +187,201 @@ class OM10RealizerTest(unittest.TestCase):
 
         self.assertTrue(np.allclose(rowbyrow_float, vectorized_float, rtol=1e-05, atol=1e-05))
 
+    def test_make_source_table_numpy_engine(self):
+        """
+        Tests whether the numpy engine of make_source_table_vectorized
+        reproduces the original pandas implementation
+        """
+        numpy_engine = self.realizer.make_source_table_vectorized(output_source_path=self.vectorized_path, include_time_variability=False, engine='numpy')
+        pandas_engine = self.realizer.make_source_table_vectorized(output_source_path=self.vectorized_path, include_time_variability=False, engine='pandas')
+
+        self.assertEqual(list(numpy_engine.columns), list(pandas_engine.columns))
+        self.assertTrue((numpy_engine.index.values == pandas_engine.index.values).all())
+        self.assertTrue((numpy_engine['filter'].values == pandas_engine['filter'].values).all())
+        self.assertTrue(np.allclose(numpy_engine.select_dtypes(include=[np.number]).values,
+                                    pandas_engine.select_dtypes(include=[np.number]).values))
+
+    def test_make_source_table_chunked(self):
+        """
+        Tests whether realizing the source table in blocks of rows
+        writes the same file as the monolithic run
+        """
+        self.realizer.make_source_table_vectorized(output_source_path=self.vectorized_path, include_time_variability=False)
+        for chunk_size in [1, 7, 1000]:
+            self.realizer.make_source_table_vectorized(output_source_path=self.chunked_path, include_time_variability=False, chunk_size=chunk_size)
+            with open(self.vectorized_path) as monolithic, open(self.chunked_path) as chunked:
+                self.assertEqual(monolithic.read(), chunked.read())
+
+    def test_make_source_table_parallel(self):
+        """
+        Tests whether the sharded source table is in the monolithic row order
+        and does not depend on the number of worker processes
+        """
+        self.realizer.make_source_table_vectorized(output_source_path=self.vectorized_path, include_time_variability=False)
+        for n_workers in [1, 2]:
+            self.realizer.make_source_table_vectorized(output_source_path=self.parallel_path, include_time_variability=False, chunk_size=7, n_workers=n_workers)
+            with open(self.vectorized_path) as monolithic, open(self.parallel_path) as parallel:
+                self.assertEqual(monolithic.read(), parallel.read())
+
+    def test_cached_catalog(self):
+        """
+        Tests whether the catalog read again from the Dataloader cache
+        realizes the same source table and keeps the full OM10 sample
+        """
+        from slrealizer import Dataloader
+        cached_db = Dataloader().read(filename='om10', is_test=True)
+        cached_realizer = OM10Realizer(observation=self.realizer.observation, catalog=cached_db,
+                                       add_moment_noise=False, add_flux_noise=False)
+        self.realizer.make_source_table_vectorized(output_source_path=self.vectorized_path, include_time_variability=False)
+        cached_realizer.make_source_table_vectorized(output_source_path=self.parallel_path, include_time_variability=False)
+        with open(self.vectorized_path) as original, open(self.parallel_path) as cached:
+            self.assertEqual(original.read(), cached.read())
+        self.assertEqual(cached_realizer.num_systems, self.realizer.num_systems)
+        # Neither the vectorized run nor num_systems reads the sample of a cache hit
+        self.assertIsNone(vars(cached_db).get('_db'))
+        self.assertEqual(cached_db.sample.colnames, self.realizer.catalog.sample.colnames)
+
+    def test_keyed_noise(self):
+        """
+        Tests whether, with noise and time variability, the chunked and sharded source tables
+        and a run with a reseeded global generator reproduce the monolithic run
+        """
+        noisy_realizer = OM10Realizer(observation=self.realizer.observation, catalog=self.realizer.catalog,
+                                      add_moment_noise=True, add_flux_noise=True)
+        noisy_realizer.make_source_table_vectorized(output_source_path=self.vectorized_path, include_time_variability=True)
+        np.random.seed(321)
+        for chunk_size, n_workers in [(None, None), (7, None), (7, 2)]:
+            noisy_realizer.make_source_table_vectorized(output_source_path=self.parallel_path, include_time_variability=True,
+                                                        chunk_size=chunk_size, n_workers=n_workers)
+            with open(self.vectorized_path) as monolithic, open(self.parallel_path) as parallel:
+                self.assertEqual(monolithic.read(), parallel.read())
+
+    def test_select_observations(self):
+        """
+        Tests whether realizing a selection of MJD windows and filters
+        reproduces the corresponding rows of the full run, with noise
+        """
+        noisy_realizer = OM10Realizer(observation=self.realizer.observation, catalog=self.realizer.catalog,
+                                      add_moment_noise=True, add_flux_noise=True)
+        noisy_realizer.make_source_table_vectorized(output_source_path=self.vectorized_path, include_time_variability=False)
+        full = pd.read_csv(self.vectorized_path)
+        MJD = self.realizer.observation['expMJD']
+        mjd_windows = [(MJD.min(), MJD.median()), (MJD.quantile(0.75), MJD.max() + 1.0)]
+        filters = sorted(set(self.realizer.observation['filter']))[:2]
+        noisy_realizer.make_source_table_vectorized(output_source_path=self.parallel_path, include_time_variability=False,
+                                                    mjd_windows=mjd_windows, filters=filters)
+        selected = pd.read_csv(self.parallel_path)
+        in_windows = np.zeros(len(full), dtype=bool)
+        for start, end in mjd_windows:
+            in_windows |= (full['MJD'] >= start) & (full['MJD'] < end)
+        expected = full.loc[in_windows & full['filter'].isin(filters)]
+        self.assertTrue(len(selected) > 0)
+        self.assertEqual(len(selected), len(expected))
+        self.assertTrue(np.array_equal(np.sort(selected['ccdVisitId'].values), np.sort(expected['ccdVisitId'].values)))
+        key = ['objectId', 'ccdVisitId']
+        selected, expected = selected.sort_values(key).reset_index(drop=True), expected.sort_values(key).reset_index(drop=True)
+        pd.testing.assert_frame_equal(selected, expected)
+
+    def test_append_observations(self):
+        """
+        Tests whether appending the later visits to the source table of the earlier ones
+        reproduces the full run, with noise and time variability,
+        and whether the updated object table matches the one made from the full source table
+        """
+        observation, catalog = self.realizer.observation, self.realizer.catalog
+        full_realizer = OM10Realizer(observation=observation, catalog=catalog, add_moment_noise=True, add_flux_noise=True)
+        full_realizer.make_source_table_vectorized(output_source_path=self.vectorized_path, include_time_variability=True)
+        full_realizer.make_object_table(include_std=True, source_table_path=self.vectorized_path, object_table_path=self.object_path)
+
+        earlier = observation.loc[observation['expMJD'] < observation['expMJD'].median()]
+        earlier_realizer = OM10Realizer(observation=earlier, catalog=catalog, add_moment_noise=True, add_flux_noise=True)
+        earlier_realizer.make_source_table_vectorized(output_source_path=self.appended_path, include_time_variability=True)
+        earlier_realizer.make_object_table(include_std=True, source_table_path=self.appended_path,
+                                           object_table_path=self.appended_object_path, update=True)
+        full_realizer.make_source_table_vectorized(output_source_path=self.appended_path, include_time_variability=True, append=True)
+        full_realizer.make_object_table(include_std=True, source_table_path=self.appended_path,
+                                        object_table_path=self.appended_object_path, update=True)
+
+        key = ['objectId', 'ccdVisitId']
+        full, appended = pd.read_csv(self.vectorized_path), pd.read_csv(self.appended_path)
+        pd.testing.assert_frame_equal(appended.sort_values(key).reset_index(drop=True), full.sort_values(key).reset_index(drop=True))
+        full_object, updated_object = pd.read_csv(self.object_path), pd.read_csv(self.appended_object_path)
+        self.assertEqual(list(full_object.columns), list(updated_object.columns))
+        self.assertTrue(np.allclose(full_object.values, updated_object.values))
+
     def test_make_object_table(self):
         """ Tests whether make_object_table runs """
         self.realizer.make_source_table_vectorized(output_source_path=self.vectorized_path, include_time_variability=False)
         self.realizer.make_object_table(include_std=False, source_table_path=self.vectorized_path, object_table_path=self.object_path)
 
+    def test_make_object_table_engines(self):
+        """
+        Tests whether the numpy engine of make_object_table
+        reproduces the original pivot_table implementation
+        """
+        self.realizer.make_source_table_vectorized(output_source_path=self.vectorized_path, include_time_variability=False)
+        for include_std in [False, True]:
+            self.realizer.make_object_table(include_std=include_std, source_table_path=self.vectorized_path, object_table_path=self.object_path, engine='pandas')
+            self.realizer.make_object_table(include_std=include_std, source_table_path=self.vectorized_path, object_table_path=self.streamed_object_path, engine='numpy')
+            pandas_engine, numpy_engine = pd.read_csv(self.object_path), pd.read_csv(self.streamed_object_path)
+            self.assertEqual(list(pandas_engine.columns), list(numpy_engine.columns))
+            self.assertTrue(np.allclose(pandas_engine.values, numpy_engine.values))
+
+    def test_make_object_table_streaming(self):
+        """
+        Tests whether the object table made by streaming the source table in chunks
+        matches the one made from the whole source table
+        """
+        self.realizer.make_source_table_vectorized(output_source_path=self.vectorized_path, include_time_variability=False)
+        for include_std in [False, True]:
+            self.realizer.make_object_table(include_std=include_std, source_table_path=self.vectorized_path, object_table_path=self.object_path)
+            self.realizer.make_object_table(include_std=include_std, source_table_path=self.vectorized_path, object_table_path=self.streamed_object_path, chunk_rows=7)
+            in_memory, streamed = pd.read_csv(self.object_path), pd.read_csv(self.streamed_object_path)
+            self.assertEqual(list(in_memory.columns), list(streamed.columns))
+            self.assertTrue(np.allclose(in_memory.values, streamed.values))
+
+    def test_compact_dtypes(self):
+        """
+        Tests whether the compact schema stores float32 measurements, a categorical filter
+        and int32 IDs, within the documented precision of the float64 tables
+        """
+        full = self.realizer.make_source_table_vectorized(output_source_path=self.vectorized_path, include_time_variability=False)
+        self.realizer.make_object_table(include_std=True, object_table_path=self.object_path)
+        self.realizer.compact_dtypes = True
+        try:
+            compact = self.realizer.make_source_table_vectorized(output_source_path=self.vectorized_path, include_time_variability=False)
+            self.realizer.make_object_table(include_std=True, object_table_path=self.streamed_object_path)
+        finally:
+            self.realizer.compact_dtypes = False
+        self.assertEqual(compact['apMag'].dtype, np.float32)
+        self.assertEqual(compact['MJD'].dtype, np.float64)
+        self.assertEqual(compact['ccdVisitId'].dtype, np.int32)
+        self.assertEqual(list(compact['filter'].cat.categories), list('ugriz'))
+        self.assertTrue((compact['filter'].astype(str).values == full['filter'].values).all())
+        self.assertTrue(np.allclose(compact['apMag'].values, full['apMag'].values, rtol=0.0, atol=2e-6))
+        for e in ['e1', 'e2']:
+            self.assertTrue(np.allclose(compact[e].values, full[e].values, rtol=0.0, atol=1e-7))
+        full_object, compact_object = pd.read_csv(self.object_path), pd.read_csv(self.streamed_object_path)
+        self.assertEqual(list(full_object.columns), list(compact_object.columns))
+        self.assertTrue(np.allclose(full_object.values, compact_object.values, rtol=1e-6, atol=1e-6))
+
+    def test_instrumentation(self):
+        """ Tests whether the stages of a realization are recorded once instrumentation is enabled """
+        from slrealizer.utils.instrumentation import Instrumentation
+
+        instrumentation = self.realizer.enable_instrumentation()
+        try:
+            self.realizer.make_source_table_vectorized(output_source_path=self.vectorized_path, include_time_variability=False, chunk_size=7)
+            self.realizer.make_object_table(source_table_path=self.vectorized_path, object_table_path=self.object_path)
+            stages = instrumentation.get_report()['stages']
+        finally:
+            self.realizer.instrumentation = Instrumentation()
+        num_rows = len(pd.read_csv(self.vectorized_path))
+        self.assertEqual(stages['make_source_table_vectorized']['num_rows'], num_rows)
+        self.assertEqual(stages['realize_source_block']['num_rows'], num_rows)
+        self.assertEqual(stages['write_source_block']['parent'], 'make_source_table_vectorized')
+        self.assertEqual(stages['read_source_table']['parent'], 'aggregate_object_table')
+        self.assertEqual(stages['make_object_table']['calls'], 1)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,50 @@
+from __future__ import absolute_import, division, print_function
+
+import unittest
+import numpy as np
+
+import slrealizer.utils.random_streams as random_streams
+
+class RandomStreamsTest(unittest.TestCase):
+
+    """
+    Tests the counter-based noise generator in utils.random_streams.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        num_rows = 100000
+        cls.objectId = 5000 + np.arange(num_rows)//50
+        cls.ccdVisitId = np.tile(np.arange(50), num_rows//50)
+
+    def test_philox_known_answers(self):
+        """ Checks Philox4x32-10 against the known-answer vectors of Random123 """
+        for counter, key, expected in [((0, 0, 0, 0), (0, 0), (0x6627e8d5, 0xe169c58d, 0xbc57ac4c, 0x9b00dbd8)),
+                                       ((0xffffffff, )*4, (0xffffffff, 0xffffffff), (0x408f276d, 0x41c83b0e, 0xa20bc7c6, 0x6d5451fd)),
+                                       ((0x243f6a88, 0x85a308d3, 0x13198a2e, 0x03707344), (0xa4093822, 0x299f31d0),
+                                        (0xd16cfe09, 0x94fdcceb, 0x5001e420, 0x24126ea1))]:
+            words = random_streams.philox4x32([np.array([c]) for c in counter], key)
+            self.assertEqual(tuple(int(w[0]) for w in words), expected)
+
+    def test_keyed_per_row(self):
+        """ Checks that the noise of a row does not depend on the other rows drawn with it """
+        normals = random_streams.get_standard_normals(123, 'variability', self.objectId, self.ccdVisitId, num_draws=4)
+        rows = np.random.RandomState(0).permutation(len(self.objectId))[:777]
+        subset = random_streams.get_standard_normals(123, 'variability', self.objectId[rows], self.ccdVisitId[rows], num_draws=4)
+        self.assertTrue(np.array_equal(normals[rows], subset))
+        single = random_streams.get_standard_normals(123, 'variability', self.objectId[rows[0]], self.ccdVisitId[rows[0]], num_draws=4)
+        self.assertTrue(np.array_equal(normals[rows[0]], single))
+
+    def test_distribution(self):
+        """ Checks the moments of the deviates and the independence of seeds and kinds """
+        flux = random_streams.get_standard_normals(123, 'flux', self.objectId, self.ccdVisitId)
+        self.assertTrue(abs(np.mean(flux)) < 0.02)
+        self.assertTrue(abs(np.std(flux) - 1.0) < 0.02)
+        for other in [random_streams.get_standard_normals(124, 'flux', self.objectId, self.ccdVisitId),
+                      random_streams.get_standard_normals(123, 'second_moment', self.objectId, self.ccdVisitId)]:
+            self.assertTrue(abs(np.corrcoef(flux, other)[0, 1]) < 0.02)
+        first_moment = random_streams.get_standard_normals(123, 'first_moment', self.objectId, self.ccdVisitId, num_draws=2)
+        self.assertTrue(abs(np.corrcoef(first_moment[:, 0], first_moment[:, 1])[0, 1]) < 0.02)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -33,6 +33,8 @@ class SDSSRealizerTest(unittest.TestCase):
         output_paths = {
         'rowbyrow_path': os.path.join(output_dir, 'rowbyrow_source.csv'),
         'vectorized_path': os.path.join(output_dir, 'vectorized_source.csv'),
+        'chunked_path': os.path.join(output_dir, 'chunked_source.csv'),
+        'pandas_path': os.path.join(output_dir, 'pandas_source.csv'),
         'object_path': os.path.join(output_dir, 'object.csv'),
         }
 
@@ -61,6 +63,22 @@ class SDSSRealizerTest(unittest.TestCase):
         """ Tests whether make_source_table_vectorized runs """
         self.realizer.make_source_table_vectorized(save_file=self.vectorized_path)
 
+    def test_make_source_table_chunked(self):
+        """ Tests whether the chunked source table matches the monolithic one """
+        self.realizer.make_source_table_vectorized(save_file=self.vectorized_path)
+        for chunk_size in [1, 7, 1000]:
+            self.realizer.make_source_table_vectorized(save_file=self.chunked_path, chunk_size=chunk_size)
+            with open(self.vectorized_path) as monolithic, open(self.chunked_path) as chunked:
+                self.assertEqual(monolithic.read(), chunked.read())
+
+    def test_make_source_table_engines(self):
+        """ Tests whether the numpy and pandas engines write the same source table """
+        numpy_table = self.realizer.make_source_table_vectorized(save_file=self.vectorized_path, engine='numpy')
+        pandas_table = self.realizer.make_source_table_vectorized(save_file=self.pandas_path, engine='pandas')
+        pd.testing.assert_frame_equal(numpy_table, pandas_table, check_exact=True)
+        with open(self.vectorized_path) as numpy_file, open(self.pandas_path) as pandas_file:
+            self.assertEqual(numpy_file.read(), pandas_file.read())
+
     def test_make_object_table(self):
         """ Tests whether make_object_table runs """
         self.realizer.make_source_table_vectorized(save_file=self.vectorized_path)
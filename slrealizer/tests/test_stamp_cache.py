@@ -0,0 +1,71 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import unittest
+import numpy as np
+
+from slrealizer.utils.stamp_cache import StampCache
+
+class StampCacheTest(unittest.TestCase):
+
+    """
+    Tests the rendered-stamp cache in utils.stamp_cache.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        test_dir = os.path.dirname(os.path.abspath(__file__))
+        cls.cache_dir = os.path.join(test_dir, 'test_output', 'stamps')
+
+    @classmethod
+    def tearDownClass(cls):
+        if os.path.exists(cls.cache_dir):
+            shutil.rmtree(cls.cache_dir)
+
+    def test_fwhm_quantization(self):
+        """ Checks that FWHMs within one quantum share a key """
+        cache = StampCache(fwhm_quantum=0.1)
+        self.assertEqual(cache.get_key(1, 'g', 0.71, 49, 49), cache.get_key(1, 'g', 0.68, 49, 49))
+        self.assertNotEqual(cache.get_key(1, 'g', 0.71, 49, 49), cache.get_key(1, 'r', 0.71, 49, 49))
+        self.assertNotEqual(cache.get_key(1, 'g', 0.71, 49, 49), cache.get_key(1, 'g', 0.76, 49, 49))
+        self.assertAlmostEqual(cache.quantize_fwhm(0.71), 0.7)
+
+    def test_lru_eviction(self):
+        """ Checks that the least recently used stamp is evicted beyond the memory limit """
+        stamp = np.ones((32, 32)) # 8 kB
+        cache = StampCache(max_memory_mb=2.5*stamp.nbytes/1024.0**2)
+        for lens_id in range(3):
+            cache.put(cache.get_key(lens_id, 'g', 0.7, 32, 32), stamp*lens_id)
+        self.assertIsNone(cache.get(cache.get_key(0, 'g', 0.7, 32, 32)))
+        self.assertTrue(np.array_equal(cache.get(cache.get_key(2, 'g', 0.7, 32, 32)), stamp*2))
+        stats = cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['num_stamps']), (1, 1, 2))
+
+    def test_disk_cache(self):
+        """ Checks that stamps persist on disk across cache objects """
+        stamp = np.arange(49.0*49.0).reshape(49, 49)
+        cache = StampCache(cache_dir=self.cache_dir)
+        cache.put(cache.get_key(7, 'i', 0.9, 49, 49), stamp)
+        new_cache = StampCache(cache_dir=self.cache_dir)
+        self.assertTrue(np.array_equal(new_cache.get(new_cache.get_key(7, 'i', 0.9, 49, 49)), stamp))
+        self.assertEqual(new_cache.get_stats()['disk_hits'], 1)
+
+    def test_disk_cache_settings(self):
+        """ Checks that a disk cache reused with other settings does not return stamps rendered with different ones """
+        stamp = np.ones((49, 49))
+        cache = StampCache(fwhm_quantum=0.1, cache_dir=self.cache_dir)
+        key = cache.get_key(8, 'r', 0.7, 49, 49, render_settings=(0.1, ))
+        cache.put(key, stamp)
+        self.assertNotEqual(key, cache.get_key(8, 'r', 0.7, 65, 65, render_settings=(0.1, )))
+        self.assertNotEqual(key, cache.get_key(8, 'r', 0.7, 49, 49, render_settings=(0.2, )))
+        # The same FWHM bucket under a finer quantum
+        finer_cache = StampCache(fwhm_quantum=0.01, cache_dir=self.cache_dir)
+        self.assertIsNone(finer_cache.get(finer_cache.get_key(8, 'r', 0.07, 49, 49, render_settings=(0.1, ))))
+        new_cache = StampCache(fwhm_quantum=0.1, cache_dir=self.cache_dir)
+        for nx, ny, render_settings in [(65, 65, (0.1, )), (49, 49, (0.2, ))]:
+            self.assertIsNone(new_cache.get(new_cache.get_key(8, 'r', 0.7, nx, ny, render_settings=render_settings)))
+        self.assertTrue(np.array_equal(new_cache.get(new_cache.get_key(8, 'r', 0.7, 49, 49, render_settings=(0.1, ))), stamp))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+from __future__ import absolute_import, division, print_function
+
+import unittest
+import os, sys
+import shutil
+import pandas as pd
+import numpy as np
+
+import slrealizer.utils.table_io as table_io
+
+def _has_module(name):
+    try:
+        __import__(name)
+        return True
+    except ImportError:
+        return False
+
+class TableIOTest(unittest.TestCase):
+
+    """
+    Tests the table readers and writers in utils.table_io.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        tests_dir = os.path.dirname(os.path.realpath(__file__))
+        cls.output_dir = os.path.join(tests_dir, 'test_output', 'test_table_io')
+        if os.path.exists(cls.output_dir):
+            shutil.rmtree(cls.output_dir)
+        os.makedirs(cls.output_dir)
+
+        num_rows = 50
+        cls.table = pd.DataFrame({'objectId': np.repeat(np.arange(5), 10),
+                                  'MJD': np.linspace(59580.0, 59980.0, num_rows),
+                                  'filter': np.tile(list('ugriz'), 10),
+                                  'apFlux': np.random.RandomState(123).uniform(size=num_rows), })
+        cls.table = cls.table.set_index('objectId')
+
+    def _check_round_trip(self, filename, exact=True):
+        path = os.path.join(self.output_dir, filename)
+        # Write in blocks, as the chunked realizations do
+        with table_io.get_table_writer(path) as writer:
+            for start in range(0, len(self.table), 20):
+                writer.write(self.table.iloc[start:start + 20])
+        self.assertEqual(writer.num_rows, len(self.table))
+
+        read_back = table_io.read_table(path).set_index('objectId')
+        self.assertEqual(list(read_back.columns), list(self.table.columns))
+        self.assertTrue((read_back.index.values == self.table.index.values).all())
+        self.assertTrue((read_back['filter'].values == self.table['filter'].values).all())
+        if exact:
+            # Binary formats store floats without any loss
+            self.assertTrue(np.array_equal(read_back['apFlux'].values, self.table['apFlux'].values))
+        else:
+            self.assertTrue(np.allclose(read_back['apFlux'].values, self.table['apFlux'].values))
+
+        subset = table_io.read_table(path, columns=['objectId', 'MJD'])
+        self.assertEqual(list(subset.columns), ['objectId', 'MJD'])
+
+        # Stream the table back in bounded chunks
+        chunks = list(table_io.iter_table(path, chunk_rows=15))
+        self.assertTrue(all(len(chunk) <= 15 for chunk in chunks))
+        streamed = pd.concat(chunks, ignore_index=True).set_index('objectId')
+        self.assertTrue((streamed.index.values == read_back.index.values).all())
+        self.assertTrue(np.array_equal(streamed['apFlux'].values, read_back['apFlux'].values))
+
+    def _check_append(self, filename, exact=True):
+        path = os.path.join(self.output_dir, 'appended_' + filename)
+        # Write the first rows, then append the others in blocks, as incremental realizations do
+        table_io.write_table(self.table.iloc[:20], path)
+        start_byte = table_io.get_table_size(path)
+        with table_io.get_table_writer(path, append=True) as writer:
+            for start in range(20, len(self.table), 15):
+                writer.write(self.table.iloc[start:start + 15])
+        self.assertFalse(os.path.exists(path + '.tmp'))
+
+        read_back = table_io.read_table(path).set_index('objectId')
+        self.assertTrue((read_back.index.values == self.table.index.values).all())
+        self.assertTrue((read_back['filter'].values == self.table['filter'].values).all())
+        self.assertTrue(np.allclose(read_back['apFlux'].values, self.table['apFlux'].values, rtol=0.0 if exact else 1e-12))
+
+        # Stream only the rows after start_row, within or at the end of a written block
+        for start_row in [7, 20, 49, 50]:
+            chunks = list(table_io.iter_table(path, chunk_rows=15, start_row=start_row))
+            self.assertTrue(all(len(chunk) <= 15 for chunk in chunks))
+            streamed = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=['MJD'])
+            self.assertTrue(np.array_equal(streamed['MJD'].values, read_back['MJD'].values[start_row:]))
+
+        # Resume from the size of the table before the appends (used by csv),
+        # or from within a line, which falls back to skipping start_row rows
+        for size in [start_byte, start_byte - 3]:
+            streamed = pd.concat(table_io.iter_table(path, chunk_rows=15, start_row=20, start_byte=size), ignore_index=True)
+            self.assertEqual(list(streamed.columns), list(read_back.reset_index().columns))
+            self.assertTrue(np.array_equal(streamed['MJD'].values, read_back['MJD'].values[20:]))
+        subset = pd.concat(table_io.iter_table(path, columns=['MJD'], start_row=20, start_byte=start_byte), ignore_index=True)
+        self.assertEqual(list(subset.columns), ['MJD'])
+
+    def test_format_inference(self):
+        """ Tests whether table formats are inferred from file extensions """
+        self.assertEqual(table_io.get_table_format('source.csv'), 'csv')
+        self.assertEqual(table_io.get_table_format('source.parquet'), 'parquet')
+        self.assertEqual(table_io.get_table_format('source.h5'), 'hdf5')
+        self.assertEqual(table_io.get_table_format('source'), 'csv')
+        self.assertEqual(table_io.get_table_format('source.csv', table_format='feather'), 'feather')
+        self.assertEqual(table_io.get_sidecar_path('output/source.parquet', 'stats'), 'output/source.stats.parquet')
+        self.assertRaises(ValueError, table_io.get_table_format, 'source.csv', 'xml')
+
+    def test_csv(self):
+        """ Tests whether a csv table written in blocks matches df.to_csv """
+        self._check_round_trip('table.csv', exact=False)
+        self._check_append('table.csv', exact=False)
+        path = os.path.join(self.output_dir, 'table_monolithic.csv')
+        self.table.to_csv(path)
+        with open(path) as monolithic, open(os.path.join(self.output_dir, 'table.csv')) as blocked:
+            self.assertEqual(monolithic.read(), blocked.read())
+
+    @unittest.skipIf(not _has_module('pyarrow'), "pyarrow is not installed")
+    def test_parquet(self):
+        """ Tests the Parquet round trip and appends """
+        self._check_round_trip('table.parquet')
+        self._check_append('table.parquet')
+
+    @unittest.skipIf(not _has_module('pyarrow'), "pyarrow is not installed")
+    def test_feather(self):
+        """ Tests the Feather (Arrow IPC) round trip and appends """
+        self._check_round_trip('table.feather')
+        self._check_append('table.feather')
+
+    @unittest.skipIf(not _has_module('tables'), "tables is not installed")
+    def test_hdf5(self):
+        """ Tests the HDF5 round trip and appends """
+        self._check_round_trip('table.h5')
+        self._check_append('table.h5')
+
+if __name__ == '__main__':
+    unittest.main()
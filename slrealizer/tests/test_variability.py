@@ -0,0 +1,63 @@
+from __future__ import absolute_import, division, print_function
+
+import unittest
+import numpy as np
+
+import slrealizer.utils.constants as constants
+import slrealizer.utils.variability as variability
+
+class VariabilityTest(unittest.TestCase):
+
+    """
+    Tests the vectorized damped random walk generator in utils.variability.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.RandomState(123)
+        num_rows = 2000
+        cls.objectId = rng.randint(0, 30, num_rows)
+        cls.band_index = rng.randint(0, 5, num_rows)
+        cls.MJD = rng.uniform(59580.0, 60580.0, num_rows)
+
+    def test_matches_serial_recurrence(self):
+        """ Compares the batched walk with a serial loop over the sorted rows """
+        normals = np.random.RandomState(42).normal(size=(len(self.MJD), 4))
+        batched = variability.get_intrinsic_variability(self.objectId, self.band_index, self.MJD, normals)
+
+        order = np.lexsort((self.MJD, self.objectId, self.band_index))
+        innovations = normals[order]
+        timescale, sf_inf = constants.get_drw_timescale(), constants.get_drw_sf_inf()
+        serial = np.zeros((len(order), 4))
+        for k in range(len(order)):
+            i, previous_i = order[k], order[k - 1]
+            if k == 0 or (self.objectId[i], self.band_index[i]) != (self.objectId[previous_i], self.band_index[previous_i]):
+                continue # every walk starts from zero
+            d_time = self.MJD[i] - self.MJD[previous_i]
+            serial[k] = np.exp(-d_time/timescale)*serial[k - 1]\
+                        + np.sqrt(0.5*sf_inf**2.0*(1.0 - np.exp(-2.0*d_time/timescale)))*innovations[k]
+        expected = np.empty_like(serial)
+        expected[order] = serial
+
+        self.assertTrue(np.allclose(batched, expected))
+
+    def test_stationary_scatter(self):
+        """ Checks the scatter of well-separated epochs against SF_inf/sqrt(2) """
+        num_curves, num_epochs = 2000, 20
+        objectId = np.repeat(np.arange(num_curves), num_epochs)
+        MJD = np.tile(np.arange(num_epochs)*10.0*constants.get_drw_timescale(), num_curves)
+        normals = np.random.RandomState(42).normal(size=(len(MJD), 4))
+        walk = variability.get_intrinsic_variability(objectId, np.zeros_like(objectId), MJD, normals)
+        self.assertTrue(np.isclose(np.std(walk[MJD > 0.0]), constants.get_drw_sf_inf()/np.sqrt(2.0), rtol=0.05))
+
+    def test_initial_state(self):
+        """ Checks that a walk continues from a given earlier state """
+        objectId = np.zeros(1, dtype=int)
+        initial_mag = np.full((1, 4), 0.3)
+        # No time elapsed: the walk stays at the initial state
+        walk = variability.get_intrinsic_variability(objectId, objectId, np.array([100.0]), np.ones((1, 4)),
+                                                     initial_mag=initial_mag, initial_MJD=np.array([100.0]))
+        self.assertTrue(np.allclose(walk, initial_mag))
+
+if __name__ == '__main__':
+    unittest.main()
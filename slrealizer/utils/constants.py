@@ -53,3 +53,12 @@ def get_ellipticity_cut():
 
 def get_SDSS_pixel_arcsec_conversion():
     return 0.396
+
+def get_drw_mean():
+    return 0.0 # mag, mean of the damped random walk
+
+def get_drw_timescale():
+    return 20.0 # days, damping timescale (hand-picked)
+
+def get_drw_sf_inf():
+    return 0.14 # mag, structure function at infinity
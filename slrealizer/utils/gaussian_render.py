@@ -0,0 +1,178 @@
+"""
+The :mod:`gaussian_render` module renders lens systems made of Gaussians
+(a sheared Gaussian lens galaxy and point-like Gaussian quasar images)
+convolved with a Gaussian PSF, for many systems at once, without GalSim.
+
+The convolution of two Gaussians is the Gaussian whose covariance is the sum
+of their covariances, so every convolved component has a closed form,
+which is evaluated directly on the pixel centers of the stamps.
+The stamps match GalSim's drawImage(method='no_pixel') on the same grid,
+up to the accuracy of GalSim's FFT rendering.
+
+The same closed forms give the flux of each system falling within a stamp,
+from which get_stamp_sizes picks the size of the stamp of each system.
+"""
+from __future__ import absolute_import, division, print_function
+import math
+import numpy as np
+import slrealizer.utils.utils as utils
+
+# Sizes in pixels of the square stamps of get_stamp_sizes, few enough
+# that the stamps of many systems share a size and can be batched
+STAMP_SIZES = (17, 25, 33, 49, 65, 97, 129, )
+
+def get_pixel_grid(nx, ny, pixel_scale):
+    """
+    Returns the x and y coordinates in arcsec of the pixel centers,
+    with the origin at the true center of the stamp as in GalSim's drawImage
+    """
+    x = (np.arange(nx) - 0.5*(nx - 1))*pixel_scale
+    y = (np.arange(ny) - 0.5*(ny - 1))*pixel_scale
+    return x, y
+
+def get_sheared_covariance(sigma, e, beta):
+    """
+    Returns the covariance of a circular Gaussian of width sigma
+    sheared by distortion e along position angle beta (in radians),
+    as in galsim.Gaussian(sigma=sigma).shear(e=e, beta=beta)
+
+    Returns:
+    a tuple of the covariance elements Cxx, Cxy, Cyy
+    """
+    e1, e2 = e*np.cos(2.0*beta), e*np.sin(2.0*beta)
+    # Shears preserve area, so the covariance scales as sigma^2/sqrt(1 - e^2)
+    scale = np.power(sigma, 2.0)/np.sqrt(1.0 - np.power(e, 2.0))
+    return scale*(1.0 + e1), scale*e2, scale*(1.0 - e1)
+
+def render_gaussians(flux, x0, y0, cov_xx, cov_xy, cov_yy, nx, ny, pixel_scale):
+    """
+    Renders scenes made of Gaussian components on a pixel grid
+
+    Keyword arguments:
+    flux -- array of shape [n_scenes, n_components] of component fluxes
+    x0, y0 -- arrays of shape [n_scenes, n_components] of component centers in arcsec
+    cov_xx, cov_xy, cov_yy -- arrays of shape [n_scenes, n_components]
+                              of component covariances in arcsec^2
+    nx, ny -- stamp size in pixels
+    pixel_scale -- scale of the stamp in arcsec/pixel
+
+    Returns:
+    an array of shape [n_scenes, ny, nx] of the rendered stamps
+    """
+    x, y = get_pixel_grid(nx, ny, pixel_scale)
+    num_scenes, num_components = np.shape(flux)
+    stamps = np.zeros((num_scenes, ny, nx))
+    # Accumulate one component at a time to keep the memory at one stack of stamps
+    for k in range(num_components):
+        det = cov_xx[:, k]*cov_yy[:, k] - np.power(cov_xy[:, k], 2.0)
+        norm = flux[:, k]*pixel_scale**2.0/(2.0*np.pi*np.sqrt(det))
+        dx = (x[np.newaxis, :] - x0[:, k, np.newaxis])[:, np.newaxis, :] # [n_scenes, 1, nx]
+        dy = (y[np.newaxis, :] - y0[:, k, np.newaxis])[:, :, np.newaxis] # [n_scenes, ny, 1]
+        quad = (cov_yy[:, k, np.newaxis, np.newaxis]*np.power(dx, 2.0)
+                - 2.0*cov_xy[:, k, np.newaxis, np.newaxis]*dx*dy
+                + cov_xx[:, k, np.newaxis, np.newaxis]*np.power(dy, 2.0))/det[:, np.newaxis, np.newaxis]
+        stamps += norm[:, np.newaxis, np.newaxis]*np.exp(-0.5*quad)
+    return stamps
+
+def render_lens_systems(lens_flux, lens_sigma, e, beta, quasar_flux, quasar_x, quasar_y, psf_fwhm,
+                        nx, ny, pixel_scale, quasar_sigma=1.e-5):
+    """
+    Renders lens systems convolved with a Gaussian PSF,
+    i.e. the scene drawn by SLRealizer.draw_system, for many systems at once
+
+    Keyword arguments:
+    lens_flux, lens_sigma, e, beta -- arrays of length n_systems of the lens galaxy flux,
+                                      width in arcsec, distortion and position angle in radians
+    quasar_flux, quasar_x, quasar_y -- arrays of shape [n_systems, n_images] of the
+                                       quasar image fluxes and positions in arcsec
+                                       (zero flux for missing images)
+    psf_fwhm -- array of length n_systems of the PSF FWHM in arcsec
+    nx, ny -- stamp size in pixels
+    pixel_scale -- scale of the stamp in arcsec/pixel
+    quasar_sigma -- width of the point-like quasar images in arcsec [default: 1.e-5]
+
+    Returns:
+    an array of shape [n_systems, ny, nx] of the rendered stamps
+    """
+    psf_var = np.power(utils.fwhm_to_sigma(np.asarray(psf_fwhm, dtype=float)), 2.0)
+    lens_xx, lens_xy, lens_yy = get_sheared_covariance(np.asarray(lens_sigma, dtype=float),
+                                                       np.asarray(e, dtype=float),
+                                                       np.asarray(beta, dtype=float))
+    quasar_flux = np.atleast_2d(quasar_flux)
+    num_systems, num_images = quasar_flux.shape
+    quasar_var = np.broadcast_to((quasar_sigma**2.0 + psf_var)[:, np.newaxis], (num_systems, num_images))
+    zeros = np.zeros((num_systems, 1))
+
+    # The lens galaxy is component 0, followed by the quasar images
+    flux = np.hstack([np.reshape(lens_flux, (-1, 1)), quasar_flux])
+    x0 = np.hstack([zeros, np.atleast_2d(quasar_x)])
+    y0 = np.hstack([zeros, np.atleast_2d(quasar_y)])
+    cov_xx = np.hstack([(lens_xx + psf_var)[:, np.newaxis], quasar_var])
+    cov_xy = np.hstack([lens_xy[:, np.newaxis], np.zeros((num_systems, num_images))])
+    cov_yy = np.hstack([(lens_yy + psf_var)[:, np.newaxis], quasar_var])
+    return render_gaussians(flux, x0, y0, cov_xx, cov_xy, cov_yy, nx=nx, ny=ny, pixel_scale=pixel_scale)
+
+def _erf(x):
+    """
+    Returns the error function of the array x, to within 1.5e-7
+    (Abramowitz and Stegun 7.1.26)
+    """
+    t = 1.0/(1.0 + 0.3275911*np.abs(x))
+    poly = t*(0.254829592 + t*(-0.284496736 + t*(1.421413741 + t*(-1.453152027 + t*1.061405429))))
+    return np.sign(x)*(1.0 - poly*np.exp(-np.power(x, 2.0)))
+
+def _get_interval_fraction(x0, sigma, half_width):
+    """
+    Returns the fraction of a 1D Gaussian of center x0 and width sigma within [-half_width, half_width]
+    """
+    scale = np.sqrt(2.0)*sigma
+    return 0.5*(_erf((half_width - x0)/scale) + _erf((half_width + x0)/scale))
+
+def get_stamp_sizes(lens_flux, lens_sigma, e, beta, quasar_flux, quasar_x, quasar_y, psf_fwhm,
+                    pixel_scale, flux_fraction=0.999, stamp_sizes=STAMP_SIZES, quasar_sigma=1.e-5):
+    """
+    Returns the size of the square stamp of each lens system (see render_lens_systems for the arguments):
+    the smallest of stamp_sizes containing at least flux_fraction of the flux of the system,
+    or, for systems too extended for the largest of stamp_sizes, the smallest size containing it
+    in steps of 32 pixels beyond the largest.
+
+    The lens galaxy, at the center of the stamp, is bounded by a circular Gaussian
+    of the width of its major axis, which contains less flux in the stamp than the sheared one,
+    so that the flux fraction is guaranteed for the Gaussian scene.
+
+    Returns:
+    an integer array of length n_systems of the stamp sizes in pixels
+    """
+    psf_var = np.power(utils.fwhm_to_sigma(np.asarray(psf_fwhm, dtype=float)), 2.0)
+    lens_xx, lens_xy, lens_yy = get_sheared_covariance(np.asarray(lens_sigma, dtype=float),
+                                                       np.asarray(e, dtype=float),
+                                                       np.asarray(beta, dtype=float))
+    lens_major_var = 0.5*(lens_xx + lens_yy) + np.sqrt(np.power(0.5*(lens_xx - lens_yy), 2.0) + np.power(lens_xy, 2.0))
+    quasar_flux = np.atleast_2d(quasar_flux)
+    num_systems, num_images = quasar_flux.shape
+
+    # The lens galaxy is component 0, followed by the quasar images,
+    # with a trailing axis over the candidate sizes
+    flux = np.hstack([np.reshape(lens_flux, (-1, 1)), quasar_flux])[:, :, np.newaxis]
+    x0 = np.hstack([np.zeros((num_systems, 1)), np.atleast_2d(quasar_x)])[:, :, np.newaxis]
+    y0 = np.hstack([np.zeros((num_systems, 1)), np.atleast_2d(quasar_y)])[:, :, np.newaxis]
+    sigma = np.sqrt(np.hstack([(lens_major_var + psf_var)[:, np.newaxis],
+                               np.broadcast_to((quasar_sigma**2.0 + psf_var)[:, np.newaxis], (num_systems, num_images))]))
+    sigma = sigma[:, :, np.newaxis]
+    total_flux = np.sum(flux[:, :, 0], axis=1)
+
+    sizes = np.zeros(num_systems, dtype=np.int64)
+    # Systems with undefined fluxes or positions get the largest of stamp_sizes
+    valid = np.isfinite(total_flux) & np.all(np.isfinite(sigma[:, :, 0] + x0[:, :, 0] + y0[:, :, 0]), axis=1)
+    sizes[~valid] = stamp_sizes[-1]
+    candidates = np.asarray(stamp_sizes)
+    while not np.all(sizes):
+        todo = np.flatnonzero(sizes == 0)
+        half_width = 0.5*candidates*pixel_scale
+        contained = np.sum(flux[todo]*_get_interval_fraction(x0[todo], sigma[todo], half_width)
+                           *_get_interval_fraction(y0[todo], sigma[todo], half_width), axis=1)
+        is_contained = contained >= flux_fraction*total_flux[todo, np.newaxis]
+        found = np.any(is_contained, axis=1)
+        sizes[todo[found]] = candidates[np.argmax(is_contained[found], axis=1)]
+        candidates = candidates[-1] + 32*np.arange(1, 5)
+    return sizes
@@ -0,0 +1,143 @@
+"""
+The :mod:`hsm_batch` module measures image stamps with GalSim's HSM adaptive moments
+(FindAdaptiveMom), as the "hsm" method of SLRealizer.estimate_parameters, for many stamps at once.
+
+Each stamp can start from its own initial guess of the centroid and size,
+e.g. from the analytical moments of the emulator (see get_guess_from_moments),
+rather than from one fixed guess, so that HSM needs fewer iterations and fails less often.
+Batches can be measured across a pool of worker processes,
+and the reason of each failure is returned with the stamp.
+"""
+from __future__ import absolute_import, division, print_function
+import numpy as np
+import galsim
+import slrealizer.utils.utils as utils
+
+# Columns returned by measure_stamps
+HSM_COLUMNS = ['x', 'y', 'apFlux', 'trace', 'e1', 'e2', 'e_final', 'phi_final', 'hsm_n_iter', 'hsm_failure', ]
+
+def get_guess_from_moments(x, y, trace, nx, ny, pixel_scale):
+    """
+    Returns HSM initial guesses from the first moments and the trace of the second moments
+    (PSF included, as computed analytically by SLRealizer._include_moments)
+
+    Keyword arguments:
+    x, y -- first moments in arcsec
+    trace -- trace of the second moments in arcsec^2
+    nx, ny -- size of the stamps in pixels
+    pixel_scale -- pixel scale in arcsec
+
+    Returns:
+    a tuple of the guess of the Gaussian sigma in pixels (sqrt(trace/2) for a round Gaussian)
+    and of the centroid x and y in the pixel coordinates of the stamps
+    """
+    guess_sig = np.sqrt(0.5*np.asarray(trace, dtype=np.float64))/pixel_scale
+    return guess_sig, utils.physical_to_pixel(np.asarray(x), nx, pixel_scale), utils.physical_to_pixel(np.asarray(y), ny, pixel_scale)
+
+def measure_stamp(galsim_img, pixel_scale, guess_sig, guess_x=None, guess_y=None, debug=False):
+    """
+    Measures one stamp with HSM
+
+    Keyword arguments:
+    galsim_img -- GalSim's Image object of the stamp
+    pixel_scale -- pixel scale in arcsec
+    guess_sig -- initial guess of the Gaussian sigma in pixels
+    guess_x, guess_y -- optional initial guess of the centroid in pixel coordinates.
+                        If None, HSM starts from the center of the stamp. [default: None]
+    debug -- whether to also return the half-light radius 'hlr' and the determinant 'det' [default: False]
+
+    Returns:
+    a tuple of the dictionary of the estimated properties (None if HSM failed),
+    including the number of iterations 'hsm_n_iter', and the reason of the failure (None if HSM succeeded)
+    """
+    ny, nx = galsim_img.array.shape
+    guess_centroid = None if guess_x is None else galsim.PositionD(x=float(guess_x), y=float(guess_y))
+    try:
+        shape_info = galsim_img.FindAdaptiveMom(guess_sig=float(guess_sig), guess_centroid=guess_centroid, strict=False)
+    except Exception as error:
+        return None, '%s: %s' %(type(error).__name__, str(error).strip())
+    if shape_info.moments_status != 0:
+        return None, shape_info.error_message.strip() or 'moments_status %d' %shape_info.moments_status
+
+    estimated_params = {}
+    # Calculate the real position from the arbitrary pixel position
+    pixelCenter = galsim.PositionD(x=shape_info.moments_centroid.x, y=shape_info.moments_centroid.y)
+    estimated_params['x'] = utils.pixel_to_physical(shape_info.moments_centroid.x, nx, pixel_scale)
+    estimated_params['y'] = utils.pixel_to_physical(shape_info.moments_centroid.y, ny, pixel_scale)
+    estimated_params['apFlux'] = float(np.sum(galsim_img.array))
+    if debug:
+        estimated_params['hlr'] = galsim_img.calculateHLR(center=pixelCenter)
+        estimated_params['det'] = (shape_info.moments_sigma * pixel_scale)**4.0
+    estimated_params['trace'] = 2.0*galsim_img.calculateMomentRadius(center=pixelCenter, rtype='trace')**2.0
+    estimated_params['e1'] = shape_info.observed_shape.e1
+    estimated_params['e2'] = shape_info.observed_shape.e2
+    estimated_params['e_final'] = shape_info.observed_shape.e
+    # In radians, as in the other methods
+    estimated_params['phi_final'] = shape_info.observed_shape.beta/galsim.radians
+    estimated_params['hsm_n_iter'] = shape_info.moments_n_iter
+    return estimated_params, None
+
+def _measure_task(args):
+    """
+    Measures one task of measure_stamps, in this process or a worker process
+    """
+    image_stack, pixel_scale, guess_sig, guess_x, guess_y = args
+    num_stamps = len(image_stack)
+    columns = dict((k, np.full(num_stamps, np.nan)) for k in HSM_COLUMNS[:-2])
+    columns['hsm_n_iter'] = np.zeros(num_stamps, dtype=np.int64)
+    columns['hsm_failure'] = np.full(num_stamps, '', dtype=object)
+    for i in range(num_stamps):
+        estimated_params, failure = measure_stamp(galsim.Image(np.ascontiguousarray(image_stack[i]), scale=pixel_scale),
+                                                  pixel_scale=pixel_scale, guess_sig=guess_sig[i],
+                                                  guess_x=None if guess_x is None else guess_x[i],
+                                                  guess_y=None if guess_y is None else guess_y[i])
+        if estimated_params is None:
+            columns['hsm_failure'][i] = failure
+            continue
+        for k in HSM_COLUMNS[:-1]:
+            columns[k][i] = estimated_params[k]
+    return columns
+
+def measure_stamps(image_stack, pixel_scale, guess_sig, guess_x=None, guess_y=None, n_workers=None, stamps_per_task=64):
+    """
+    Measures a batch of stamps with HSM, each from its own initial guess
+
+    Keyword arguments:
+    image_stack -- an array of shape [n_stamps, ny, nx]
+    pixel_scale -- pixel scale in arcsec
+    guess_sig -- initial guess of the Gaussian sigma in pixels, one per stamp or one for all
+    guess_x, guess_y -- optional arrays of initial guesses of the centroid in pixel coordinates
+                        (see get_guess_from_moments). If None, HSM starts from the center of each stamp.
+                        [default: None]
+    n_workers -- if given, the stamps are measured stamps_per_task at a time
+                 across n_workers processes. The result does not depend on n_workers. [default: None]
+    stamps_per_task -- number of stamps sent to a worker at once [default: 64]
+
+    Returns:
+    a dictionary of arrays keyed by HSM_COLUMNS, one entry per stamp: the estimated properties
+    (NaN where HSM failed), the number of iterations 'hsm_n_iter' (0 where HSM failed)
+    and the reason of the failure 'hsm_failure' ('' where HSM succeeded)
+    """
+    num_stamps = len(image_stack)
+    guess_sig = np.broadcast_to(np.asarray(guess_sig, dtype=np.float64), (num_stamps, ))
+    tasks = []
+    for start in range(0, num_stamps, stamps_per_task):
+        stamps = slice(start, start + stamps_per_task)
+        tasks.append((image_stack[stamps], pixel_scale, guess_sig[stamps],
+                      None if guess_x is None else np.asarray(guess_x)[stamps],
+                      None if guess_y is None else np.asarray(guess_y)[stamps]))
+
+    if n_workers is None or n_workers <= 1:
+        results = [_measure_task(task) for task in tasks]
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes=n_workers)
+        try:
+            results = list(pool.imap(_measure_task, tasks))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    if not results:
+        return _measure_task((np.zeros((0, 1, 1)), pixel_scale, guess_sig, None, None))
+    return dict((k, np.concatenate([columns[k] for columns in results])) for k in HSM_COLUMNS)
@@ -0,0 +1,282 @@
+"""
+The :mod:`instrumentation` module provides the :class:`Instrumentation` class, which records
+named stages of the work of the :class:`SLRealizer` worker class and its descendants:
+wall-clock and CPU time, rows processed and rows per second, the peak resident set size
+of the process and, optionally, tracemalloc allocation deltas and cProfile captures.
+
+Instrumentation is off by default and costs next to nothing then. It can be switched on
+without code edits through environment variables read by :meth:`Instrumentation.from_environment`:
+
+    SLREALIZER_INSTRUMENT -- record stages if set to a non-empty value other than '0'
+    SLREALIZER_TRACEMALLOC -- also trace Python allocations with tracemalloc (Python 3)
+    SLREALIZER_PROFILE_DIR -- also save a cProfile capture of each outermost stage in this directory
+    SLREALIZER_INSTRUMENT_REPORT -- path of a JSON report, rewritten whenever an outermost stage ends
+
+Any of the last three also switches the instrumentation on.
+"""
+from __future__ import absolute_import, division, print_function
+import os
+import json
+import time
+import functools
+import collections
+import contextlib
+
+try:
+    _cpu_time = time.process_time
+except AttributeError: # Python 2
+    _cpu_time = time.clock
+_wall_time = getattr(time, 'perf_counter', time.time)
+
+def _is_set(value):
+    return value not in (None, '', '0')
+
+def get_peak_rss_mb():
+    """
+    Returns the peak resident set size of this process so far in MB,
+    or None where the resource module is not available
+    """
+    try:
+        import resource
+    except ImportError: # Windows
+        return None
+    import sys
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kB elsewhere
+    return peak/2**20 if sys.platform == 'darwin' else peak/2**10
+
+def instrumented(name):
+    """
+    Decorator recording every call of a realizer method
+    as one call of the stage name of the realizer's instrumentation
+    """
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.instrumentation.stage(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorate
+
+class Instrumentation(object):
+    """
+    Records of the named stages of a run, accumulated over every call of each stage.
+    Stages may be nested; the time of a nested stage is also part of the enclosing one.
+
+    Keyword arguments:
+    enabled -- whether to record stages [default: False]
+    trace_memory -- whether to trace Python allocations with tracemalloc,
+                    recording the net allocation and the peak allocation of each stage.
+                    Slows down allocation-heavy code. [default: False]
+    profile_dir -- if given, each outermost stage is run under cProfile and its profile,
+                   accumulated over its calls, saved as profile_dir/<stage>.prof [default: None]
+    report_path -- if given, the JSON report is rewritten there whenever an outermost stage ends,
+                   so that long runs can be followed as they go [default: None]
+    """
+
+    def __init__(self, enabled=False, trace_memory=False, profile_dir=None, report_path=None):
+        self.enabled = enabled
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        self.report_path = report_path
+        self.reset()
+
+    @classmethod
+    def from_environment(cls):
+        """
+        Returns an Instrumentation object configured by the SLREALIZER_* environment variables
+        (see the module docstring), disabled if none of them is set
+        """
+        trace_memory = _is_set(os.environ.get('SLREALIZER_TRACEMALLOC'))
+        profile_dir = os.environ.get('SLREALIZER_PROFILE_DIR') or None
+        report_path = os.environ.get('SLREALIZER_INSTRUMENT_REPORT') or None
+        enabled = _is_set(os.environ.get('SLREALIZER_INSTRUMENT')) or trace_memory\
+                  or profile_dir is not None or report_path is not None
+        return cls(enabled=enabled, trace_memory=trace_memory, profile_dir=profile_dir, report_path=report_path)
+
+    def reset(self):
+        """
+        Discards every record
+        """
+        self._records = collections.OrderedDict()
+        self._stack = []
+        self._profiles = {}
+
+    def __getstate__(self):
+        # Profilers cannot be pickled, and open stages belong to this process
+        state = self.__dict__.copy()
+        state['_stack'], state['_profiles'] = [], {}
+        return state
+
+    @contextlib.contextmanager
+    def stage(self, name, num_rows=None):
+        """
+        Context manager recording the enclosed code as one call of the stage name.
+        The number of rows processed can be given up front, or added within the stage with add_rows.
+        A stage entered again while it is open (e.g. by a method delegating to itself)
+        is recorded as part of the open call.
+        """
+        if not self.enabled or any(f['name'] == name for f in self._stack):
+            yield
+            return
+        frame = self._start(name)
+        frame['num_rows'] = num_rows
+        try:
+            yield
+        finally:
+            self._stop(frame)
+
+    def add_rows(self, num_rows):
+        """
+        Adds num_rows to the number of rows processed by the innermost open stage
+        """
+        if self._stack:
+            frame = self._stack[-1]
+            frame['num_rows'] = (frame['num_rows'] or 0) + int(num_rows)
+
+    def iter_stage(self, name, iterable):
+        """
+        Yields the items of iterable, recording the production of each item
+        (e.g. a realized block of rows) as one call of the stage name,
+        with the length of the item as its number of rows
+        """
+        if not self.enabled:
+            for item in iterable:
+                yield item
+            return
+        iterator = iter(iterable)
+        while True:
+            frame = self._start(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self._stop(frame, record=False)
+                return
+            except:
+                self._stop(frame)
+                raise
+            frame['num_rows'] = len(item)
+            self._stop(frame)
+            yield item
+
+    def _start(self, name):
+        frame = {'name': name, 'num_rows': None, 'profile': None, 'tracemalloc_start': None, 'tracemalloc_peak': None,
+                 'stop_tracemalloc': False}
+        if self.trace_memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                frame['stop_tracemalloc'] = True
+            current, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                # Hand the peak so far over to the enclosing stage before resetting it
+                parent = self._stack[-1]
+                parent['tracemalloc_peak'] = max(parent['tracemalloc_peak'], peak)
+            if hasattr(tracemalloc, 'reset_peak'): # Python 3.9+
+                tracemalloc.reset_peak()
+            frame['tracemalloc_start'] = frame['tracemalloc_peak'] = current
+        if self.profile_dir is not None and not any(f['profile'] is not None for f in self._stack):
+            import cProfile
+            frame['profile'] = self._profiles.setdefault(name, cProfile.Profile())
+            frame['profile'].enable()
+        frame['parent'] = self._stack[-1]['name'] if self._stack else None
+        if name not in self._records:
+            self._records[name] = {'parent': frame['parent'], 'calls': 0, 'wall_time': 0.0, 'cpu_time': 0.0,
+                                   'num_rows': None, 'peak_rss_mb': None,
+                                   'tracemalloc_delta_mb': None, 'tracemalloc_peak_mb': None, }
+        self._stack.append(frame)
+        frame['cpu_start'] = _cpu_time()
+        frame['wall_start'] = _wall_time()
+        return frame
+
+    def _stop(self, frame, record=True):
+        wall_time = _wall_time() - frame['wall_start']
+        cpu_time = _cpu_time() - frame['cpu_start']
+        # Frames are almost always closed in order, but a generator may be closed late
+        del self._stack[max(i for i, f in enumerate(self._stack) if f is frame)]
+        if frame['profile'] is not None:
+            frame['profile'].disable()
+            if record:
+                if not os.path.exists(self.profile_dir):
+                    os.makedirs(self.profile_dir)
+                frame['profile'].dump_stats(self._get_profile_path(frame['name']))
+        tracemalloc_delta, tracemalloc_peak = None, None
+        if frame['tracemalloc_start'] is not None:
+            import tracemalloc
+            current, peak = tracemalloc.get_traced_memory()
+            frame['tracemalloc_peak'] = max(frame['tracemalloc_peak'], peak)
+            if self._stack:
+                parent = self._stack[-1]
+                parent['tracemalloc_peak'] = max(parent['tracemalloc_peak'], frame['tracemalloc_peak'])
+            tracemalloc_delta = (current - frame['tracemalloc_start'])/2**20
+            tracemalloc_peak = (frame['tracemalloc_peak'] - frame['tracemalloc_start'])/2**20
+            if frame['stop_tracemalloc']:
+                tracemalloc.stop()
+        if not record:
+            return
+
+        record = self._records[frame['name']]
+        record['calls'] += 1
+        record['wall_time'] += wall_time
+        record['cpu_time'] += cpu_time
+        if frame['num_rows'] is not None:
+            record['num_rows'] = (record['num_rows'] or 0) + int(frame['num_rows'])
+        record['peak_rss_mb'] = get_peak_rss_mb()
+        if tracemalloc_delta is not None:
+            record['tracemalloc_delta_mb'] = (record['tracemalloc_delta_mb'] or 0.0) + tracemalloc_delta
+            record['tracemalloc_peak_mb'] = max(record['tracemalloc_peak_mb'] or 0.0, tracemalloc_peak)
+        if not self._stack and self.report_path is not None:
+            self.write_report(self.report_path)
+
+    def _get_profile_path(self, name):
+        return os.path.join(self.profile_dir, name + '.prof')
+
+    def get_report(self):
+        """
+        Returns a dictionary of the records of each stage, in the order the stages were first entered.
+        Each record holds the number of calls, the total wall-clock and CPU times in seconds,
+        the number of rows and the rows per second of wall-clock time (None if not given),
+        the peak resident set size of the process at the end of the stage in MB,
+        the net and peak tracemalloc allocations in MB (None without trace_memory),
+        the enclosing stage of its first call and the path of the cProfile capture (None without profile_dir).
+        """
+        stages = collections.OrderedDict()
+        for name, record in self._records.items():
+            if record['calls'] == 0: # e.g. an empty iter_stage
+                continue
+            record = dict(record)
+            record['rows_per_sec'] = None
+            if record['num_rows'] is not None and record['wall_time'] > 0.0:
+                record['rows_per_sec'] = record['num_rows']/record['wall_time']
+            record['profile_path'] = self._get_profile_path(name) if name in self._profiles else None
+            stages[name] = record
+        return {'stages': stages, 'peak_rss_mb': get_peak_rss_mb(), }
+
+    def write_report(self, path):
+        """
+        Writes the report (see get_report) as JSON to path
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.get_report(), f, indent=1)
+        # Rename into place, so that the report can be read at any time during a run
+        os.rename(tmp_path, path)
+
+    def format_report(self):
+        """
+        Returns the report (see get_report) as a table, with nested stages indented
+        """
+        lines = ["%-36s %6s %10s %10s %12s %12s %12s" %('stage', 'calls', 'wall [s]', 'cpu [s]', 'rows/s', 'peak RSS [MB]', 'alloc [MB]')]
+        stages = self.get_report()['stages']
+        def add_lines(parent, depth):
+            for name, record in stages.items():
+                if record['parent'] != parent:
+                    continue
+                lines.append("%-36s %6d %10.3f %10.3f %12s %12s %12s" %('  '*depth + name, record['calls'],
+                             record['wall_time'], record['cpu_time'],
+                             '-' if record['rows_per_sec'] is None else '%.0f' %record['rows_per_sec'],
+                             '-' if record['peak_rss_mb'] is None else '%.1f' %record['peak_rss_mb'],
+                             '-' if record['tracemalloc_peak_mb'] is None else '%.1f' %record['tracemalloc_peak_mb']))
+                add_lines(name, depth + 1)
+        add_lines(None, 0)
+        return '\n'.join(lines)
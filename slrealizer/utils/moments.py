@@ -0,0 +1,122 @@
+"""
+The :mod:`moments` module computes the analytical first and second moments
+of lens systems, modeled as a Gaussian lens galaxy plus point-like quasar images
+convolved with a Gaussian PSF, in one fused pass over the rows.
+
+The rows are processed in blocks small enough to stay in cache, and each quantity
+is accumulated in place over the quasar images, so that no full-length temporary
+(flux ratios, lens shape, PSF size...) is ever allocated: the only full-length arrays
+are the inputs and the outputs, which may be preallocated by the caller.
+"""
+from __future__ import absolute_import, division, print_function
+import numpy as np
+import slrealizer.utils.utils as utils
+
+# Columns computed by get_analytical_moments
+MOMENT_COLUMNS = ['x', 'y', 'trace', 'e1', 'e2', 'e_final', 'phi_final', ]
+
+# Rows per block, small enough for the block temporaries to stay in cache
+_BLOCK_ROWS = 2**14
+
+def _as_columns(values):
+    """
+    Returns a list of 1D arrays, one per image, from either an array of shape
+    [n_rows, n_images] or a sequence of n_images arrays of length n_rows
+    """
+    if isinstance(values, (list, tuple)):
+        return [np.asarray(v) for v in values]
+    values = np.asarray(values)
+    return [values[:, q] for q in range(values.shape[1])]
+
+def get_lens_second_moments(e, beta):
+    """
+    Returns the second moments Ixx, Iyy, Ixy (arcsec^2) of the lens galaxies,
+    with unit half-light radius sheared by ellipticity e at position angle beta (deg)
+    """
+    minor_to_major = np.sqrt((1.0 - e)/(1.0 + e))
+    sigmasq_lens = np.power(utils.hlr_to_sigma(1.0), 2.0) # Arbitrarily set REFF_T to 1.0
+    lam1, lam2 = sigmasq_lens/minor_to_major, sigmasq_lens*minor_to_major
+    beta = np.radians(beta)
+    cos_beta, sin_beta = np.cos(beta), np.sin(beta)
+    return lam1*cos_beta*cos_beta + lam2*sin_beta*sin_beta,\
+           lam1*sin_beta*sin_beta + lam2*cos_beta*cos_beta,\
+           (lam1 - lam2)*cos_beta*sin_beta
+
+def get_analytical_moments(lens_flux, apFlux, q_flux, XIMG, YIMG, e, beta, psf_fwhm,
+                           x_noise=None, y_noise=None, trace_noise=None, lens_index=None, out=None):
+    """
+    Returns the analytical moments of lens systems, one per row
+
+    Keyword arguments:
+    lens_flux -- array of lens fluxes
+    apFlux -- array of total fluxes, normalizing the flux ratios of the lens and images
+    q_flux, XIMG, YIMG -- fluxes and positions (arcsec) of the quasar images,
+                          as arrays of shape [n_rows, n_images] or sequences of n_images arrays
+    e, beta -- arrays of lens ellipticities and position angles (deg)
+    psf_fwhm -- array of PSF FWHMs (arcsec)
+    x_noise, y_noise -- optional arrays of fractional noise of the first moments,
+                        added before they enter the second moments [default: None]
+    trace_noise -- optional array of fractional noise of the trace [default: None]
+    lens_index -- optional array mapping each row to a lens. If given, XIMG, YIMG, e and beta
+                  are given per lens rather than per row, and the lens shape is evaluated once per lens.
+                  [default: None]
+    out -- optional dictionary of preallocated float64 arrays keyed by MOMENT_COLUMNS [default: None]
+
+    Returns:
+    a dictionary of arrays keyed by MOMENT_COLUMNS
+    """
+    num_rows = len(apFlux)
+    if out is None:
+        out = dict((k, np.empty(num_rows)) for k in MOMENT_COLUMNS)
+    q_flux, XIMG, YIMG = _as_columns(q_flux), _as_columns(XIMG), _as_columns(YIMG)
+    if lens_index is not None:
+        lens_moments = get_lens_second_moments(e, beta)
+
+    for start in range(0, num_rows, _BLOCK_ROWS):
+        rows = slice(start, start + _BLOCK_ROWS)
+        total_flux = apFlux[rows]
+        q_ratio = [f[rows]/total_flux for f in q_flux]
+        if lens_index is None:
+            lens_rows = rows
+            lens_Ixx, lens_Iyy, lens_Ixy = get_lens_second_moments(e[rows], beta[rows])
+        else:
+            lens_rows = lens_index[rows]
+            lens_Ixx, lens_Iyy, lens_Ixy = [m[lens_rows] for m in lens_moments]
+        ximg, yimg = [v[lens_rows] for v in XIMG], [v[lens_rows] for v in YIMG]
+
+        # First moments
+        x, y = out['x'][rows], out['y'][rows]
+        x[...], y[...] = 0.0, 0.0
+        for ratio, xq, yq in zip(q_ratio, ximg, yimg):
+            x += ratio*xq
+            y += ratio*yq
+        if x_noise is not None:
+            x += x*x_noise[rows]
+            y += y*y_noise[rows]
+
+        # Second moments of the lens
+        lens_ratio = lens_flux[rows]/total_flux
+        Ixx = lens_ratio*(lens_Ixx + x*x)
+        Iyy = lens_ratio*(lens_Iyy + y*y)
+        Ixy = lens_ratio*(lens_Ixy - x*y)
+        # Quasar contributions
+        for ratio, xq, yq in zip(q_ratio, ximg, yimg):
+            dx, dy = xq - x, yq - y
+            Ixx += ratio*dx*dx
+            Iyy += ratio*dy*dy
+            Ixy += ratio*dx*dy
+        # PSF
+        sigmasq_psf = np.power(utils.fwhm_to_sigma(psf_fwhm[rows]), 2.0)
+        Ixx += sigmasq_psf
+        Iyy += sigmasq_psf
+
+        # Trace and ellipticities
+        trace = out['trace'][rows]
+        np.add(Ixx, Iyy, out=trace)
+        if trace_noise is not None:
+            trace += trace*trace_noise[rows]
+        e1, e2 = out['e1'][rows], out['e2'][rows]
+        np.divide(Ixx - Iyy, trace, out=e1)
+        np.divide(2.0*Ixy, trace, out=e2)
+        out['e_final'][rows], out['phi_final'][rows] = utils.e1e2_to_ephi(e1, e2)
+    return out
@@ -0,0 +1,77 @@
+"""
+The :mod:`observation_index` module contains the :class:`ObservationIndex` class,
+which indexes an observation history (such as minion_1060, read by the :class:`Dataloader`)
+for fast lookups by visit ID and selections by MJD window and filter.
+"""
+from __future__ import absolute_import, division, print_function
+import numpy as np
+import pandas as pd
+
+class ObservationIndex(object):
+    """
+    Indexes of an observation history: a hash index on obsHistID,
+    and the rows of each filter sorted by MJD, on which MJD windows are binary searched.
+    Row numbers are positions in the observation history (as for .iloc).
+
+    Keyword arguments:
+    observation -- the observation history df, with columns obsHistID, expMJD and filter
+    """
+
+    def __init__(self, observation):
+        self.observation = observation
+        self._id_index = pd.Index(observation['obsHistID'].values)
+        MJD = np.asarray(observation['expMJD'].values, dtype=np.float64)
+        filters = np.asarray(observation['filter'].values).astype(str)
+        # One partition per filter, each sorted by MJD
+        order = np.lexsort((MJD, filters))
+        bounds = np.flatnonzero(np.append(True, filters[order][1:] != filters[order][:-1]))
+        bounds = np.append(bounds, len(order))
+        self._partitions = {}
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            rows = order[start:stop]
+            self._partitions[filters[rows[0]]] = (rows, MJD[rows])
+
+    def get_filters(self):
+        """
+        Returns the sorted list of filters in the observation history
+        """
+        return sorted(self._partitions)
+
+    def get_rows(self, obsHistID):
+        """
+        Returns the row numbers of the visits with the given obsHistID (scalar or array),
+        in the order of the given IDs, skipping IDs not in the observation history
+        """
+        rows = self._id_index.get_indexer_for(np.atleast_1d(obsHistID))
+        return rows[rows >= 0]
+
+    def select(self, mjd_windows=None, filters=None):
+        """
+        Returns the row numbers, in increasing order, of the visits
+        in any of the MJD windows and in any of the filters
+
+        Keyword arguments:
+        mjd_windows -- a (start, end) pair or a list of pairs of MJDs.
+                       A window includes its start and excludes its end.
+                       If None, all MJDs are selected. [default: None]
+        filters -- a string or list of filter names, e.g. 'r' or 'gri'.
+                   If None, all filters are selected. [default: None]
+        """
+        if filters is None:
+            filters = self.get_filters()
+        if mjd_windows is not None and np.ndim(mjd_windows) == 1:
+            mjd_windows = [mjd_windows]
+        selected = []
+        for band in filters:
+            if band not in self._partitions:
+                continue
+            rows, MJD = self._partitions[band]
+            if mjd_windows is None:
+                selected.append(rows)
+                continue
+            for start, end in mjd_windows:
+                selected.append(rows[np.searchsorted(MJD, start, side='left'):np.searchsorted(MJD, end, side='left')])
+        if not selected:
+            return np.zeros(0, dtype=np.int64)
+        # Overlapping windows select a row once
+        return np.unique(np.concatenate(selected))
@@ -0,0 +1,117 @@
+"""
+The :mod:`random_streams` module draws the noise of the realizers from a counter-based
+random number generator, the Philox4x32-10 block cipher of Salmon et al (2011),
+so that every random number is a pure function of (seed, objectId, ccdVisitId, noise kind).
+
+The noise of a source table row therefore does not depend on which other rows are realized
+with it, in what order, in which chunk or shard or in which process: any partial, chunked
+or parallel realization reproduces the noise of the monolithic run bit for bit, and any
+single row can be regenerated on its own.
+
+Philox is evaluated here with plain Numpy integer arithmetic on whole arrays of rows,
+so it does not need the Philox bit generator of Numpy 1.17+ (which is 4x64 and
+keyed per generator, not per row).
+"""
+from __future__ import absolute_import, division, print_function
+import numpy as np
+
+# Noise kinds, each keying an independent stream per row.
+# Values are part of the key: changing them changes every realization.
+NOISE_KINDS = {'flux': 1,
+               'first_moment': 2, # x and y
+               'second_moment': 3, # trace
+               'variability': 4, } # one innovation per quasar image
+
+_MASK32, _SHIFT32 = np.uint64(0xFFFFFFFF), np.uint64(32)
+_PHILOX_M0, _PHILOX_M1 = np.uint64(0xD2511F53), np.uint64(0xCD9E8D57)
+_PHILOX_W0, _PHILOX_W1 = 0x9E3779B9, 0xBB67AE85
+# Rows per block of the cipher, small enough for the block to stay in cache
+_BLOCK_ROWS = 2**15
+
+def philox4x32(counter, key, rounds=10):
+    """
+    Evaluates the Philox4x32 block cipher on many counters under one key
+
+    Keyword arguments:
+    counter -- sequence of four arrays of 32-bit counter words (any integer dtype)
+    key -- tuple of two 32-bit key words
+    rounds -- number of rounds [default: 10]
+
+    Returns:
+    a list of four uint64 arrays holding the 32-bit output words
+    """
+    c0, c1, c2, c3 = [np.asarray(c).astype(np.uint64) & _MASK32 for c in counter]
+    k0, k1 = int(key[0]) & 0xFFFFFFFF, int(key[1]) & 0xFFFFFFFF
+    for r in range(rounds):
+        if r > 0:
+            k0, k1 = (k0 + _PHILOX_W0) & 0xFFFFFFFF, (k1 + _PHILOX_W1) & 0xFFFFFFFF
+        # 32 x 32 -> 64 bit products are exact in uint64
+        p0, p1 = _PHILOX_M0*c0, _PHILOX_M1*c2
+        c0 = p1 >> _SHIFT32
+        c0 ^= c1
+        c0 ^= np.uint64(k0)
+        c2 = p0 >> _SHIFT32
+        c2 ^= c3
+        c2 ^= np.uint64(k1)
+        p1 &= _MASK32
+        p0 &= _MASK32
+        c1, c3 = p1, p0
+    return [c0, c1, c2, c3]
+
+def _split_id(ids):
+    ids = np.asarray(ids).astype(np.int64).view(np.uint64)
+    return ids & _MASK32, ids >> _SHIFT32
+
+def get_standard_normals(seed, kind, objectId, ccdVisitId, num_draws=1):
+    """
+    Returns standard normal deviates keyed on (seed, kind, objectId, ccdVisitId),
+    one set of num_draws per row
+
+    Keyword arguments:
+    seed -- integer seed of the realization (taken modulo 2**32)
+    kind -- noise kind, one of the keys of NOISE_KINDS
+    objectId -- array (or scalar) of object IDs, one per row
+    ccdVisitId -- array (or scalar) of visit IDs, one per row
+    num_draws -- number of independent deviates per row [default: 1]
+
+    Returns:
+    an array of shape [n_rows] if num_draws is 1 and [n_rows, num_draws] otherwise
+    (a scalar or an array of length num_draws for scalar IDs)
+    """
+    objectId, ccdVisitId = np.broadcast_arrays(objectId, ccdVisitId)
+    shape = objectId.shape
+    object_lo, object_hi = _split_id(objectId.ravel())
+    visit_lo, visit_hi = _split_id(ccdVisitId.ravel())
+    normals = np.empty((len(object_lo), 2*((num_draws + 1)//2)))
+    for start in range(0, len(object_lo), _BLOCK_ROWS):
+        rows = slice(start, start + _BLOCK_ROWS)
+        counter = (object_lo[rows], object_hi[rows], visit_lo[rows], visit_hi[rows])
+        for pair in range(normals.shape[1]//2):
+            # The row IDs are the counter, and the kind and the pair of draws are part of the key
+            words = philox4x32(counter, (seed, (NOISE_KINDS[kind] << 16) | pair))
+            # Two uniforms in (0, 1) with 53 random bits each, turned into two normals by Box-Muller
+            u1 = (((words[0] << _SHIFT32) | words[1]) >> np.uint64(11)).astype(np.float64)
+            u2 = (((words[2] << _SHIFT32) | words[3]) >> np.uint64(11)).astype(np.float64)
+            radius = np.sqrt(-2.0*np.log((u1 + 0.5)/2.0**53))
+            angle = (2.0*np.pi/2.0**53)*(u2 + 0.5)
+            normals[rows, 2*pair] = radius*np.cos(angle)
+            normals[rows, 2*pair + 1] = radius*np.sin(angle)
+    normals = normals[:, :num_draws]
+    if num_draws == 1:
+        return normals.reshape(shape)
+    return normals.reshape(shape + (num_draws,))
+
+def get_noise(seed, kind, objectId, ccdVisitId, mean, stdev, measurement=1.0):
+    """
+    Returns Gaussian noise for each row, keyed on (seed, kind, objectId, ccdVisitId).
+
+    Keyword arguments:
+    seed -- integer seed of the realization
+    kind -- noise kind, one of the keys of NOISE_KINDS
+    objectId, ccdVisitId -- arrays (or scalars) of the IDs of each row
+    mean -- the mean of Gaussian
+    stdev -- the standard deviation of Gaussian
+    measurement -- scaling factor, for adding fractional errors.
+                   If 1.0, error is absolute. [default: 1.0]
+    """
+    return measurement*(mean + stdev*get_standard_normals(seed, kind, objectId, ccdVisitId))
@@ -0,0 +1,137 @@
+"""
+The :mod:`running_stats` module provides the :class:`RunningStats` class, which accumulates
+per-group counts, means and variances of table columns over any number of blocks of rows,
+so that tables too large for memory can be summarized in one streaming pass.
+
+Each block is reduced to its own count, mean and sum of squared deviations (M2) per group,
+which are merged into the running values with the pairwise update of Chan et al (1979),
+the parallel form of Welford's algorithm. Accumulators built from separate blocks
+(e.g. in different processes) can be merged the same way, or stored as a table
+(see RunningStats.to_frame) and updated later with more rows.
+
+For tables held in memory, :func:`get_segment_stats` reduces the rows of each group
+in one pass over the table sorted by group.
+"""
+from __future__ import absolute_import, division, print_function
+import numpy as np
+import pandas as pd
+
+class RunningStats(object):
+    """
+    Running per-group count, mean and M2 of the value columns of a table.
+    Missing (NaN) values are skipped, column by column.
+
+    Keyword arguments:
+    group_columns -- list of the columns defining the groups, e.g. ['objectId', 'filter']
+    value_columns -- list of the columns to summarize
+    """
+
+    def __init__(self, group_columns, value_columns):
+        self.group_columns = list(group_columns)
+        self.value_columns = list(value_columns)
+        self.count, self.mean, self.m2 = None, None, None
+
+    def update(self, df):
+        """
+        Adds the rows of the DataFrame df, which must have the group and value columns
+        """
+        grouped = df[self.group_columns + self.value_columns].groupby(self.group_columns)
+        count = grouped.count().astype(np.float64)
+        # Sum of squared deviations from the block mean, zero for single values
+        self._merge(count, grouped.mean(), grouped.var(ddof=0)*count)
+
+    def merge(self, other):
+        """
+        Adds the statistics of another RunningStats object over the same columns
+        """
+        if other.count is not None:
+            self._merge(other.count, other.mean, other.m2)
+
+    def _merge(self, count, mean, m2):
+        if self.count is None:
+            self.count, self.mean, self.m2 = count, mean, m2
+            return
+        index = self.count.index.union(count.index)
+        count_a, mean_a, m2_a = [df.reindex(index).fillna(0.0) for df in (self.count, self.mean, self.m2)]
+        count_b, mean_b, m2_b = [df.reindex(index).fillna(0.0) for df in (count, mean, m2)]
+        total = count_a + count_b
+        delta = mean_b - mean_a
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.mean = mean_a + delta*count_b/total
+            self.m2 = m2_a + m2_b + np.power(delta, 2.0)*count_a*count_b/total
+        self.count = total
+
+    def to_frame(self):
+        """
+        Returns the running statistics as a DataFrame with the group columns and,
+        for each value column c, the columns 'count__c', 'mean__c' and 'm2__c',
+        from which from_frame restores them
+        """
+        frames = [getattr(self, stat).add_prefix(stat + '__') for stat in ['count', 'mean', 'm2']]
+        return pd.concat(frames, axis=1).reset_index()
+
+    @classmethod
+    def from_frame(cls, df, group_columns):
+        """
+        Returns the RunningStats stored in the DataFrame df by to_frame
+
+        Keyword arguments:
+        df -- DataFrame returned by to_frame, e.g. after a round trip to disk
+        group_columns -- list of the columns defining the groups
+        """
+        value_columns = [c[len('count__'):] for c in df.columns if c.startswith('count__')]
+        stats = cls(group_columns=group_columns, value_columns=value_columns)
+        df = df.set_index(list(group_columns))
+        for stat in ['count', 'mean', 'm2']:
+            frame = df[[stat + '__' + c for c in value_columns]].astype(np.float64)
+            frame.columns = value_columns
+            setattr(stats, stat, frame)
+        return stats
+
+    def get_mean(self):
+        """
+        Returns a DataFrame of the mean of each value column, indexed by the groups
+        """
+        return self.mean.where(self.count > 0)
+
+    def get_std(self, ddof=1):
+        """
+        Returns a DataFrame of the standard deviation of each value column, indexed by the groups,
+        with ddof delta degrees of freedom as in pandas (NaN for groups with count <= ddof)
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.sqrt(self.m2/(self.count - ddof))
+        return std.where(self.count > ddof)
+
+def get_segment_stats(values, starts, include_std=False, ddof=1):
+    """
+    Returns the count, mean and (optionally) standard deviation of each column
+    over contiguous segments of rows, e.g. the rows of each group of a sorted table.
+    Missing (NaN) values are skipped, column by column.
+
+    Keyword arguments:
+    values -- array of shape [n_rows, n_columns]
+    starts -- increasing array of the first row of each segment, starting with 0
+    include_std -- whether to compute the standard deviation [default: False]
+    ddof -- delta degrees of freedom of the standard deviation, as in pandas [default: 1]
+
+    Returns:
+    a tuple of arrays of shape [n_segments, n_columns] of the count, mean and
+    standard deviation (None unless include_std; NaN for segments with count <= ddof)
+    """
+    # Reduce along contiguous rows of the transposed [n_columns, n_rows] array
+    values = np.ascontiguousarray(np.transpose(np.asarray(values, dtype=np.float64)))
+    valid = ~np.isnan(values)
+    count = np.add.reduceat(valid.astype(np.int64), starts, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.add.reduceat(np.where(valid, values, 0.0), starts, axis=1)/count
+    if not include_std:
+        return count.T, mean.T, None
+
+    # Second pass over the deviations from each segment mean, which is numerically stable
+    segment = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, values.shape[1])))
+    deviation = np.where(valid, values - mean[:, segment], 0.0)
+    m2 = np.add.reduceat(np.square(deviation), starts, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        std = np.where(count > ddof, np.sqrt(m2/(count - ddof)), np.nan)
+    return count.T, mean.T, std.T
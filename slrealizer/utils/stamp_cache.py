@@ -0,0 +1,133 @@
+"""
+The :mod:`stamp_cache` module provides the :class:`StampCache` class, which keeps rendered
+postage stamps of lens systems so that the GalSim paths of the :class:`SLRealizer` worker class
+and its descendants render each (lens, band, PSF) combination only once.
+
+Observations taken in the same band under nearly the same seeing would otherwise re-render
+the same convolved stamp. PSF FWHMs are quantized, so that observations within one quantum
+share a stamp, which is then rendered at the quantized FWHM. Stamps are keyed on everything
+else that changes them as well (stamp size, quantum and render settings), so that a disk cache
+reused with other settings never returns a stamp rendered with different ones.
+"""
+from __future__ import absolute_import, division, print_function
+import os
+import hashlib
+import collections
+import numpy as np
+
+class StampCache(object):
+    """
+    Least-recently-used cache of rendered stamps with an optional disk backing.
+
+    Stamps are kept in memory up to max_memory_mb; the least recently used stamps are
+    evicted beyond that. If cache_dir is given, every stamp is also written there
+    as a .npy file, and stamps missing from memory are looked up on disk before
+    being re-rendered, so the cache persists across runs and worker processes.
+
+    Keyword arguments:
+    fwhm_quantum -- quantization step of the PSF FWHM in arcsec.
+                    If 0, only identical FWHMs share a stamp. [default: 0.01]
+    max_memory_mb -- memory limit of the in-memory cache in MB [default: 256]
+    cache_dir -- directory of the disk cache. If None, stamps are only kept in memory. [default: None]
+    """
+
+    def __init__(self, fwhm_quantum=0.01, max_memory_mb=256, cache_dir=None):
+        self.fwhm_quantum = fwhm_quantum
+        self.max_memory_bytes = int(max_memory_mb*1024**2)
+        self.cache_dir = cache_dir
+        if self.cache_dir is not None and not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self._stamps = collections.OrderedDict()
+        self._memory_bytes = 0
+        self.hits, self.disk_hits, self.misses = 0, 0, 0
+
+    def quantize_fwhm(self, fwhm):
+        """
+        Returns the representative FWHM of the quantum containing fwhm
+        """
+        if not self.fwhm_quantum:
+            return float(fwhm)
+        return round(float(fwhm)/self.fwhm_quantum)*self.fwhm_quantum
+
+    def get_key(self, lens_id, band, fwhm, nx, ny, render_settings=()):
+        """
+        Returns the cache key of a stamp
+
+        Keyword arguments:
+        lens_id, band, fwhm -- the lens, band and PSF FWHM of the stamp
+        nx, ny -- size of the stamp in pixels
+        render_settings -- tuple of any other settings the stamp depends on,
+                           with a stable repr (e.g. the pixel scale and GSParams) [default: ()]
+        """
+        if not self.fwhm_quantum:
+            fwhm_bin = repr(float(fwhm))
+        else:
+            fwhm_bin = (repr(float(self.fwhm_quantum)), int(round(float(fwhm)/self.fwhm_quantum)))
+        return (lens_id, band, fwhm_bin, int(nx), int(ny), tuple(render_settings))
+
+    def _get_path(self, key):
+        # The settings are hashed into a short, valid file name
+        settings_hash = hashlib.sha1(repr(key[2:]).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir, '%s_%s_%s.npy' %(key[0], key[1], settings_hash))
+
+    def get(self, key):
+        """
+        Returns a copy of the stamp array stored under key, or None if it was never rendered
+        """
+        if key in self._stamps:
+            stamp = self._stamps.pop(key)
+            self._stamps[key] = stamp # mark as most recently used
+            self.hits += 1
+            return stamp.copy()
+        if self.cache_dir is not None and os.path.exists(self._get_path(key)):
+            stamp = np.load(self._get_path(key))
+            self._store(key, stamp)
+            self.disk_hits += 1
+            return stamp.copy()
+        self.misses += 1
+        return None
+
+    def put(self, key, stamp):
+        """
+        Stores a copy of the stamp array under key
+        """
+        stamp = np.array(stamp, copy=True)
+        self._store(key, stamp)
+        if self.cache_dir is not None:
+            # Write then rename, so concurrent workers never read a partial file
+            path = self._get_path(key)
+            tmp_path = '%s.%d.tmp' %(path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                np.save(f, stamp)
+            os.rename(tmp_path, path)
+
+    def _store(self, key, stamp):
+        if key in self._stamps:
+            self._memory_bytes -= self._stamps.pop(key).nbytes
+        self._stamps[key] = stamp
+        self._memory_bytes += stamp.nbytes
+        while self._memory_bytes > self.max_memory_bytes and len(self._stamps) > 1:
+            _, evicted = self._stamps.popitem(last=False)
+            self._memory_bytes -= evicted.nbytes
+
+    def clear(self):
+        """
+        Empties the in-memory cache and resets the statistics (the disk cache is kept)
+        """
+        self._stamps.clear()
+        self._memory_bytes = 0
+        self.hits, self.disk_hits, self.misses = 0, 0, 0
+
+    def get_stats(self):
+        """
+        Returns a dictionary of cache statistics: numbers of memory hits,
+        disk hits and misses, the overall hit rate, the number of stamps
+        held in memory and their size in MB
+        """
+        lookups = self.hits + self.disk_hits + self.misses
+        return {'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits)/lookups if lookups else 0.0,
+                'num_stamps': len(self._stamps),
+                'memory_mb': self._memory_bytes/1024.0**2, }
@@ -0,0 +1,353 @@
+"""
+The :mod:`table_io` module provides pluggable readers and writers for the source and object tables
+produced by the :class:`SLRealizer` worker class and its descendants.
+
+Besides csv, tables can be stored in typed, columnar binary formats
+(Parquet, Feather/Arrow IPC and HDF5), which are much faster to write and read back
+and several times smaller than text. The format is inferred from the file extension
+unless given explicitly. Writers accept a table block by block, so that tables realized
+in chunks never have to be held in memory at once, and can append blocks to an existing table.
+
+Binary formats need optional dependencies: `pyarrow` for Parquet and Feather,
+and `tables` (PyTables) for HDF5.
+"""
+from __future__ import absolute_import, division, print_function
+import os
+import pandas as pd
+
+# Key under which tables are stored in HDF5 files
+HDF5_KEY = 'table'
+# Minimum string length reserved for text columns in HDF5 files,
+# which cannot grow once the first block has been written
+HDF5_MIN_ITEMSIZE = 32
+
+class TableWriter(object):
+    """
+    Base class for writing a table to disk one block at a time.
+
+    Blocks are DataFrames with identical columns. If index is True,
+    the index of each block is written out as a regular (first) column,
+    as pandas does for csv files. If append is True and the file exists,
+    the blocks are added after its rows, which must have the same columns.
+
+    Usage:
+        with get_table_writer(path) as writer:
+            for block in blocks:
+                writer.write(block)
+    """
+
+    def __init__(self, path, index=True, append=False):
+        self.path = path
+        self.index = index
+        self.append = append and os.path.exists(path)
+        self.num_rows = 0
+
+    def write(self, df):
+        self._write(df.reset_index() if self.index else df)
+        self.num_rows += len(df)
+
+    def _write(self, df):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class CSVTableWriter(TableWriter):
+
+    def __init__(self, path, index=True, append=False):
+        super(CSVTableWriter, self).__init__(path, index=index, append=append)
+        self._wrote_header = self.append and os.path.getsize(path) > 0
+
+    def write(self, df):
+        # pandas writes the index itself, which keeps csv output identical to df.to_csv
+        df.to_csv(self.path, index=self.index, mode='a' if self._wrote_header else 'w', header=not self._wrote_header)
+        self._wrote_header = True
+        self.num_rows += len(df)
+
+class ParquetTableWriter(TableWriter):
+
+    def __init__(self, path, index=True, append=False):
+        super(ParquetTableWriter, self).__init__(path, index=index, append=append)
+        self._writer = None
+
+    def _write(self, df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if self._writer is None and self.append:
+            # Parquet files cannot grow in place: their row groups are copied into a new file
+            existing = pq.ParquetFile(self.path)
+            self._writer = pq.ParquetWriter(_get_temporary_path(self.path), existing.schema_arrow)
+            for i in range(existing.num_row_groups):
+                self._writer.write_table(existing.read_row_group(i))
+        if self._writer is None:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            self._writer = pq.ParquetWriter(self.path, table.schema)
+        else:
+            table = pa.Table.from_pandas(df, schema=self._writer.schema, preserve_index=False)
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            if self.append:
+                _replace(_get_temporary_path(self.path), self.path)
+
+class FeatherTableWriter(TableWriter):
+
+    def __init__(self, path, index=True, append=False):
+        super(FeatherTableWriter, self).__init__(path, index=index, append=append)
+        self._writer = None
+        self._schema = None
+
+    def _write(self, df):
+        import pyarrow as pa
+        if self._writer is None and self.append:
+            # Feather files cannot grow in place: their record batches are copied into a new file
+            existing = pa.ipc.open_file(self.path)
+            self._schema = existing.schema
+            self._writer = pa.RecordBatchFileWriter(_get_temporary_path(self.path), self._schema)
+            for i in range(existing.num_record_batches):
+                self._writer.write_batch(existing.get_batch(i))
+        if self._writer is None:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            self._schema = table.schema
+            self._writer = pa.RecordBatchFileWriter(self.path, self._schema)
+        else:
+            table = pa.Table.from_pandas(df, schema=self._schema, preserve_index=False)
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            if self.append:
+                _replace(_get_temporary_path(self.path), self.path)
+
+class HDF5TableWriter(TableWriter):
+
+    def __init__(self, path, index=True, append=False):
+        super(HDF5TableWriter, self).__init__(path, index=index, append=append)
+        self._store = None
+
+    def _write(self, df):
+        if self._store is None:
+            self._store = pd.HDFStore(self.path, mode='a' if self.append else 'w')
+        min_itemsize = dict((c, HDF5_MIN_ITEMSIZE) for c in df.columns if df[c].dtype == object)
+        self._store.append(HDF5_KEY, df, format='table', index=False, min_itemsize=min_itemsize or None)
+
+    def close(self):
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
+def _get_temporary_path(path):
+    return path + '.tmp'
+
+def _replace(source, destination):
+    # os.rename does not overwrite on Windows
+    if os.path.exists(destination):
+        os.remove(destination)
+    os.rename(source, destination)
+
+def _read_csv(path, columns=None):
+    return pd.read_csv(path, usecols=columns)
+
+def _read_parquet(path, columns=None):
+    return pd.read_parquet(path, columns=columns)
+
+def _read_feather(path, columns=None):
+    import pyarrow as pa
+    table = pa.ipc.open_file(path).read_all()
+    if columns is not None:
+        table = table.select(columns)
+    return table.to_pandas()
+
+def _read_hdf5(path, columns=None):
+    return pd.read_hdf(path, HDF5_KEY, columns=columns).reset_index(drop=True)
+
+def _iter_csv(path, columns=None, chunk_rows=100000, start_row=0, start_byte=None):
+    with open(path, 'rb') as f:
+        header = f.readline()
+        if start_byte is not None and start_byte >= len(header):
+            f.seek(start_byte - 1)
+            # Only resume at the start of a line, i.e. at the end of the rows already read
+            if f.read(1) == b'\n':
+                if start_byte == os.fstat(f.fileno()).st_size:
+                    return # no rows were appended
+                names = pd.read_csv(path, nrows=0).columns
+                for chunk in pd.read_csv(f, header=None, names=names, usecols=columns, chunksize=chunk_rows):
+                    yield chunk
+                return
+    # Skipped lines are still tokenized, so this takes time linear in start_row
+    skiprows = range(1, start_row + 1) if start_row else None
+    for chunk in pd.read_csv(path, usecols=columns, chunksize=chunk_rows, skiprows=skiprows):
+        yield chunk
+
+def _iter_parquet(path, columns=None, chunk_rows=100000, start_row=0):
+    import pyarrow.parquet as pq
+    parquet_file = pq.ParquetFile(path)
+    # Skip whole row groups (the blocks the table was written in) from the metadata
+    row_groups, offset = [], 0
+    for i in range(parquet_file.num_row_groups):
+        num_rows = parquet_file.metadata.row_group(i).num_rows
+        if offset + num_rows > start_row:
+            row_groups.append(i)
+        else:
+            offset += num_rows
+    if not row_groups:
+        return
+    for batch in parquet_file.iter_batches(batch_size=chunk_rows, row_groups=row_groups, columns=columns):
+        skip = min(max(start_row - offset, 0), batch.num_rows)
+        offset += batch.num_rows
+        if skip < batch.num_rows:
+            yield batch.slice(skip).to_pandas()
+
+def _iter_feather(path, columns=None, chunk_rows=100000, start_row=0):
+    import pyarrow as pa
+    reader = pa.ipc.open_file(path)
+    # Record batches are the blocks the table was written in
+    offset = 0
+    for i in range(reader.num_record_batches):
+        batch = reader.get_batch(i)
+        skip = min(max(start_row - offset, 0), batch.num_rows)
+        offset += batch.num_rows
+        if columns is not None:
+            batch = batch.select(columns)
+        for start in range(skip, batch.num_rows, chunk_rows):
+            yield batch.slice(start, chunk_rows).to_pandas()
+
+def _iter_hdf5(path, columns=None, chunk_rows=100000, start_row=0):
+    with pd.HDFStore(path, mode='r') as store:
+        for chunk in store.select(HDF5_KEY, columns=columns, chunksize=chunk_rows, start=start_row or None):
+            yield chunk.reset_index(drop=True)
+
+# Registry of table formats, keyed by format name
+_TABLE_FORMATS = {}
+
+def register_table_format(name, writer, reader, extensions=(), chunk_reader=None):
+    """
+    Registers a table format, making it available to
+    get_table_writer, write_table, read_table and iter_table
+
+    Keyword arguments:
+    name -- name of the format, e.g. 'parquet'
+    writer -- subclass of TableWriter writing (or appending to) this format
+    reader -- function of (path, columns=None) returning a DataFrame,
+              with the index (if written) as a regular column
+    extensions -- file extensions (including the dot) from which the format is inferred
+    chunk_reader -- generator function of (path, columns=None, chunk_rows=100000, start_row=0)
+                    yielding the table from row start_row as DataFrames of at most chunk_rows rows.
+                    If None, iter_table reads the whole table as one chunk. [default: None]
+    """
+    _TABLE_FORMATS[name] = {'writer': writer, 'reader': reader, 'extensions': tuple(extensions),
+                            'chunk_reader': chunk_reader}
+
+register_table_format('csv', CSVTableWriter, _read_csv, extensions=['.csv', '.txt'], chunk_reader=_iter_csv)
+register_table_format('parquet', ParquetTableWriter, _read_parquet, extensions=['.parquet', '.pq'], chunk_reader=_iter_parquet)
+register_table_format('feather', FeatherTableWriter, _read_feather, extensions=['.feather', '.arrow'], chunk_reader=_iter_feather)
+register_table_format('hdf5', HDF5TableWriter, _read_hdf5, extensions=['.h5', '.hdf5', '.hdf'], chunk_reader=_iter_hdf5)
+
+def get_table_format(path, table_format=None):
+    """
+    Returns the name of the format of the table at path
+
+    Keyword arguments:
+    path -- path of the table file
+    table_format -- explicit format name. If None, the format is inferred
+                    from the file extension, defaulting to csv. [default: None]
+    """
+    if table_format is not None:
+        if table_format not in _TABLE_FORMATS:
+            raise ValueError("Please choose one of %s" %(','.join(sorted(_TABLE_FORMATS))))
+        return table_format
+    extension = os.path.splitext(path)[1].lower()
+    for name, table_format_info in _TABLE_FORMATS.items():
+        if extension in table_format_info['extensions']:
+            return name
+    return 'csv'
+
+def get_table_writer(path, table_format=None, index=True, append=False):
+    """
+    Returns a TableWriter for the table at path
+
+    Keyword arguments:
+    path -- path of the output table file
+    table_format -- name of the format. If None, inferred from path. [default: None]
+    index -- whether to write the index of each block as a column [default: True]
+    append -- whether to add the blocks after the rows of an existing table at path,
+              rather than overwrite it. Csv and HDF5 tables grow in place,
+              Parquet and Feather tables are copied into a new file. [default: False]
+    """
+    return _TABLE_FORMATS[get_table_format(path, table_format)]['writer'](path, index=index, append=append)
+
+def write_table(df, path, table_format=None, index=True, append=False):
+    """
+    Writes the DataFrame df to path in one go. See get_table_writer.
+    """
+    with get_table_writer(path, table_format=table_format, index=index, append=append) as writer:
+        writer.write(df)
+
+def get_sidecar_path(path, name):
+    """
+    Returns the path of a table stored alongside the table at path,
+    e.g. 'source.variability.csv' for get_sidecar_path('source.csv', 'variability')
+    """
+    root, extension = os.path.splitext(path)
+    return '%s.%s%s' %(root, name, extension)
+
+def read_table(path, table_format=None, columns=None):
+    """
+    Reads the table at path into a DataFrame, with typed columns
+    for the binary formats
+
+    Keyword arguments:
+    path -- path of the table file
+    table_format -- name of the format. If None, inferred from path. [default: None]
+    columns -- list of columns to read. If None, all columns are read. [default: None]
+
+    Returns:
+    a Pandas dataframe, with any written index as a regular column
+    """
+    return _TABLE_FORMATS[get_table_format(path, table_format)]['reader'](path, columns=columns)
+
+def iter_table(path, table_format=None, columns=None, chunk_rows=100000, start_row=0, start_byte=None):
+    """
+    Reads the table at path as a sequence of DataFrames of bounded size,
+    so that tables larger than memory can be processed block by block
+
+    Keyword arguments:
+    path -- path of the table file
+    table_format -- name of the format. If None, inferred from path. [default: None]
+    columns -- list of columns to read. If None, all columns are read. [default: None]
+    chunk_rows -- maximum number of rows per DataFrame [default: 100000]
+    start_row -- number of leading rows to skip, e.g. the rows already processed
+                 before more rows were appended to the table [default: 0]
+    start_byte -- for csv tables, the size of the file when its first start_row rows were written
+                  (see get_table_size), from which reading resumes without parsing the earlier rows.
+                  Without it, skipping rows of a csv table takes time linear in start_row,
+                  whereas the binary formats seek to start_row directly. [default: None]
+
+    Returns:
+    a generator of Pandas dataframes, with any written index as a regular column
+    """
+    table_format = get_table_format(path, table_format)
+    table_format_info = _TABLE_FORMATS[table_format]
+    if table_format_info['chunk_reader'] is None:
+        return iter([table_format_info['reader'](path, columns=columns).iloc[start_row:]])
+    if table_format == 'csv' and start_byte is not None:
+        return _iter_csv(path, columns=columns, chunk_rows=chunk_rows, start_row=start_row, start_byte=start_byte)
+    return table_format_info['chunk_reader'](path, columns=columns, chunk_rows=chunk_rows, start_row=start_row)
+
+def get_table_size(path):
+    """
+    Returns the size in bytes of the table file at path,
+    which, for a csv table, is the start_byte of the rows appended to it later (see iter_table)
+    """
+    return os.path.getsize(path)
@@ -4,6 +4,55 @@ The :mod:`utils` module provides a number of utility functions used by the :clas
 from __future__ import absolute_import, division, print_function
 import numpy as np
 
+# Pixel coordinates of each (image shape, pixel scale), shared by all moment calculations
+_pixel_coordinates_cache = {}
+
+def get_pixel_coordinates(shape, pixel_scale):
+    """
+    Returns the x and y coordinates in arcsec of the pixel centers of an image,
+    with the origin at the center of the image
+
+    Keyword arguments:
+    shape -- shape (ny, nx) of the image array
+    pixel_scale -- scale factor for the image in arcsec/pixel
+
+    Returns:
+    a tuple of the arrays of x coordinates (length nx) and y coordinates (length ny)
+    """
+    key = (tuple(shape), float(pixel_scale))
+    if key not in _pixel_coordinates_cache:
+        ny, nx = shape
+        x_coords = (np.arange(nx) - (nx - 1)/2)*pixel_scale
+        y_coords = (np.arange(ny) - (ny - 1)/2)*pixel_scale
+        _pixel_coordinates_cache[key] = (x_coords, y_coords)
+    return _pixel_coordinates_cache[key]
+
+def get_moments_from_image_stack(image_stack, pixel_scale):
+    """
+    Returns the flux and the first and (central) second moments in arcsec units
+    numerically computed from a stack of images on the same pixel grid
+
+    Keyword arguments:
+    image_stack -- a numpy array of shape [n_images, ny, nx]
+    pixel_scale -- scale factor for the images in arcsec/pixel
+
+    Returns:
+    a tuple of arrays of length n_images of the flux and the moments Ix, Iy, Ixx, Ixy, Iyy
+    """
+    image_stack = np.asarray(image_stack, dtype=np.float64)
+    x_coords, y_coords = get_pixel_coordinates(image_stack.shape[1:], pixel_scale)
+    # Contract over x first, then reduce the per-row marginals over y
+    row_flux = np.sum(image_stack, axis=2) # [n_images, ny]
+    row_x = np.dot(image_stack, x_coords)
+    row_xx = np.dot(image_stack, np.power(x_coords, 2.0))
+    flux = np.sum(row_flux, axis=1)
+    Ix = np.sum(row_x, axis=1)/flux
+    Iy = np.dot(row_flux, y_coords)/flux
+    Ixx = np.sum(row_xx, axis=1)/flux - np.power(Ix, 2.0)
+    Ixy = np.dot(row_x, y_coords)/flux - Ix*Iy
+    Iyy = np.dot(row_flux, np.power(y_coords, 2.0))/flux - np.power(Iy, 2.0)
+    return flux, Ix, Iy, Ixx, Ixy, Iyy
+
 def get_first_moments_from_image(image_array, pixel_scale):
     """
     Returns the first moments in arcsec units numerically computed from
@@ -16,15 +65,8 @@ def get_first_moments_from_image(image_array, pixel_scale):
     Returns:
     a tuple of the first moments Ix, Iy in arcsec
     """
-    nx, ny = image_array.shape
-    offset = np.array([(nx - 1)/2, (ny - 1)/2]).reshape(2, 1, 1)
-    pixel_grid = np.indices([nx, ny]) - offset # shape (2, nx, ny)
-    x_coords = pixel_grid[1, :, :] * pixel_scale
-    y_coords = pixel_grid[0, :, :] * pixel_scale
-    total_flux = np.sum(image_array)
-    Ix = np.sum(image_array * x_coords) / total_flux
-    Iy = np.sum(image_array * y_coords) / total_flux
-    return Ix, Iy
+    _, Ix, Iy, _, _, _ = get_moments_from_image_stack(image_array[np.newaxis], pixel_scale)
+    return Ix[0], Iy[0]
 
 def get_second_moments_from_image(image_array, pixel_scale):
     """
@@ -38,20 +80,12 @@ def get_second_moments_from_image(image_array, pixel_scale):
     Returns:
     a tuple of the second moments Ixx, Ixy, Iyy in arcsec
     """
-    nx, ny = image_array.shape
-    Ix, Iy = get_first_moments_from_image(image_array, pixel_scale=1.0)
-    offset = np.array([(ny - 1)/2 + Iy, (nx - 1)/2 + Ix]).reshape(2, 1, 1)
-    pixel_grid = np.indices([ny, nx]) - offset # shape (2, nx, ny)
-    x_coords = pixel_grid[1, :, :] * pixel_scale
-    y_coords = pixel_grid[0, :, :] * pixel_scale
-    total_flux = np.sum(image_array)
-    Ixx = np.sum(image_array * np.power(x_coords, 2.0)) / total_flux
-    Ixy = np.sum(image_array * x_coords * y_coords) / total_flux
-    Iyy = np.sum(image_array * np.power(y_coords, 2.0)) / total_flux
-    return Ixx, Ixy, Iyy
+    _, _, _, Ixx, Ixy, Iyy = get_moments_from_image_stack(image_array[np.newaxis], pixel_scale)
+    return Ixx[0], Ixy[0], Iyy[0]
 
 def e1e2_to_ephi(e1, e2):
-    e = np.power(np.power(e1, 2.0) + np.power(e2, 2.0), 0.5)
+    # Same values for arrays and pandas Series (np.power on a Series evaluates as **)
+    e = np.sqrt(np.square(e1) + np.square(e2))
     phi = 0.5*np.arctan(e2/e1)
     return e, phi
 
@@ -70,6 +104,132 @@ def get_1D_columns(multidimColNames, table):
         totalColDict.update(colDict)
     return totalColDict
 
+def get_flat_om10_catalog(table):
+    """
+    Converts a painted OM10 lens sample into a flat Pandas dataframe
+    holding the columns used by the realizers, with the per-image columns
+    MAG, XIMG, YIMG unpacked into four 1D columns each and one row per unique LENSID
+
+    Keyword arguments:
+    table -- the Astropy table of a painted OM10 DB (DB.sample)
+
+    Returns:
+    a Pandas dataframe of the flattened, deduplicated catalog
+    """
+    import pandas as pd
+
+    saveCols = [b + '_SDSS_lens' for b in 'ugriz'] + [b + '_SDSS_quasar' for b in 'ugriz']
+    saveCols += ['REFF_T', 'NIMG', 'LENSID', 'ELLIP', 'PHIE']
+    saveColDict = dict((c, table[c].data) for c in saveCols)
+    saveColDict.update(get_1D_columns(multidimColNames=['MAG', 'XIMG', 'YIMG'], table=table))
+    # FITS columns are big-endian, so convert them to native byte order
+    columns = list(saveCols) + sorted(set(saveColDict) - set(saveCols))
+    catalog = pd.DataFrame(dict((c, np.asarray(v, dtype=v.dtype.newbyteorder('='))) for c, v in saveColDict.items()),
+                           columns=columns)
+    catalog.drop_duplicates('LENSID', inplace=True)
+    return catalog.reset_index(drop=True)
+
+def get_om10_sample(flat_catalog):
+    """
+    Inverse of get_flat_om10_catalog: packs the unpacked per-image columns
+    back into [n, 4] columns, returning an Astropy table that can stand in for DB.sample
+    """
+    from astropy.table import Table
+
+    multidimColNames = ['MAG', 'XIMG', 'YIMG']
+    names = [c for c in flat_catalog.columns if c.rsplit('_', 1)[0] not in multidimColNames]
+    columns = [flat_catalog[c].values for c in names]
+    for mc in multidimColNames:
+        names.append(mc)
+        columns.append(np.column_stack([flat_catalog[mc + '_' + str(c)].values for c in range(4)]))
+    return Table(columns, names=names)
+
+def get_band_index(filters, bands='ugriz'):
+    """
+    Maps each filter name to the integer position of that band in bands,
+    so that multi-band quantities stored as an array of shape [..., len(bands)]
+    can be read out with a single indexed gather
+
+    Keyword arguments:
+    filters -- array-like of filter names, e.g. the 'filter' column of the observation history
+    bands -- string of band names, in the column order of the multi-band arrays [default: 'ugriz']
+
+    Returns:
+    a numpy array of integer band indices, with the same length as filters
+    """
+    if hasattr(filters, 'categories') and list(filters.categories) == list(bands):
+        # The codes of a compact (categorical) filter column already are the band indices
+        band_index = np.asarray(filters.codes, dtype=np.int64)
+        if np.any(band_index < 0):
+            raise ValueError("Missing filter(s) among the bands %s" %bands)
+        return band_index
+    filters = np.asarray(filters)
+    band_index = np.full(filters.shape, -1, dtype=np.int64)
+    for i, b in enumerate(bands):
+        band_index[filters == b] = i
+    if np.any(band_index < 0):
+        unknown = sorted(set(filters[band_index < 0]))
+        raise ValueError("Filter(s) %s not among the bands %s" %(unknown, bands))
+    return band_index
+
+def select_rows(columns, rows):
+    """
+    Returns a dictionary of arrays restricted to the given rows
+
+    Keyword arguments:
+    columns -- dictionary of equal-length numpy arrays
+    rows -- a slice, integer index array or boolean mask into the arrays
+
+    Returns:
+    a dictionary with the same keys as columns
+    """
+    return dict((k, v[rows]) for k, v in columns.items())
+
+def get_filter_dtype(bands='ugriz'):
+    """
+    Returns the categorical dtype of the filter column of compact tables,
+    which stores each filter name as a one-byte code into bands
+    """
+    import pandas as pd
+    return pd.api.types.CategoricalDtype(categories=list(bands))
+
+def get_id_dtype(ids):
+    """
+    Returns the integer dtype of an ID column of compact tables:
+    int32 if all the IDs fit in it, and int64 otherwise.
+    The same dtype is used for every block of a table, so that blocks can be appended.
+    """
+    ids = np.asarray(ids)
+    info = np.iinfo(np.int32)
+    if len(ids) == 0 or (ids.min() >= info.min and ids.max() <= info.max):
+        return np.dtype(np.int32)
+    return np.dtype(np.int64)
+
+def compact_columns(columns, dtypes):
+    """
+    Casts the columns of a table to the compact schema, in place and one column at a time:
+    the columns named in dtypes to the given dtypes, and any other float64 column to float32
+
+    Keyword arguments:
+    columns -- a Pandas dataframe or dictionary of arrays
+    dtypes -- dictionary of the dtypes of some columns,
+              e.g. {'MJD': np.float64, 'filter': get_filter_dtype()}
+
+    Returns:
+    columns, with the cast columns
+    """
+    import pandas as pd
+    for c in list(columns.keys()):
+        values = columns[c]
+        dtype = dtypes.get(c, np.float32 if values.dtype == np.float64 else None)
+        if dtype is None or values.dtype == dtype:
+            continue
+        if isinstance(dtype, pd.api.types.CategoricalDtype):
+            columns[c] = pd.Categorical(values, dtype=dtype)
+        else:
+            columns[c] = values.astype(dtype)
+    return columns
+
 def hlr_to_sigma(hlr):
     return hlr/np.sqrt(2.0*np.log(2.0))
 
@@ -98,20 +258,6 @@ def mag_to_flux(mag, zeropoint_mag=0.0, from_unit=None, to_unit=None):
         zeropoint_mag=22.5
     return np.power(10.0, -0.4*(mag - zeropoint_mag))
 
-def add_noise(mean, stdev, shape=None, measurement=1.0):
-    """
-    Given a mean and a standard deviation of a measurement, adds Gaussian noise to the data
-
-    Keyword arguments:
-    mean -- the mean of Gaussian
-    stdev -- the standard deviation of Gaussian
-    shape -- the array shape of noise to be returned
-             If None, returns a scalar noise [default: None]
-    measurement -- scaling factor, for adding fractional errors.
-                   If 1.0, error is absolute. [default: 1.0]
-    """
-    return measurement*np.random.normal(loc=mean, scale=stdev, size=shape)
-
 '''
 def return_coordinate(first_moment_x, first_moment_y):
     """
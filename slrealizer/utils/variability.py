@@ -0,0 +1,117 @@
+"""
+The :mod:`variability` module generates the intrinsic variability of quasar images
+with the damped random walk (Ornstein-Uhlenbeck) model of MacLeod et al (2010),
+for many light curves at once.
+
+A light curve (series) is the sequence of epochs of one object in one band.
+All series are sorted once, every quasar image of every series is drawn in one batch,
+and the recurrence is stepped through the epochs in order, each step acting on all series
+at that position, so the cost is linear in the number of rows.
+"""
+from __future__ import absolute_import, division, print_function
+import numpy as np
+import slrealizer.utils.constants as constants
+
+def get_light_curve_order(objectId, band_index, MJD):
+    """
+    Returns the ordering that sorts rows into contiguous light curves
+
+    Keyword arguments:
+    objectId -- array of object IDs, one per row
+    band_index -- array of integer band indices, one per row
+    MJD -- array of observation times, one per row
+
+    Returns:
+    a tuple of the row order (sorting by band, objectId, then MJD)
+    and the boolean array, in sorted order, marking the first epoch of each light curve
+    """
+    order = np.lexsort((MJD, objectId, band_index))
+    sorted_object, sorted_band = objectId[order], band_index[order]
+    is_first = np.ones(len(order), dtype=bool)
+    is_first[1:] = (sorted_object[1:] != sorted_object[:-1]) | (sorted_band[1:] != sorted_band[:-1])
+    return order, is_first
+
+def draw_drw_light_curves(MJD, is_first, num_images, normals, initial_mag=None, initial_MJD=None,
+                          mean=None, timescale=None, sf_inf=None):
+    """
+    Draws damped random walk magnitude offsets for sorted light curves
+
+    Keyword arguments:
+    MJD -- array of observation times, sorted within each light curve
+    is_first -- boolean array marking the first epoch of each light curve
+    num_images -- number of independent walks (quasar images) per light curve
+    normals -- array of shape [n_rows, num_images] of the standard normal innovations of each step
+    initial_mag -- array of shape [n_rows, num_images] holding, at the first epoch
+                   of each light curve, the walk value at initial_MJD.
+                   If None, each walk starts from zero at its first epoch. [default: None]
+    initial_MJD -- array of length n_rows holding, at the first epoch of each light curve,
+                   the time of initial_mag (NaN where there is no earlier state) [default: None]
+    mean, timescale, sf_inf -- parameters of the walk in mag, days and mag.
+                               If None, taken from the constants module. [default: None]
+
+    Returns:
+    an array of shape [n_rows, num_images] of magnitude offsets
+    """
+    mean = constants.get_drw_mean() if mean is None else mean
+    timescale = constants.get_drw_timescale() if timescale is None else timescale
+    sf_inf = constants.get_drw_sf_inf() if sf_inf is None else sf_inf
+    num_rows = len(MJD)
+
+    # Time elapsed since the previous epoch of the same light curve
+    d_time = np.zeros(num_rows)
+    d_time[1:] = MJD[1:] - MJD[:-1]
+    previous = np.zeros((num_rows, num_images))
+    if initial_MJD is not None:
+        d_time[is_first] = np.nan_to_num(MJD[is_first] - initial_MJD[is_first])
+        previous[is_first] = np.nan_to_num(initial_mag[is_first])
+    else:
+        d_time[is_first] = 0.0
+    d_time = np.clip(d_time, a_min=0.0, a_max=None)
+
+    # Conditional mean and standard deviation of each step
+    decay = np.exp(-d_time/timescale)
+    step_std = np.sqrt(0.5*sf_inf**2.0*(1.0 - np.exp(-2.0*d_time/timescale)))
+    innovation = mean*(1.0 - decay)[:, np.newaxis] + step_std[:, np.newaxis]*normals
+
+    # Step all light curves through their epochs together,
+    # longest first so that the light curves still running at each step are a prefix
+    first_rows = np.flatnonzero(is_first)
+    lengths = np.diff(np.append(first_rows, num_rows))
+    by_length = np.argsort(-lengths, kind='mergesort')
+    first_rows, lengths = first_rows[by_length], lengths[by_length]
+    num_running = np.searchsorted(-lengths, -np.arange(lengths.max() if num_rows else 0), side='left')
+    walk = np.empty((num_rows, num_images))
+    rows = first_rows
+    walk[rows] = decay[rows, np.newaxis]*previous[rows] + innovation[rows]
+    for position in range(1, len(num_running)):
+        rows = first_rows[:num_running[position]] + position
+        walk[rows] = decay[rows, np.newaxis]*walk[rows - 1] + innovation[rows]
+    return walk
+
+def get_intrinsic_variability(objectId, band_index, MJD, normals, num_images=4, initial_mag=None, initial_MJD=None):
+    """
+    Draws damped random walk magnitude offsets for rows in any order,
+    with one light curve per (object, band) and independent walks per quasar image
+
+    Keyword arguments:
+    objectId -- array of object IDs, one per row
+    band_index -- array of integer band indices, one per row
+    MJD -- array of observation times, one per row
+    normals -- array of shape [n_rows, num_images] of the standard normal innovation
+               of each row, e.g. keyed on the row IDs with utils.random_streams
+    num_images -- number of quasar images per object [default: 4]
+    initial_mag, initial_MJD -- optional per-row earlier state of each light curve,
+                                see draw_drw_light_curves [default: None]
+
+    Returns:
+    an array of shape [n_rows, num_images] of magnitude offsets, in the input row order
+    """
+    order, is_first = get_light_curve_order(objectId, band_index, MJD)
+    if initial_MJD is not None:
+        initial_mag, initial_MJD = initial_mag[order], initial_MJD[order]
+    walk = draw_drw_light_curves(MJD[order], is_first, num_images, normals[order],
+                                 initial_mag=initial_mag, initial_MJD=initial_MJD)
+    # Scatter back to the input row order
+    variability = np.empty_like(walk)
+    variability[order] = walk
+    return variability